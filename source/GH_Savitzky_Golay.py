@@ -26,19 +26,30 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     ###-----------------###
     #Use the Savitzky-Golay method to determine the accelerations from a cloud of positions (y)
     ###-----------------###
-    order_range = range(order+1)
     half_window = (window_size -1) // 2
-    # precompute coefficients
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] / (rate**deriv) * factorial(deriv)
+    m = savitzky_golay_coef(window_size, order, deriv, rate)
     # pad the signal at the extremes with
     # values taken from the signal itself
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+    firstvals = savitzky_golay_pad(y, half_window, 0)
+    lastvals = savitzky_golay_pad(y, half_window, -1)
     y = np.concatenate((firstvals, y, lastvals))
     return np.convolve( m[::-1], y, mode='valid')
 
 
+def savitzky_golay_coef(window_size, order, deriv=0, rate=1):
+    """ returns the 2*((window_size-1)//2)+1 weights of the filter, applied as windows @ m """
+    half_window = (window_size -1) // 2
+    b = np.array([[k**i for i in range(order+1)] for k in range(-half_window, half_window+1)])
+    return np.linalg.pinv(b)[deriv] / (rate**deriv) * factorial(deriv)
+
+
+def savitzky_golay_pad(y, half_window, side):
+    """ returns the values savitzky_golay pads the start (side=0) or the end (side=-1) of y with """
+    if side == 0:
+        return y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
+    return y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+
+
 def savitzky_golay_mat(Nmeasures, order, window_size, deriv = 0, rate = 1):
 
     order_range = range(order+1)
@@ -0,0 +1,443 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The purpose of this script is to check the fast kernels against reference
+    values computed with high precision arithmetic (mpmath), so that a faster
+    version of a kernel can not be slightly wrong without anyone noticing.
+    The Legendre functions, geoid heights and accelerations are computed in
+    mpmath with the standard forward column recursion, which does not under
+    or overflow at any degree in arbitrary precision. Each kernel is then run
+    at the same points, and its maximum error is reported next to its runtime
+        python GH_accuracy.py
+        python GH_accuracy.py --quick --select alf
+    Generally used variables:
+        Lat, Long = coordinates of the checked points, in degrees
+        Columns   = reference ALFs, Columns[m][l-m] = P_lm, mpmath numbers
+        Report    = list of the checks: kernel, lmax, error, time, status
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import numpy as np
+from numpy import pi, sin
+import sys
+import json
+import argparse
+import warnings
+import mpmath as mp
+from functools import lru_cache
+
+#import GH_import       as imp
+#import GH_convert      as conv
+#import GH_generate     as gen
+import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+#import GH_terminal     as term
+import GH_harmonics    as harm
+import GH_geoMath      as gmath
+#import GH_earthMap     as emap
+import GH_gravityModel as gm
+import GH_benchmark    as bench
+
+
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Lat  = np.array([-72.3, -30.1, 0.5, 17.9, 45.2, 88.7]) # no pole, dP/dlat uses tan(lat)
+Long = np.array([-170.4, -60.2, 0.3, 33.3, 101.7, 179.2])
+dps = 40 # decimal digits of the reference values
+Tolerance = 1e-9 # largest error accepted: absolute for the ALFs, relative for the rest
+
+"""
+Known_Limits: highest degree at which a kernel is known to be right. Above
+it, a failed check is reported as "limit" and does not fail the run.
+The lpmn path (Pol_Legendre * Normalize) loses the high orders above degree
+~85: Normalize underflows to 0 once (l+m)! passes 1e308, and lpmn overflows
+a bit further
+"""
+Known_Limits = {"lpmn_Normalize":    85,
+                "Get_Geoid_Height":  85,
+                "Get_acceleration3": 85}
+
+
+
+# =============================================================================
+# FUNCTIONS FOR REFERENCE VALUES
+# =============================================================================
+def Ref_ALF_Column (lmax, m, t):
+    """
+    Returns the fully normalized ALFs P_lm(t) of order m, for l = m..lmax, in
+    mpmath numbers, with the standard forward column method (see
+    GH_geoMath.ALF_norm_gcb), at the current mpmath precision
+    """
+    u = mp.sqrt(1 - t*t)
+    P_mm = mp.mpf(1)
+    if m >= 1:
+        P_mm = mp.sqrt(3) * u
+    for i in range(2, m+1):
+        P_mm *= mp.sqrt(mp.mpf(2*i+1) / (2*i)) * u
+
+    Column = [P_mm]
+    if m+1 <= lmax:
+        Column.append(mp.sqrt(2*m+3) * t * P_mm)
+    for n in range(m+2, lmax+1):
+        a_nm = mp.sqrt(mp.mpf((2*n+1)*(2*n-1)) / ((n-m)*(n+m)))
+        b_nm = mp.sqrt(mp.mpf((2*n+1)*(n+m-1)*(n-m-1)) / ((n-m)*(n+m)*(2*n-3)))
+        Column.append(a_nm*t*Column[-1] - b_nm*Column[-2])
+    return Column
+
+
+def Ref_ALF (lmax, t, Orders=None):
+    """ Returns the Ref_ALF_Column of the Orders (all of them if None), as a dictionary m: Column """
+    if Orders is None:
+        Orders = range(lmax+1)
+    return {m: Ref_ALF_Column(lmax, m, t) for m in Orders}
+
+
+def Ref_ALF_Deriv (Columns, l, m, lat):
+    """
+    Returns the derivative of P_lm with respect to the latitude, from the
+    reference Columns (orders m and m+1 needed):
+        dP_lm/dlat = k_m*sqrt((l-m)(l+m+1)) * P_l,m+1 - m*tan(lat) * P_lm
+    with k_0 = 1/sqrt(2) and k_m = 1 otherwise
+    """
+    dP = - m * mp.tan(lat) * Columns[m][l-m]
+    if l > m:
+        k_m = 1/mp.sqrt(2) if m == 0 else 1
+        dP += k_m * mp.sqrt((l-m)*(l+m+1)) * Columns[m+1][l-m-1]
+    return dP
+
+
+def Ref_Sums (lmax, Columns, HC, HS, long, lmin=2):
+    """
+    Returns, for each degree l, the sums over the orders
+        Sum_c[l] = sum of (C_lm cos(m long) + S_lm sin(m long)) * P_lm
+    in mpmath numbers, long in radians (mpmath)
+    """
+    Sum_c = [mp.mpf(0)] * (lmax+1)
+    for m in range(lmax+1):
+        cos_m, sin_m = mp.cos(m*long), mp.sin(m*long)
+        for l in range(max(m, lmin), lmax+1):
+            Sum_c[l] += (mp.mpf(HC[l, m])*cos_m + mp.mpf(HS[l, m])*sin_m) * Columns[m][l-m]
+    return Sum_c
+
+
+def Ref_Geoid_Height (phi, theta, lmax, HC, HS):
+    """
+    Returns the reference value of harm.Get_Geoid_Height(R_e, phi, theta, ...)
+    phi, theta: the colatitude and longitude+pi the kernels are given, in radians
+    The ellipsoid radius and normal gravity are those of GH_geoMath, they are
+    inputs of the kernel rather than part of it. The ellipsoid is removed
+    with Ref_Zonal_Correction, not with the code that is checked
+    """
+    c = gmath.Constants()
+    R_e = mp.mpf(gmath.Get_Ellipsoid_Radius(phi))
+    g_0 = mp.mpf(gmath.Get_Normal_Gravity(phi))
+    Corr = Ref_Zonal_Correction(lmax, mp.mp.dps)
+    HC_corr = np.array(HC[:lmax+1, :lmax+1], dtype=object)
+    for l in range(2, lmax+1, 2):
+        HC_corr[l, 0] = mp.mpf(HC[l, 0]) - Corr[l]
+    Columns = Ref_ALF(lmax, mp.cos(mp.mpf(phi)))
+    Sum_c = Ref_Sums(lmax, Columns, HC_corr, HS, mp.mpf(theta) - mp.pi)
+    Sum = mp.fsum((mp.mpf(c.a_g)/R_e)**l * Sum_c[l] for l in range(2, lmax+1))
+    return mp.mpf(c.GM_g) * Sum / (R_e*g_0)
+
+
+@lru_cache(maxsize=8)
+def Ref_Zonal_Correction (lmax, digits):
+    """
+    Returns the fully normalized zonal coefficients C_l0 of the normal field
+    of the WGS84 ellipsoid, for l = 0..lmax, in mpmath numbers at digits
+    precision. Computed from the closed form potential of the level
+    ellipsoid in ellipsoidal coordinates (u, beta):
+        V = GM/E atan(E/u) + w**2 a**2/2 q(u)/q(b) (sin(beta)**2 - 1/3)
+    projected on the Legendre polynomials along the sphere r = a, by
+    quadrature, so that it does not share the J_2n series of
+    harm.Get_Zonal_Correction. The degrees below the precision are 0
+    """
+    c = gmath.Constants()
+    with mp.workdps(digits):
+        a, GM, wo = mp.mpf(c.a_e), mp.mpf(c.GM_e), mp.mpf(c.wo)
+        b = a * (1 - mp.mpf(c.f))
+        E = mp.sqrt(a**2 - b**2)
+        q = lambda u: ((1 + 3*u**2/E**2)*mp.atan(E/u) - 3*u/E) / 2
+        q_b = q(b)
+
+        def V (x): # at r = a, x = sin(lat)
+            z2 = (a*x)**2
+            u = mp.sqrt((a**2 - E**2 + mp.sqrt((a**2 - E**2)**2 + 4*E**2*z2)) / 2)
+            return GM/E*mp.atan(E/u) + wo**2*a**2/2 * q(u)/q_b * (z2/u**2 - mp.mpf(1)/3)
+
+        Corr = [mp.mpf(0)] * (lmax+1)
+        for l in range(2, lmax+1, 2): # V is even in x, so are the P_l it has
+            Corr[l] = a/GM * mp.sqrt(2*l+1) * mp.quad(lambda x: V(x)*mp.legendre(l, x), [0, 1])
+            if abs(Corr[l]) < mp.mpf(10)**(-digits):
+                break
+    return Corr
+
+
+def Ref_acceleration3 (phi, theta, lmax, HC, HS):
+    """ Returns the reference value of harm.Get_acceleration3, see Ref_Geoid_Height """
+    c = gmath.Constants()
+    R_e = mp.mpf(gmath.Get_Ellipsoid_Radius(phi))
+    Columns = Ref_ALF(lmax, mp.cos(mp.mpf(phi)))
+    Sum_c = Ref_Sums(lmax, Columns, HC, HS, mp.mpf(theta) - mp.pi)
+    Sum = mp.fsum((mp.mpf(c.a_g)/R_e)**l * (l+1) * Sum_c[l] for l in range(2, lmax+1))
+    return mp.mpf(c.GM_g) / R_e**2 * Sum
+
+
+def Ref_PotGrad (Pos, lmax, HC, HS, R=6378.1363, GM=398600.4418):
+    """
+    Returns the reference value of the [a_r, a_theta, a_phi] accelerations
+    of GH_solve.Synth_PotGrad at one position Pos = (r, lat, long), km and
+    radians
+    """
+    r, lat, long = [mp.mpf(v) for v in Pos]
+    Columns = Ref_ALF(lmax, mp.sin(lat))
+    Acc = [mp.mpf(0)] * 3
+    for m in range(lmax+1):
+        cos_m, sin_m = mp.cos(m*long), mp.sin(m*long)
+        for l in range(max(m, 2), lmax+1):
+            W_l = mp.mpf(GM)/r**2 * (mp.mpf(R)/r)**l
+            C, S = mp.mpf(HC[l, m]), mp.mpf(HS[l, m])
+            P_lm = Columns[m][l-m]
+            Acc[0] += -(l+1) * W_l * P_lm * (C*cos_m + S*sin_m)
+            Acc[1] += W_l * Ref_ALF_Deriv(Columns, l, m, lat) * (C*cos_m + S*sin_m)
+            Acc[2] += m * W_l * P_lm / mp.cos(lat) * (-C*sin_m + S*cos_m)
+    return Acc
+
+
+
+# =============================================================================
+# FUNCTIONS FOR THE CHECKS
+# =============================================================================
+"""
+Each Check_ function returns the error of a kernel at the points Lat, Long
+for its lmax, and the function that is timed
+"""
+def Get_Orders (lmax):
+    """ returns the orders at which the ALFs are checked: low, middle and sectoral """
+    return sorted({0, 1, 2, lmax//4, lmax//2, (3*lmax)//4, lmax-1, lmax})
+
+
+def ALF_Error (lmax, Kernel):
+    """
+    Returns the largest absolute error of Kernel(x) (an array [l, m] of
+    ALFs at x = sin(lat)) over the points and the orders of Get_Orders
+    """
+    error = 0.
+    for lat in Lat:
+        x = sin(lat*pi/180)
+        Columns = Ref_ALF(lmax, mp.mpf(x), Get_Orders(lmax))
+        P = Kernel(x)
+        for m, Column in Columns.items():
+            Ref = np.array([float(v) for v in Column])
+            error = max(error, Max_Error(P[m:, m], Ref))
+    return error
+
+
+def Check_ALF_vec (lmax):
+    error = ALF_Error(lmax, lambda x: gmath.ALF_norm_vec(lmax, x)[0])
+    x = sin(Lat*pi/180)
+    return error, lambda: gmath.ALF_norm_vec(lmax, x)
+
+def Check_ALF_gcb (lmax):
+    error = ALF_Error(lmax, lambda x: gmath.ALF_norm_gcb(lmax, lmax, np.arcsin(x)))
+    return error, lambda: gmath.ALF_norm_gcb(lmax, lmax, Lat[0]*pi/180)
+
+def Check_lpmn_Normalize (lmax):
+    def Kernel (x):
+        P_lm, _ = gmath.Pol_Legendre(lmax, lmax, x)
+        l, m = np.tril_indices(lmax+1)
+        N = np.array([gmath.Normalize(int(l_i), int(m_i)) for l_i, m_i in zip(l, m)])
+        P = np.zeros((lmax+1, lmax+1))
+        P[l, m] = P_lm[m, l] * N * (-1.)**m # lpmn has the Condon-Shortley phase
+        return P
+    error = ALF_Error(lmax, Kernel)
+    return error, lambda: Kernel(sin(Lat[0]*pi/180))
+
+def Check_ALF_deriv (lmax):
+    error = 0.
+    for lat in Lat:
+        x = sin(lat*pi/180)
+        Orders = Get_Orders(lmax)
+        Columns = Ref_ALF(lmax, mp.mpf(x), sorted(set(Orders) | {m+1 for m in Orders if m < lmax}))
+        dP = gmath.ALF_norm_deriv(gmath.ALF_norm_vec(lmax, x))[0]
+        lat_mp = mp.asin(mp.mpf(x))
+        for m in Orders:
+            Ref = np.array([float(Ref_ALF_Deriv(Columns, l, m, lat_mp)) for l in range(m, lmax+1)])
+            error = max(error, Max_Error(dP[m:, m], Ref, relative=True)) # grows like l
+    P_lm = gmath.ALF_norm_vec(lmax, sin(Lat*pi/180))
+    return error, lambda: gmath.ALF_norm_deriv(P_lm)
+
+
+def Field_Points ():
+    """ returns the colatitudes phi and longitudes theta (+pi) of the points, as the kernels take them """
+    return pi/2 - Lat*pi/180, Long*pi/180 + pi
+
+def Check_Geoid_Point (lmax):
+    HC, HS = bench.Make_Coef(lmax)
+    Phi, Theta = Field_Points()
+    R_e = gmath.Get_Ellipsoid_Radius(Phi)
+    Values = np.array([harm.Get_Geoid_Height(R_e[i], Phi[i], Theta[i], lmax, HC, HS) for i in range(len(Phi))])
+    Ref = np.array([float(Ref_Geoid_Height(Phi[i], Theta[i], lmax, HC, HS)) for i in range(len(Phi))])
+    return Max_Error(Values, Ref, relative=True), lambda: harm.Get_Geoid_Height(R_e[0], Phi[0], Theta[0], lmax, HC, HS)
+
+def Check_Geoid_Evaluate (lmax):
+    HC, HS = bench.Make_Coef(lmax)
+    Model = gm.GravityModel("accuracy", lmax, HC, HS)
+    Phi, Theta = Field_Points()
+    Ref = np.array([float(Ref_Geoid_Height(Phi[i], Theta[i], lmax, HC, HS)) for i in range(len(Phi))])
+    Values = Model.Evaluate("geoid", Lat, Long)
+    return Max_Error(Values, Ref, relative=True), lambda: Model.Evaluate("geoid", Lat, Long)
+
+def Check_Geoid_Grid (lmax):
+    """ the FFT grid synthesis, checked at a few of its nodes """
+    HC, HS = bench.Make_Coef(lmax)
+    mins = 60
+    G_Grid, G_Long, G_Lat = harm.Gen_Grid(mins, harm.Get_Geoid_Height, [lmax, HC, HS], mode="fft", cache=False)
+    I = np.linspace(1, G_Grid.shape[0]-2, len(Lat)).astype(int)
+    J = np.linspace(0, G_Grid.shape[1]-1, len(Lat)).astype(int)
+    Phi, Theta = pi/2 - G_Lat[I, J]*pi/180, G_Long[I, J]*pi/180 + pi
+    Ref = np.array([float(Ref_Geoid_Height(Phi[i], Theta[i], lmax, HC, HS)) for i in range(len(Phi))])
+    return (Max_Error(G_Grid[I, J], Ref, relative=True),
+            lambda: harm.Gen_Grid(mins, harm.Get_Geoid_Height, [lmax, HC, HS], mode="fft", cache=False))
+
+def Check_acceleration3 (lmax):
+    HC, HS = bench.Make_Coef(lmax)
+    Phi, Theta = Field_Points()
+    R_e = gmath.Get_Ellipsoid_Radius(Phi)
+    Values = np.array([harm.Get_acceleration3(R_e[i], Phi[i], Theta[i], lmax, HC, HS) for i in range(len(Phi))])
+    Ref = np.array([float(Ref_acceleration3(Phi[i], Theta[i], lmax, HC, HS)) for i in range(len(Phi))])
+    return Max_Error(Values, Ref, relative=True), lambda: harm.Get_acceleration3(R_e[0], Phi[0], Theta[0], lmax, HC, HS)
+
+def Check_acceleration3_Evaluate (lmax):
+    HC, HS = bench.Make_Coef(lmax)
+    Model = gm.GravityModel("accuracy", lmax, HC, HS)
+    Phi, Theta = Field_Points()
+    Ref = np.array([float(Ref_acceleration3(Phi[i], Theta[i], lmax, HC, HS)) for i in range(len(Phi))])
+    Values = Model.Evaluate("acceleration", Lat, Long)
+    return Max_Error(Values, Ref, relative=True), lambda: Model.Evaluate("acceleration", Lat, Long)
+
+def Check_PotGrad (lmax):
+    HC, HS = bench.Make_Coef(lmax)
+    Pos = np.array([6778 + 0*Lat, Lat*pi/180, Long*pi/180]).T
+    Values = solv.Synth_PotGrad(lmax, Pos, HC, HS).reshape(-1, 3)
+    Ref = np.array([[float(v) for v in Ref_PotGrad(P, lmax, HC, HS)] for P in Pos])
+    return Max_Error(Values, Ref, relative=True), lambda: solv.Synth_PotGrad(lmax, Pos, HC, HS)
+
+
+Checks = {"alf_vec":            (Check_ALF_vec,                [100, 500, 2190]),
+          "alf_gcb":            (Check_ALF_gcb,                [100, 500]),
+          "alf_deriv":          (Check_ALF_deriv,              [100, 500, 2190]),
+          "lpmn_Normalize":     (Check_lpmn_Normalize,         [50, 85, 100, 200]),
+          "Get_Geoid_Height":   (Check_Geoid_Point,            [30, 85, 120]),
+          "geoid_evaluate":     (Check_Geoid_Evaluate,         [30, 120, 300]),
+          "geoid_grid_fft":     (Check_Geoid_Grid,             [30, 120]),
+          "Get_acceleration3":  (Check_acceleration3,          [30, 120]),
+          "acc_evaluate":       (Check_acceleration3_Evaluate, [30, 120, 300]),
+          "Synth_PotGrad":      (Check_PotGrad,                [30, 120])}
+
+Quick_Params = {"alf_vec": [100], "alf_gcb": [100], "alf_deriv": [100], "lpmn_Normalize": [50, 100],
+                "Get_Geoid_Height": [30], "geoid_evaluate": [30], "geoid_grid_fft": [30],
+                "Get_acceleration3": [30], "acc_evaluate": [30], "Synth_PotGrad": [30]}
+
+
+
+# =============================================================================
+# FUNCTIONS TO RUN THE CHECKS
+# =============================================================================
+def Max_Error (Values, Ref, relative=False):
+    """
+    Returns the largest absolute difference between Values and Ref, divided
+    by the largest |Ref| if relative. NaN or inf values give an inf error
+    """
+    Values, Ref = np.asarray(Values, dtype=float), np.asarray(Ref, dtype=float)
+    if not np.all(np.isfinite(Values)):
+        return np.inf
+    error = np.amax(np.abs(Values - Ref)) if Ref.size else 0.
+    if relative:
+        error /= max(np.amax(np.abs(Ref)), np.finfo(float).tiny)
+    return float(error)
+
+
+def Get_Status (kernel, lmax, error, tol=Tolerance):
+    """ returns "ok", "FAIL", or "limit" for a known failure, see Known_Limits """
+    if error <= tol:
+        return "ok"
+    if lmax > Known_Limits.get(kernel, np.inf):
+        return "limit"
+    return "FAIL"
+
+
+def Run_Checks (select=None, quick=False, tol=Tolerance, digits=dps):
+    """
+    Runs the Checks whose name starts with one of select (all if None)
+    Output:
+        Report: list of dictionaries kernel, lmax, error, time (s), status
+    """
+    Report = []
+    with mp.workdps(digits), warnings.catch_warnings():
+        warnings.simplefilter("ignore") # the overflows are what is checked here
+        for kernel, (Check_FUNCTION, Params) in Checks.items():
+            if select and not any(kernel.startswith(s) for s in select):
+                continue
+            if quick:
+                Params = Quick_Params.get(kernel, Params[:1])
+            for lmax in Params:
+                error, func = Check_FUNCTION(lmax)
+                timing = bench.Time_Call(func, repeat=3, min_time=0.05)
+                Report.append({"kernel": kernel, "lmax": lmax, "error": error,
+                               "time": timing["median"], "status": Get_Status(kernel, lmax, error, tol)})
+                print(Format_Line(Report[-1]))
+    return Report
+
+
+def Format_Line (Check):
+    """ Returns a check of the report as text """
+    return (f"{Check['kernel']:>18}\t{Check['lmax']:>5d}\t{Check['error']:>10.2e}\t"
+            f"{bench.Format_Time(Check['time'])}\t{Check['status']}")
+
+
+def Format_Report (Report):
+    """ Returns the report as text, one line per check """
+    lines = [f"{'kernel':>18}\t{'lmax':>5}\t{'max error':>10}\t{'time':>10}\tstatus"]
+    lines += [Format_Line(Check) for Check in Report]
+    return "\n".join(lines)
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+def Main (argv=None):
+    """ terminal interface, see the description at the top of this script """
+    parser = argparse.ArgumentParser(description="Accuracy of the fast kernels against mpmath references")
+    parser.add_argument("--select", nargs="+", default=None, help="checks whose name starts with these")
+    parser.add_argument("--quick", action="store_true", help="fewer and lower degrees")
+    parser.add_argument("--tol", type=float, default=Tolerance, help="largest error accepted")
+    parser.add_argument("--dps", type=int, default=dps, help="decimal digits of the references")
+    parser.add_argument("--out", default="", help="json file to write the report into")
+    args = parser.parse_args(argv)
+
+    Report = Run_Checks(args.select, args.quick, args.tol, args.dps)
+    print("\n" + Format_Report(Report))
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(Report, file, indent=1)
+
+    Failed = [f"{Check['kernel']}[{Check['lmax']}]" for Check in Report if Check["status"] == "FAIL"]
+    if Failed:
+        print(f"\n{len(Failed)} checks failed: {', '.join(Failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,374 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The purpose of this script is to time the hot paths of the tool, so that
+    a change to GH_harmonics, GH_geoMath or GH_solve can be shown to help or
+    hurt: Legendre functions, point and grid synthesis, design matrix, normal
+    equations, Savitzky-Golay differentiation and gridget extraction
+    All the data is synthetic and generated here, the suite runs offline
+    Each run is stored as a json file in Bench_Path, and can be compared with
+    a previous run:
+        python GH_benchmark.py --compare latest
+        python GH_benchmark.py --quick --select alf grid
+    Generally used variables:
+        Suite   = dictionary of the benchmarks, name: (Bench_FUNCTION, Params)
+        Results = dictionary of the timings, "name[param]": timing
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import numpy as np
+from numpy import pi
+import os
+import io
+import sys
+import json
+import glob
+import timeit
+import argparse
+import platform
+import subprocess
+import contextlib
+import functools
+from scipy.io import FortranFile
+
+import GH_import       as imp
+#import GH_convert      as conv
+import GH_generate     as gen
+import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+#import GH_terminal     as term
+import GH_harmonics    as harm
+import GH_geoMath      as gmath
+#import GH_earthMap     as emap
+import GH_Savitzky_Golay as sg
+import GH_gridget      as gg
+import GH_gravityModel as gm
+
+
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Bench_Path = "../Rendered/benchmarks"
+Slower = 1.2 # ratio of the median time to the reference flagged as a regression
+
+
+
+# =============================================================================
+# FUNCTIONS FOR SYNTHETIC DATA
+# =============================================================================
+def Make_Coef (lmax, seed=0):
+    """
+    Returns random HC, HS arrays following Kaula's rule, with the flattening
+    of the Earth in C20, close enough to a real model for timing purposes
+    """
+    rng = np.random.default_rng(seed)
+    l = np.arange(lmax+1)[:, None]
+    sigma = 1e-5 / np.maximum(l, 1)**2
+    HC = np.tril(rng.standard_normal((lmax+1, lmax+1)) * sigma)
+    HS = np.tril(rng.standard_normal((lmax+1, lmax+1)) * sigma)
+    HS[:, 0] = 0
+    HC[:2] = 0
+    HC[0, 0] = 1
+    if lmax >= 2:
+        HC[2, 0] = -4.84165e-4
+    return HC, HS
+
+
+def Make_Orbit (N_points, seed=0):
+    """ Returns N_points random positions (r in km, lat, long in radians) around 400 km """
+    rng = np.random.default_rng(seed)
+    r = 6778 + 10*rng.standard_normal(N_points)
+    theta = np.arcsin(rng.uniform(-1, 1, N_points))
+    phi = rng.uniform(-pi, pi, N_points)
+    return np.array([r, theta, phi]).T
+
+
+def Make_Ephemeris (N_points, dt=5.):
+    """ Returns the Time, Pos, Vit (km, km/s) of a circular polar orbit, carthesian """
+    Time = np.arange(N_points) * dt
+    w = 2*pi / 5550
+    r = 6778.
+    Pos = r * np.array([np.cos(w*Time), np.zeros(N_points), np.sin(w*Time)]).T
+    Vit = r*w * np.array([-np.sin(w*Time), np.zeros(N_points), np.cos(w*Time)]).T
+    return Time, Pos, Vit
+
+
+@contextlib.contextmanager
+def Gridget_File (folder, rows=121):
+    """
+    Writes the first rows (from the north pole) of a random undulation file,
+    in the format of the EGM2008 1 minute file, and sets up GH_gridget to
+    read it instead of the real one, and to write its output in folder too,
+    not in gg.path_out. 121 rows are enough for the 2 degrees around the pole
+    """
+    os.makedirs(folder, exist_ok=True)
+    file_name = f"{folder}/und_bench"
+    if not (os.path.isfile(file_name) and os.path.getsize(file_name) == rows*(4*gg.ncols + 8)):
+        rng = np.random.default_rng(0)
+        file = FortranFile(file_name, "w")
+        for i in range(rows):
+            file.write_record(rng.standard_normal(gg.ncols).astype(np.float32))
+        file.close()
+
+    Saved = gg.path_in, gg.n_in, gg.get_files
+    gg.path_in, gg.n_in = folder, "und_bench"
+    gg.get_files = functools.partial(Saved[2], path_out=folder)
+    try:
+        yield
+    finally:
+        gg.path_in, gg.n_in, gg.get_files = Saved
+
+
+
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+"""
+Each Bench_ function prepares its data for the parameter it is given, and
+returns the function that is timed
+"""
+def Bench_ALF_vec (lmax):
+    x = np.linspace(-0.99, 0.99, 200)
+    return lambda: gmath.ALF_norm_vec(lmax, x)
+
+def Bench_ALF_gcb (lmax):
+    return lambda: gmath.ALF_norm_gcb(lmax, lmax, 0.3)
+
+def Bench_Pol_Legendre (lmax):
+    return lambda: gmath.Pol_Legendre(lmax, lmax, 0.3)
+
+def Bench_Point (lmax):
+    HC, HS = Make_Coef(lmax)
+    R_e = gmath.Get_Ellipsoid_Radius(1.)
+    return lambda: harm.Get_Geoid_Height(R_e, 1., 2., lmax, HC, HS)
+
+def Bench_Evaluate (lmax):
+    HC, HS = Make_Coef(lmax)
+    Model = gm.GravityModel("bench", lmax, HC, HS)
+    Pos = Make_Orbit(10000)
+    Lat, Long = Pos[:,1]*180/pi, Pos[:,2]*180/pi
+    return lambda: Model.Evaluate("geoid", Lat, Long)
+
+def Bench_Grid_FFT (lmax):
+    HC, HS = Make_Coef(lmax)
+    mins = max(5, int(60*90/lmax)) # a couple of points per wavelength
+    return lambda: harm.Gen_Grid(mins, harm.Get_Geoid_Height, [lmax, HC, HS], mode="fft", cache=False)
+
+def Bench_Grid_Point (lmax):
+    HC, HS = Make_Coef(lmax)
+    limits = np.array([-10, 10, -10, 10])
+    return lambda: harm.Gen_Grid(120, harm.Get_Geoid_Height, [lmax, HC, HS], limits, mode="point", cache=False)
+
+def Bench_Grid_Analysis (lmax):
+    HC, HS = Make_Coef(lmax)
+    G_Grid, G_Long, G_Lat = harm.Gen_Grid_GL(lmax, harm.Get_Geo_Pot, [lmax, HC, HS, 0, None, None], cache=False)
+    return lambda: harm.Grid_Analysis(G_Grid, G_Long, G_Lat, lmax)
+
+def Bench_PotGradMatrix (lmax):
+    Pos = Make_Orbit(2000)
+    return lambda: solv.Get_PotGradMatrix(lmax, Pos)
+
+def Bench_PotGradMatrix2 (lmax):
+    Pos = Make_Orbit(100)
+    return lambda: solv.Get_PotGradMatrix2(lmax, Pos)
+
+def Bench_Normal (lmax):
+    Pos = Make_Orbit(5000)
+    HC, HS = Make_Coef(lmax)
+    Acc = solv.Synth_PotGrad(lmax, Pos, HC, HS).reshape(-1, 3)
+    return lambda: solv.Solve_Coef(lmax, Pos, Acc, method="cholesky")
+
+def Bench_Savitzky_Golay (N_points):
+    _, Pos, _ = Make_Ephemeris(N_points)
+    return lambda: sg.savitzky_golay(Pos[:,0], 20, 3, 1, 5.)
+
+def Bench_Stream_Acc (N_points):
+    Time, Pos, Vit = Make_Ephemeris(N_points)
+    Chunks = [(Time[i:i+10000], Pos[i:i+10000], Vit[i:i+10000]) for i in range(0, N_points, 10000)]
+    return lambda: [Chunk for Chunk in gen.Stream_Acc(Chunks)]
+
+def Bench_Gridget (mins):
+    return lambda: gg.gridget_xmin(-20, 20, 88, 90, mins, mins)
+
+
+Suite = {"alf_vec":         (Bench_ALF_vec,        [100, 500, 2000]),
+         "alf_gcb":         (Bench_ALF_gcb,        [50, 200]),
+         "pol_legendre":    (Bench_Pol_Legendre,   [50, 200]),
+         "point":           (Bench_Point,          [30, 100]),
+         "evaluate":        (Bench_Evaluate,       [100, 300]),
+         "grid_fft":        (Bench_Grid_FFT,       [100, 360]),
+         "grid_point":      (Bench_Grid_Point,     [30]),
+         "grid_analysis":   (Bench_Grid_Analysis,  [100, 360]),
+         "potgrad_matrix":  (Bench_PotGradMatrix,  [10, 30]),
+         "potgrad_matrix2": (Bench_PotGradMatrix2, [10]),
+         "normal":          (Bench_Normal,         [10, 30]),
+         "savitzky_golay":  (Bench_Savitzky_Golay, [100000]),
+         "stream_acc":      (Bench_Stream_Acc,     [100000]),
+         "gridget":         (Bench_Gridget,        [1, 5])}
+
+Quick_Params = {"alf_vec": [100], "alf_gcb": [50], "pol_legendre": [50], "point": [30],
+                "evaluate": [100], "grid_fft": [100], "grid_analysis": [100],
+                "potgrad_matrix": [10], "normal": [10], "gridget": [5]}
+
+
+
+# =============================================================================
+# FUNCTIONS TO RUN THE SUITE
+# =============================================================================
+def Time_Call (func, repeat=5, min_time=0.2):
+    """
+    Times func like timeit does: the number of calls per measure is raised
+    until a measure lasts min_time, then repeat measures are made
+    Whatever func prints is discarded
+    Output:
+        timing: dictionary of the min, median and max time per call (s), and
+                the number of calls per measure
+    """
+    Timer = timeit.Timer(func)
+    with contextlib.redirect_stdout(io.StringIO()):
+        number = 1
+        while True:
+            t = Timer.timeit(number)
+            if (t >= min_time) or (number >= 1e6):
+                break
+            number *= 2 if t <= 0 else max(2, int(np.ceil(min_time / t)))
+        Times = np.array([t] + Timer.repeat(repeat-1, number)) / number
+    return {"min": Times.min(), "median": float(np.median(Times)), "max": Times.max(), "number": number}
+
+
+def Run_Suite (select=None, quick=False, repeat=5, min_time=0.2, path=Bench_Path):
+    """
+    Runs the benchmarks of Suite whose name starts with one of select (all
+    of them if None), on fewer and smaller parameters if quick
+    Output:
+        Results: dictionary of the timings, "name[param]": timing, see Time_Call
+    """
+    Results = {}
+    with Gridget_File(f"{path}/data"):
+        for name, (Bench_FUNCTION, Params) in Suite.items():
+            if select and not any(name.startswith(s) for s in select):
+                continue
+            if quick:
+                if name not in Quick_Params:
+                    continue
+                Params = Quick_Params[name]
+            for param in Params:
+                key = f"{name}[{param}]"
+                with contextlib.redirect_stdout(io.StringIO()):
+                    func = Bench_FUNCTION(param)
+                Results[key] = Time_Call(func, repeat, min_time)
+                print(f"{key:>25}\t{Format_Time(Results[key]['median'])}")
+    return Results
+
+
+def Get_Machine ():
+    """ Returns what the timings depend on: versions, machine and commit """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {"date": imp.Get_Time(), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpus": os.cpu_count(), "system": platform.platform()}
+
+
+
+# =============================================================================
+# FUNCTIONS TO STORE AND COMPARE RESULTS
+# =============================================================================
+def Store_Results (Results, path=Bench_Path):
+    """ Stores the results of a run with the machine information, returns the file name """
+    os.makedirs(path, exist_ok=True)
+    Machine = Get_Machine()
+    file_name = f"{path}/{Machine['date']}_{Machine['commit'] or 'nocommit'}.json"
+    with open(file_name, "w") as file:
+        json.dump({"machine": Machine, "results": Results}, file, indent=1)
+    return file_name
+
+
+def Load_Results (file_name="latest", path=Bench_Path):
+    """ Returns the Machine, Results of a stored run, "latest" for the last one stored """
+    if file_name == "latest":
+        Files = sorted(glob.glob(f"{path}/*.json"))
+        if not Files:
+            raise Exception(f"No stored benchmark results in {path}")
+        file_name = Files[-1]
+    with open(file_name) as file:
+        Run = json.load(file)
+    return Run["machine"], Run["results"]
+
+
+def Compare_Results (Results, Ref, slower=Slower):
+    """
+    Returns the comparison of the median times of Results with those of the
+    reference run Ref, as text, and the names of the benchmarks that got
+    slower by more than the slower ratio
+    """
+    lines = [f"{'benchmark':>25}\t{'reference':>10}\t{'now':>10}\t{'ratio':>6}"]
+    Regressions = []
+    for key, timing in Results.items():
+        if key not in Ref:
+            lines.append(f"{key:>25}\t{'-':>10}\t{Format_Time(timing['median'])}")
+            continue
+        ratio = timing["median"] / Ref[key]["median"]
+        flag = ""
+        if ratio > slower:
+            flag = "  slower"
+            Regressions.append(key)
+        elif ratio < 1/slower:
+            flag = "  faster"
+        lines.append(f"{key:>25}\t{Format_Time(Ref[key]['median'])}\t{Format_Time(timing['median'])}\t{ratio:>6.2f}{flag}")
+    return "\n".join(lines), Regressions
+
+
+def Format_Time (t):
+    """ Returns a duration in s as text, in a readable unit """
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if t >= scale:
+            return f"{t/scale:>7.2f} {unit:<2}"
+    return f"{t/1e-9:>7.2f} ns"
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+def Main (argv=None):
+    """ terminal interface, see the description at the top of this script """
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths, on synthetic data")
+    parser.add_argument("--select", nargs="+", default=None, help="benchmarks whose name starts with these")
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller parameters")
+    parser.add_argument("--repeat", type=int, default=5, help="number of measures per benchmark")
+    parser.add_argument("--compare", default="", help="stored run to compare with, or \"latest\"")
+    parser.add_argument("--path", default=Bench_Path, help="folder of the stored runs")
+    parser.add_argument("--no-store", action="store_true", help="do not store this run")
+    args = parser.parse_args(argv)
+
+    Ref = None
+    if args.compare:
+        _, Ref = Load_Results(args.compare, args.path)
+
+    Results = Run_Suite(args.select, args.quick, args.repeat, path=args.path)
+    if not args.no_store:
+        print(f"\nStored in {Store_Results(Results, args.path)}")
+
+    if Ref is not None:
+        text, Regressions = Compare_Results(Results, Ref)
+        print("\n" + text)
+        if Regressions:
+            print(f"\n{len(Regressions)} benchmarks got slower: {', '.join(Regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -11,6 +11,8 @@
 # =============================================================================
 import numpy as np
 from numpy import pi, sin, cos
+from functools import lru_cache
+import time
 
 #import GH_import       as imp
 #import GH_convert      as conv
@@ -124,68 +126,185 @@ def Make_Array (line, col = 3):
     return arr
 
 
-def Make_Array_Coef (lmax, CS):
+@lru_cache(maxsize=32)
+def Get_Index_Coef (lmax, order="GH"):
+    """
+    Returns the (l, m) index maps of a line array of coefficients
+    The maps are computed once per (lmax, order) and cached, they are read-only
+    Input:
+        lmax: maximum degree of the line array
+        order: ordering of the coefficients in the line array
+            "GH": c20,c21,c22,c30, ... s21,s22,s31,s32,s33, ...
+                used by Make_Array_Coef, Make_Line_Coef and GH_solve
+            "full": c00,c10,c11,c20, ... s11,s21,s22,s31, ...
+                used by GH_solve.Get_PotGradMatrix2
+            "interleaved": c00,s00,c10,s10,c11,s11,c20,s20, ...
+                used by GH_solve_Discontinued
+    Output:
+        I_cos: positions of the cosine coefficients in the line array
+        L_cos, M_cos: degree and order of each of these cosine coefficients
+        I_sin, L_sin, M_sin: same, for the sine coefficients
+    """
+    if order == "GH":
+        L_cos, M_cos = Get_lm_Pairs(2, lmax, 0)
+        L_sin, M_sin = Get_lm_Pairs(2, lmax, 1)
+        I_cos = np.arange(L_cos.size)
+        I_sin = np.arange(L_sin.size) + L_cos.size
+    elif order == "full":
+        L_cos, M_cos = Get_lm_Pairs(0, lmax, 0)
+        L_sin, M_sin = Get_lm_Pairs(1, lmax, 1)
+        I_cos = np.arange(L_cos.size)
+        I_sin = np.arange(L_sin.size) + L_cos.size
+    elif order == "interleaved":
+        L_cos, M_cos = Get_lm_Pairs(0, lmax, 0)
+        L_sin, M_sin = L_cos, M_cos
+        I_cos = 2*np.arange(L_cos.size)
+        I_sin = I_cos + 1
+    else:
+        raise Exception(f"unknown coefficient order \"{order}\"")
+
+    maps = (I_cos, L_cos, M_cos, I_sin, L_sin, M_sin)
+    for arr in maps:
+        arr.setflags(write=False)
+    return maps
+
+
+@lru_cache(maxsize=32)
+def Get_Flat_Index (lmax, order="GH", ncol=0):
+    """
+    Returns the positions of the (l, m) index maps of Get_Index_Coef in a
+    flattened coefficient array of ncol columns (lmax+1 by default)
+    """
+    _, L_cos, M_cos, _, L_sin, M_sin = Get_Index_Coef(lmax, order)
+    if ncol <= 0: ncol = lmax+1
+    F_cos = L_cos*ncol + M_cos
+    F_sin = L_sin*ncol + M_sin
+    F_cos.setflags(write=False)
+    F_sin.setflags(write=False)
+    return F_cos, F_sin
+
+
+@lru_cache(maxsize=32)
+def Get_Row_Runs (lmax, order="GH"):
+    """
+    Returns the runs of consecutive orders of the index maps of
+    Get_Index_Coef, as tuples (k, l, m_0, n): the n coefficients from the
+    k-th cosine (or sine) one are H[l, m_0:m_0+n]. Copying a row at a time
+    needs no flat copy of H, which costs more than the copy itself when H is
+    a view (a truncated model for example)
+    Output:
+        Runs_cos, Runs_sin: tuples of the runs, of ints
+    """
+    _, L_cos, M_cos, _, L_sin, M_sin = Get_Index_Coef(lmax, order)
+    Runs = []
+    for L, M in [(L_cos, M_cos), (L_sin, M_sin)]:
+        K = np.flatnonzero(np.diff(L, prepend=-1) | (np.diff(M, prepend=-2) != 1))
+        N = np.diff(K, append=L.size)
+        Runs.append(tuple(zip(K.tolist(), L[K].tolist(), M[K].tolist(), N.tolist())))
+    return tuple(Runs)
+
+
+def Get_lm_Pairs (lmin, lmax, mmin):
+    """ returns the l and m of all pairs lmin<=l<=lmax, mmin<=m<=l, l major """
+    Ls = np.arange(lmin, lmax+1)
+    count = np.clip(Ls - mmin + 1, 0, None)
+    L = np.repeat(Ls, count)
+    starts = np.cumsum(count) - count
+    M = np.arange(L.size) - np.repeat(starts, count) + mmin
+    return L, M
+
+
+def As_Slice (I):
+    """ Returns the evenly spaced positions I as a slice, for views on CS """
+    if I.size < 2:
+        return slice(int(I[0]), int(I[0])+1) if I.size else slice(0, 0)
+    return slice(int(I[0]), int(I[-1])+1, int(I[1]-I[0]))
+
+
+def Get_Len_Coef (lmax, order="GH"):
+    """ Returns the length of the line array of coefficients up to lmax """
+    I_cos, _, _, I_sin, _, _ = Get_Index_Coef(lmax, order)
+    return I_cos.size + I_sin.size
+
+
+def Make_Array_Coef (lmax, CS, order="GH", out=None):
     """
     Returns the arrays of the solved Cosine and Sine coefficients
     Input:
         CS: line array filled in coefficients in such manner :
-        CS = [c00,c10,c11,c20,c21,c22, ... s11,s21,s22,s31,s32,s33 ... ]
+        CS = [c20,c21,c22,c30, ... s21,s22,s31,s32,s33 ... ]
             There are no sine coeffs for degree m=0
             There are no coeffs for order l=0, l=1
+        order: ordering of CS, see Get_Index_Coef
+        out: (HC, HS) arrays to fill instead of new ones, for repeated calls.
+             Only the coefficients of CS are written, the others are kept
     Output:
         HC_coef: solved spherical harmonic cosine coefficients
         HS_coef: solved spherical harmonic sine coefficients
             To fetch use: HS_coef(l,m) = {SIN_lm_coef}
     """
-#    Cos_len = int( (lmax+1)*(lmax+2) /2 ) # c00,c10,c11,c20,c21,c22, ...
-#    Sin_len = int( (lmax  )*(lmax+1) /2 ) # s11,s21,s22,s31,s32,s33, ...
-
-    HC_coef = np.zeros( (lmax+1,lmax+1) )
-    HS_coef = np.zeros( (lmax+1,lmax+1) )
-
-    j = 0
-    for l in range (2, lmax+1):
-        for m in range (0, l+1):
-            HC_coef[l, m] = CS[j] # Get the Cosine coefs out first
-            j += 1
-    # Normally, at this point, j == Cos_len
-    for l in range (2, lmax+1):
-        for m in range (1, l+1):
-            HS_coef[l, m] = CS[j] # Get the Sine coefs out next
-            j += 1
+    I_cos, _, _, I_sin, _, _ = Get_Index_Coef(lmax, order)
+    CS = np.asarray(CS).ravel()
+
+    if out is None:
+        out = np.zeros( (lmax+1,lmax+1) ), np.zeros( (lmax+1,lmax+1) )
+    HC_coef, HS_coef = out
+    # Get the Cosine coefs out first, the Sine coefs next, one row at a time
+    for H, C, Runs in zip([HC_coef, HS_coef], [CS[As_Slice(I_cos)], CS[As_Slice(I_sin)]],
+                          Get_Row_Runs(lmax, order)):
+        for k, l, m_0, n in Runs:
+            H[l, m_0:m_0+n] = C[k:k+n]
 
     return HC_coef, HS_coef
 
 
-def Make_Line_Coef (lmax, HC, HS):
+def Make_Line_Coef (lmax, HC, HS, order="GH", out=None):
     """
     Returns the line array filled of Cosine and Sine coefficients
     Input:
         HC: spherical harmonic cosine coefficients
         HS: spherical harmonic sine coefficients
+        order: ordering of CS, see Get_Index_Coef
+        out: line array to fill instead of a new one, for repeated calls
     Output:
         CS: line array filled in coefficients
     """
-    Cos_len = int( (lmax+1)*(lmax+2) /2 ) -3 # c20,c21,c22, ...
-    Sin_len = int( (lmax  )*(lmax+1) /2 ) -1 # s21,s22,s31,s32,s33, ...
+    I_cos, _, _, I_sin, _, _ = Get_Index_Coef(lmax, order)
 
-    N_coef = Cos_len + Sin_len
-    CS = np.zeros(N_coef)
-
-    j=0
-    for l in range (2, lmax +1):
-        for m in range (0, l +1):
-            CS[j] = HC[l, m] # Write in the Cosine coefs
-            j += 1
-    # Normally, at this point, j == Cos_len
-    for l in range (2, lmax +1):
-        for m in range (1, l +1):
-            CS[j] = HS[l, m] # Write in the Sine coefs
-            j += 1
+    CS = np.empty(I_cos.size + I_sin.size) if out is None else out
+    # Write in the Cosine coefs, then the Sine coefs, one row at a time
+    for H, C, Runs in zip([HC, HS], [CS[As_Slice(I_cos)], CS[As_Slice(I_sin)]],
+                          Get_Row_Runs(lmax, order)):
+        for k, l, m_0, n in Runs:
+            C[k:k+n] = H[l, m_0:m_0+n]
 
     return CS
 
 
+def Convert_Line_Coef (lmax, CS, order_in, order_out):
+    """
+    Returns the line array CS, written in order_in, rewritten in order_out
+    Coefficients that do not exist in order_in are set to zero, coefficients
+    that do not exist in order_out are dropped
+    """
+    I_in_c, L_in_c, M_in_c, I_in_s, L_in_s, M_in_s = Get_Index_Coef(lmax, order_in)
+    I_out_c, L_out_c, M_out_c, I_out_s, L_out_s, M_out_s = Get_Index_Coef(lmax, order_out)
+    CS = np.asarray(CS).ravel()
+
+    # position of each (l,m) in order_in, -1 where it does not exist
+    Pos_c = np.full((lmax+1, lmax+1), -1)
+    Pos_s = np.full((lmax+1, lmax+1), -1)
+    Pos_c[L_in_c, M_in_c] = I_in_c
+    Pos_s[L_in_s, M_in_s] = I_in_s
+
+    CS_out = np.zeros(I_out_c.size + I_out_s.size)
+    for I_out, Pos in [(I_out_c, Pos_c[L_out_c, M_out_c]),
+                       (I_out_s, Pos_s[L_out_s, M_out_s])]:
+        ok = Pos >= 0
+        CS_out[I_out[ok]] = CS[Pos[ok]]
+    return CS_out
+
+
 
 # =============================================================================
 # TEST FUNCTIONS
@@ -225,6 +344,28 @@ def TEST_Line_Array ():
     return CS2
 
 
+def TEST_Index_Coef (lmax=2190):
+    """ Times the packing of the coefficients, and checks the conversions """
+    HC = np.tril(np.random.rand(lmax+1, lmax+1))
+    HS = np.tril(np.random.rand(lmax+1, lmax+1)); HS[:, 0] = 0
+    HC[:2] = 0; HS[:2] = 0
+
+    t0 = time.perf_counter()
+    CS = Make_Line_Coef(lmax, HC, HS)
+    t1 = time.perf_counter()
+    HC2, HS2 = Make_Array_Coef(lmax, CS)
+    t2 = time.perf_counter()
+    print(f"lmax={lmax}; {CS.size} coefs; line: {(t1-t0)*1e3:.1f} ms; array: {(t2-t1)*1e3:.1f} ms")
+    print("round trip ok:", np.array_equal(HC, HC2) and np.array_equal(HS, HS2))
+
+    for order in ["full", "interleaved"]:
+        CS_o = Convert_Line_Coef(lmax, CS, "GH", order)
+        HC3, HS3 = Make_Array_Coef(lmax, CS_o, order)
+        CS_back = Convert_Line_Coef(lmax, CS_o, order, "GH")
+        print(f"{order}: {CS_o.size} coefs; ok:",
+              np.array_equal(HC, HC3) and np.array_equal(HS, HS3) and np.array_equal(CS, CS_back))
+
+
 # =============================================================================
 # MAIN
 # =============================================================================
@@ -181,6 +181,31 @@ def Map_Geoid_grid(detail="grid geoid l100", title="Geoid undulation High resolu
 
 
 
+def Map_Mosaic(title, levels=40, path="../Rendered/tiles", fine=True):
+    """
+    Makes a Matplotlib figure with the map of a mosaic of harm.Gen_Grid_Tiled,
+    each tile at its own resolution, with common color levels
+    """
+    Tiles = imp.Load_Mosaic(title, path, fine)
+    v_min = min(np.amin(G_Grid) for G_Grid, _, _ in Tiles)
+    v_max = max(np.amax(G_Grid) for G_Grid, _, _ in Tiles)
+    Levels = np.linspace(v_min, v_max, levels)
+    limits = [min(np.amin(G_Long) for _, G_Long, _ in Tiles), max(np.amax(G_Long) for _, G_Long, _ in Tiles),
+              min(np.amin(G_Lat)  for _, _, G_Lat  in Tiles), max(np.amax(G_Lat)  for _, _, G_Lat  in Tiles)]
+
+    FIG, AX = emap.Make_Map(limits=np.array(limits))
+    for G_Grid, G_Long, G_Lat in Tiles:
+        data = emap.Plot_contourf(G_Grid, G_Long, G_Lat, AX, Levels, colorbar=False)
+    CBAR = plt.colorbar(mappable=data, ax=AX, orientation='horizontal', pad=0.10)
+
+    plt.figure(FIG.number)
+    plt.suptitle(title)
+    plot_specs = f"{sum(G_Grid.size for G_Grid, _, _ in Tiles)} points; {len(Tiles)} tiles; {levels} color levels"
+    plt.title(plot_specs, fontsize=10)
+    return FIG, CBAR
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
@@ -4,6 +4,9 @@
  Information:
     The purpose of this script is to display various graphs and maps about
     Satellite trajectories
+    Long tracks (days of 1 s positions) are converted in bulk, and reduced to
+    the resolution of the figure before being drawn: only the points that
+    move to another cell of a few pixels are kept, see Decimate_Track
 topo: implement earth rotation. precession ?
 # =============================================================================
 """
@@ -13,6 +16,7 @@ topo: implement earth rotation. precession ?
 import cartopy.crs as ccrs
 from mpl_toolkits.mplot3d import axes3d
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
 import numpy as np
 from numpy import cos, sin, pi
@@ -31,16 +35,23 @@ import GH_convert      as conv
 import GH_earthMap     as emap
 
 
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Track_Pixels = 4 # size in pixels of the cells of Decimate_Track. Tracks are smooth:
+                 # their chords over a few pixels stay well within a pixel of the curve
+
+
 # =============================================================================
 # DISPLAY FUNCTIONS
 # =============================================================================
-def Plot2D_PosEarthfixed (Pos, Title="No given title"):
+def Plot2D_PosEarthfixed (Pos, Title="No given title", dpi=None):
     """
     This function plots spherical coordinates on a basemp plot in a mpl figure
     Input:
-        fignum: index of the matplotlib figure to be created
         Pos: Coordinates in spherical reherantial, radian degrees
         Title: Title of the plot to appear on the figure
+        dpi: resolution the figure will be stored at, see Plot_Track
     Output:
         FIG: matplotlib figure object created in this function
         (MAP: basemap plot created in this function)
@@ -51,7 +62,7 @@ def Plot2D_PosEarthfixed (Pos, Title="No given title"):
     Long = Pos[:,2] * 180/pi
 
     FIG, AX = emap.Make_Map()
-    AX.plot(Long, Lat, '.', markersize=0.5, transform=ccrs.PlateCarree())
+    Plot_Track(AX, Long, Lat, dpi)
 #    AX.scatter(Long, Lat, s=0.1, c='r', latlon=True, alpha=1)
     plt.suptitle("Position projected on Earth")
     plt.title(Title)
@@ -60,30 +71,25 @@ def Plot2D_PosEarthfixed (Pos, Title="No given title"):
     return FIG
 
 
-def Plot3D_Pos (fignum, Pos, Title):
+def Plot3D_Pos (fignum, Pos, Title, dpi=None):
     """
     This functions creates a matplotlib figure and plots Pos in 3D.
     Input:
         Pos: array in spherical coordinates of the satellite position
         Title: The title to be displayed on the plot
+        dpi: resolution the figure will be stored at, None for the screen
     Output:
         FIG: matplotlib figure object created in this function
     """
-    X_1 = []
-    Y_1 = []
-    Z_1 = []
-    zero = [] #for the center of the Referential
-    zero.append(0)
-
-    for i in range (0, len(Pos)):
-        r, theta, phi = Pos[i]
-        xi, yi, zi = conv.sph2cart(r, theta, phi)
-        X_1.append(xi)
-        Y_1.append(yi)
-        Z_1.append(zi)
+    zero = [0] #for the center of the Referential
+    Points = np.column_stack(conv.sph2cart(Pos[:,0], Pos[:,1], Pos[:,2]))
 
     FIG = plt.figure(fignum)
     plt.clf()
+    if dpi is None:
+        dpi = FIG.dpi
+    cell = Track_Pixels * np.ptp(Points, axis=0).max() / (FIG.get_size_inches()[0]*dpi)
+    X_1, Y_1, Z_1 = Points[Decimate_Track(Points, cell)].T
 
     ax1 = FIG.add_subplot(111, projection = '3d')
 
@@ -180,6 +186,82 @@ def Plot_pos_spe_acc(Pos, Spe, Acc, Time):
     return FIG
 
 
+# =============================================================================
+# TRACK FUNCTIONS
+# =============================================================================
+def Plot_Track (AX, Long, Lat, dpi=None, color="C0", linewidth=0.5):
+    """
+    Draws a ground track on a cartopy map as a single LineCollection, reduced
+    to cells of Track_Pixels pixels of the map (see Decimate_Track) and cut
+    at the dateline (see Split_Dateline)
+    Input:
+        AX: cartopy axes of the map, see emap.Make_Map
+        Long, Lat: coordinates of the track in degrees, in time order
+        dpi: resolution the figure will be stored at (see
+             GH_export.Store_Figure), None for the resolution of the screen
+    Output:
+        LINES: the LineCollection added to AX
+    """
+    dx, dy = Get_Pixel_Size(AX, dpi)
+    I = Decimate_Track(np.column_stack((Long, Lat)), Track_Pixels*np.array([dx, dy]))
+    LINES = LineCollection(Split_Dateline(Long[I], Lat[I]), colors=color,
+                           linewidths=linewidth, transform=ccrs.PlateCarree())
+    AX.add_collection(LINES)
+    return LINES
+
+
+def Get_Pixel_Size (AX, dpi=None):
+    """ Returns the size of a pixel of the map AX in degrees of longitude and latitude """
+    if dpi is None:
+        dpi = AX.figure.dpi
+    AX.apply_aspect()
+    Box = AX.get_position()
+    width, height = AX.figure.get_size_inches()
+    x_0, x_1, y_0, y_1 = AX.get_extent(crs=ccrs.PlateCarree())
+    return (x_1 - x_0) / (Box.width*width*dpi), (y_1 - y_0) / (Box.height*height*dpi)
+
+
+def Decimate_Track (Points, cell):
+    """
+    Returns the indices of the points of a track to draw at a resolution of
+    cell: each point that enters another cell than the previous point is
+    kept, and the last point. Points of the track inside the same cell would
+    be drawn on the same pixel
+    Input:
+        Points: array of shape (N, dims), in time order
+        cell: size of the cells, one value or one per dimension
+    Output:
+        I: indices of the points kept, in time order
+    """
+    if len(Points) < 3:
+        return np.arange(len(Points))
+    Cells = np.floor((Points - Points.min(axis=0)) / cell).astype(np.int64)
+    Keep = np.ones(len(Points), dtype=bool)
+    Keep[1:-1] = np.any(Cells[1:-1] != Cells[:-2], axis=1)
+    return np.flatnonzero(Keep)
+
+
+def Split_Dateline (Long, Lat):
+    """
+    Returns the track as a list of lines (arrays of Long, Lat of shape (n, 2))
+    that do not cross the dateline: the track is cut where the longitude
+    jumps by more than 180 degrees, and both sides are extended to the
+    dateline, at the latitude interpolated across it
+    """
+    I = np.flatnonzero(np.abs(np.diff(Long)) > 180) # the track goes from I to I+1
+    if I.size == 0:
+        return [np.column_stack((Long, Lat))]
+    edge = 180 * np.sign(Long[I])
+    Long_1 = Long[I+1] + 2*edge # on the same side as Long[I]
+    frac = (edge - Long[I]) / (Long_1 - Long[I])
+    Lat_edge = Lat[I] + frac*(Lat[I+1] - Lat[I])
+
+    Long = np.insert(Long, np.repeat(I+1, 2), np.column_stack((edge, -edge)).ravel())
+    Lat = np.insert(Lat, np.repeat(I+1, 2), np.repeat(Lat_edge, 2))
+    return np.split(np.column_stack((Long, Lat)), I + 2 + 2*np.arange(I.size))
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
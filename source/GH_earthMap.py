@@ -50,7 +50,8 @@ def Make_Map_Fig (proj, fignum, ax_pos, shape, limits):
     FIG = plt.figure(*fignum, figsize=shape)
     AX = FIG.add_subplot(ax_pos, projection=proj(central_longitude=0))
     AX.set_extent(limits, crs=ccrs.PlateCarree())
-    plt.show(block=False)
+    if FIG.canvas.required_interactive_framework: # no window with Agg (headless)
+        plt.show(block=False)
     return FIG, AX
 
 
@@ -74,10 +75,11 @@ def Make_Map_3D (fignum=[], ax_pos=111, shape=(7,5) ):
 # =============================================================================
 # PLOT FUNCTIONS
 # =============================================================================
-def Plot_contourf(G_Grid, G_Long, G_Lat, AX=0, levels=75, proj=ccrs.PlateCarree, map_color="jet"):
+def Plot_contourf(G_Grid, G_Long, G_Lat, AX=0, levels=75, proj=ccrs.PlateCarree, map_color="jet", colorbar=True):
     """
     Display of G_Grid, with coordinates G_Long and G_Lat
     map_colors = ["jet", "terrain", "gist_earth"]
+    Without colorbar, returns the contour set instead of the colorbar
     """
     if (AX==0): AX = plt.gca()
     alpha = 1
@@ -85,6 +87,8 @@ def Plot_contourf(G_Grid, G_Long, G_Lat, AX=0, levels=75, proj=ccrs.PlateCarree,
     data = AX.contourf(G_Long, G_Lat, G_Grid,
                        levels = levels, alpha = alpha,
                        transform = proj(), cmap=plt.get_cmap(map_color))
+    if not colorbar:
+        return data
     CBAR = plt.colorbar(mappable=data, ax=AX, cmap=plt.get_cmap(map_color),
                         orientation='horizontal', pad=0.10)
     return CBAR
@@ -12,6 +12,8 @@ todo:
 # LIBRARIES
 # =============================================================================
 import numpy as np
+import os
+import json
 #from numpy import pi, sin, cos
 import matplotlib.pyplot as plt
 #from time import gmtime, strftime
@@ -71,24 +73,45 @@ def Store_temp_GLl(G_Grid, G_Long, G_Lat, detail=""):
 
 
 
+def Store_Normal(state, title, path="../Rendered/coefficients"):
+    """
+    Stores a solver state (see GH_solve.Init_Normal) into a .npz file
+    The file is written next to its destination and then moved, so that an
+    interrupted write never corrupts a previous state
+    To import use:
+        state = imp.Load_Normal(title, path)
+    """
+    file_name = f"{path}/{title}.npz"
+    temp_name = f"{path}/{title}.tmp.npz"
+    np.savez(temp_name, lmax=state["lmax"], N=state["N"], b=state["b"],
+             yty=state["yty"], n_obs=state["n_obs"],
+             arcs=json.dumps(state["arcs"]), meta=json.dumps(state["meta"]))
+    os.replace(temp_name, file_name)
+
+
+
 # =============================================================================
 # FUNCTIONS FOR FIGURES
 # =============================================================================
-def Store_Figure(fignum, title, time="", path="../Rendered/images", dpi=500):
+def Store_Figure(fignum, title, time="", path="../Rendered/images", dpi=500, close=False):
     """
     Stores a figure into a .png format
     Input:
-        fignum: matplotlib figure number
+        fignum: matplotlib figure number, or the figure itself
         title: title image name.
         path: image path location
         dpi: pixels per inch density
+        close: closes the figure once stored, for figures made in a loop
+    To render many maps without a screen, see GH_render.Render_Maps
     """
-    plt.figure(fignum)
+    FIG = fignum if isinstance(fignum, plt.Figure) else plt.figure(fignum)
 #    mng = plt.get_current_fig_manager()
 #    mng.window.showMaximized()
 #    plt.show()
     file_name = f"{path}/{time} {title}.png"
-    plt.savefig(file_name, dpi=dpi)
+    FIG.savefig(file_name, dpi=dpi)
+    if close:
+        plt.close(FIG)
 
 # =============================================================================
 # TEST FUNCTIONS
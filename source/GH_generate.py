@@ -12,20 +12,23 @@
 import numpy as np
 from numpy import pi, sin, cos
 import matplotlib.pyplot as plt
+import time
 
 import GH_import       as imp
 import GH_convert      as conv
 import GH_Savitzky_Golay as sg
+from numpy.lib.stride_tricks import sliding_window_view
 #import GH_generate     as gen
 import GH_solve        as solv
 #import GH_displayGeoid as dgeo
 import GH_displaySat   as dsat
 #import GH_export       as exp
 #import GH_displayTopo  as dtopo
-#import GH_terminal     as term
+import GH_terminal     as term
 #import GH_harmonics    as harm
 #import GH_geoMath      as gmath
 #import GH_earthMap     as emap
+import GH_instrument   as inst
 
 
 # =============================================================================
@@ -33,6 +36,7 @@ import GH_displaySat   as dsat
 # =============================================================================
 
 
+@inst.Staged("accelerations")
 def Gen_Sim_Acc (lmax, HC, HS, Pos):
     """
     Generates simulated acceleration values from known coefficients
@@ -63,6 +67,7 @@ def Gen_Sim_Acc (lmax, HC, HS, Pos):
 
 
 
+@inst.Staged("accelerations")
 def Gen_Acc_2(Pos,Vit,t):
     x,y,z = Pos.T
     ax = sg.savitzky_golay(x,20,3,1,t[1]-t[0])
@@ -89,6 +94,7 @@ def Gen_Acc_2(Pos,Vit,t):
 
 
 
+@inst.Staged("accelerations")
 def Gen_Acc (Pos, t):
 
 
@@ -126,6 +132,152 @@ def Gen_Acc (Pos, t):
     return Acc, Spe
 
 
+# =============================================================================
+# FUNCTIONS FOR STREAMED ACCELERATIONS
+# =============================================================================
+def Stream_Acc (Stream, window_size=20, order=3, deriv=1):
+    """
+    Differentiates a stream of positions with the Savitzky-Golay filter of
+    Gen_Acc_2, chunk by chunk. The last window_size-1 positions of a chunk
+    are kept to finish the windows of the next one, so the result is the
+    same as filtering the whole arc at once, for a fixed memory. The first
+    chunks are merged until they are longer than half a window
+    Input:
+        Stream: yields Time, Pos, Vit in carthesian coordinates, see
+                GH_import.Stream_Pos_Vit
+        window_size, order, deriv: see GH_Savitzky_Golay.savitzky_golay
+    Output:
+        yields Time, Pos, Vit, Acc in carthesian coordinates
+    """
+    half_window = (window_size -1) // 2
+    Y = None # padded positions, the windows of the pending points
+    Pending = None # Time, Pos, Vit of the points not yielded yet
+    Head = None # Time, Pos, Vit of the first chunks, too short to pad the start of the arc
+    for Time, Pos, Vit in Stream:
+        if Y is None:
+            if Head is not None:
+                Time, Pos, Vit = [np.concatenate((P, P_new)) for P, P_new in zip(Head, [Time, Pos, Vit])]
+            if len(Pos) <= half_window:
+                Head = [Time, Pos, Vit]
+                continue
+            m = sg.savitzky_golay_coef(window_size, order, deriv, Time[1]-Time[0])
+            Y = np.concatenate((sg.savitzky_golay_pad(Pos, half_window, 0), Pos))
+            Pending = [Time, Pos, Vit]
+        else:
+            Y = np.concatenate((Y, Pos))
+            Pending = [np.concatenate((P, P_new)) for P, P_new in zip(Pending, [Time, Pos, Vit])]
+
+        n_out = len(Y) - 2*half_window
+        if n_out > 0:
+            Acc = sliding_window_view(Y, 2*half_window+1, axis=0) @ m
+            yield Pending[0][:n_out], Pending[1][:n_out], Pending[2][:n_out], Acc
+            Pending = [P[n_out:] for P in Pending]
+            Y = Y[n_out:]
+
+    if Y is None:
+        if Head is not None:
+            raise Exception(f"The arc ({len(Head[1])} points) is shorter than the filter window")
+        return
+    # the end of the arc, padded like savitzky_golay does
+    Y = np.concatenate((Y, sg.savitzky_golay_pad(Y[-half_window-1:], half_window, -1)))
+    Acc = sliding_window_view(Y, 2*half_window+1, axis=0) @ m
+    yield Pending[0], Pending[1], Pending[2], Acc
+
+
+def Stream_Correc (Stream, omega=7292115E-11):
+    """ Corrects a stream of Stream_Acc for the rotating frame, see GH_Savitzky_Golay.correcRef """
+    for Time, Pos, Vit, Acc in Stream:
+        yield Time, Pos, Vit, sg.correcRef(Pos, Vit, Acc, omega)
+
+
+def Stream_Sph (Stream):
+    """
+    Converts a stream of Stream_Acc to the inputs of the solver: the positions
+    in spherical coordinates (r, theta, phi) of GH_convert.cart2sph, and the
+    accelerations in the local (a_r, a_theta, a_phi) frame of these
+    coordinates, theta being the latitude
+    Output:
+        yields Time, Pos, Acc
+    """
+    for Time, Pos, Vit, Acc in Stream:
+        r, theta, phi = conv.cart2sph(Pos[:,0], Pos[:,1], Pos[:,2])
+        U_r = Pos / r[:, None]
+        U_theta = np.array([-sin(theta)*cos(phi), -sin(theta)*sin(phi), cos(theta)]).T
+        U_phi = np.array([-sin(phi), cos(phi), np.zeros(len(phi))]).T
+        Acc_sph = np.array([(Acc*U_r).sum(1), (Acc*U_theta).sum(1), (Acc*U_phi).sum(1)]).T
+        yield Time, np.array([r, theta, phi]).T, Acc_sph
+
+
+def Count_Stage (Stream, name, Counters):
+    """
+    Passes the chunks of Stream through, counting them in Counters[name]:
+    chunks, points, and the time spent producing them (with the stages
+    before it, see Format_Counters)
+    """
+    Count = Counters.setdefault(name, {"chunks": 0, "points": 0, "time": 0.})
+    def Counted (Stream):
+        while True:
+            t_0 = time.perf_counter()
+            try:
+                Chunk = next(Stream)
+            except StopIteration:
+                Count["time"] += time.perf_counter() - t_0
+                return
+            Count["time"] += time.perf_counter() - t_0
+            Count["chunks"] += 1
+            Count["points"] += len(Chunk[0])
+            yield Chunk
+    return Counted(iter(Stream))
+
+
+def Format_Counters (Counters):
+    """ Returns the throughput of each stage, in the order they were chained, as text """
+    lines = [f"{'stage':>15}\t{'chunks':>8}\t{'points':>10}\t{'time (s)':>10}\t{'points/s':>10}"]
+    t_before = 0.
+    for name, Count in Counters.items():
+        t_stage = max(Count["time"] - t_before, 0.)
+        t_before = Count["time"]
+        rate = Count["points"] / t_stage if t_stage > 0 else np.inf
+        lines.append(f"{name:>15}\t{Count['chunks']:>8d}\t{Count['points']:>10d}\t{t_stage:>10.3f}\t{rate:>10.0f}")
+    return "\n".join(lines)
+
+
+@inst.Staged("stream")
+def Stream_Normal (file_name, lmax, days=0.7, data_path="../data", chunk=10000,
+                   window_size=20, order=3, deriv=1, W=None, state=None, prefetch=2):
+    """
+    Accumulates the normal equations of an ephemeris file without ever
+    holding the whole arc: the chunks flow from the file through the
+    differentiation, the frame correction, the conversion to spherical
+    coordinates and the solver
+    Input:
+        file_name, days, data_path, chunk: see GH_import.Stream_Pos_Vit
+        lmax: maximum degree of the coefficients
+        window_size, order, deriv: see Stream_Acc
+        W: weight of the accelerations, None or one per component (3 values)
+        state: solver state to add the arc to, see GH_solve.Init_Normal
+        prefetch: number of chunks read ahead in the background, see
+                  GH_import.Prefetch
+    Output:
+        state: the solver state, solve it with GH_solve.Solve_State
+        Counters: throughput of each stage, print with Format_Counters
+    """
+    if state is None:
+        state = solv.Init_Normal(lmax, {"file": file_name, "days": days})
+    Counters = {}
+    Stream = imp.Prefetch(imp.Stream_Pos_Vit(file_name, days, data_path, chunk), prefetch)
+    Stream = Count_Stage(Stream, "read", Counters)
+    Stream = Count_Stage(Stream_Acc(Stream, window_size, order, deriv), "differentiate", Counters)
+    Stream = Count_Stage(Stream_Correc(Stream), "correct", Counters)
+    Stream = Count_Stage(Stream_Sph(Stream), "convert", Counters)
+    Stream = Count_Stage(solv.Stream_Update_Normal(state, Stream, W, file_name), "accumulate", Counters)
+    with term.Progress(0, "stream", "chunks") as P:
+        for _ in Stream:
+            P.update()
+    return state, Counters
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
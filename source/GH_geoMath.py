@@ -16,6 +16,7 @@ from scipy.special import lpmn
 import math
 import matplotlib.pyplot as plt
 from time import gmtime, strftime
+from functools import lru_cache
 
 #import GH_import       as imp
 import GH_convert      as conv
@@ -36,6 +37,9 @@ from GH_convert import cart2sphA
 # =============================================================================
 # GLOBAL VARIABLES
 # =============================================================================
+ALF_scale = 1e-280 # scaling of the sectoral ALFs, see ALF_norm_vec
+
+
 class Constants:
     """
     A variable with all the constants inside it
@@ -177,6 +181,103 @@ def ALF_norm_gcb (N, M, phi):
     return POL
 
 
+@lru_cache(maxsize=8)
+def ALF_recursion_coef (lmax):
+    """
+    Returns the a_nm, b_nm coefficients of the standard forward column method
+    (see ALF_norm_gcb) for all degrees up to lmax, and the scaled sectorals
+    The arrays are cached per lmax, and read-only
+    """
+    n = np.arange(lmax+1, dtype=float)[:, None]
+    m = np.arange(lmax+1, dtype=float)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a_nm = np.sqrt( (2*n+1)*(2*n-1) / ((n-m)*(n+m)) )
+        b_nm = np.sqrt( (2*n+1)*(n+m-1)*(n-m-1) / ((n-m)*(n+m)*(2*n-3)) )
+    a_nm[~np.isfinite(a_nm)] = 0
+    b_nm[~np.isfinite(b_nm)] = 0
+
+    # sectorals divided by u**m, scaled down to avoid the overflow of the
+    # recursion at high degree (Holmes & Featherstone, 2002)
+    ratio = np.ones(lmax+1)
+    ratio[1] = np.sqrt(3)
+    k = np.arange(2, lmax+1)
+    ratio[2:] = np.sqrt((2*k+1)/(2*k))
+    Q_mm = ALF_scale * np.cumprod(ratio)
+
+    for arr in (a_nm, b_nm, Q_mm):
+        arr.setflags(write=False)
+    return a_nm, b_nm, Q_mm
+
+
+def ALF_norm_vec (lmax, x, div_u=False):
+    """
+    returns an array[N, l+1, m+1] of the values of the fully normalized
+    Associated Legendre Functions (geodesy convention, no Condon-Shortley phase)
+    of all degrees l and orders m up to lmax, at each of the N points x
+    This is ALF_norm_gcb vectorized over the points and the orders, with the
+    scaling of Holmes & Featherstone so that it holds up to degree 2190
+    Input:
+        lmax: maximum degree
+        x: array of N values of sin(latitude) = cos(colatitude)
+        div_u: also return the functions divided by u = cos(latitude)
+    Output:
+        P_lm: array[N, l, m], use P_lm[i, l, m]
+        P_lm_u: P_lm / u, only if div_u. Finite at the poles for m>0
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    a_nm, b_nm, Q_mm = ALF_recursion_coef(lmax)
+    t = x[:, None]
+    u = np.sqrt(np.clip(1 - x**2, 0, None))
+
+    # column recursion on Q_lm = P_lm / u**m, all orders at once
+    Q = np.zeros((x.size, lmax+1, lmax+1))
+    Q[:, np.arange(lmax+1), np.arange(lmax+1)] = Q_mm
+    if lmax >= 1:
+        Q[:, 1:, :-1][:, np.arange(lmax), np.arange(lmax)] = np.sqrt(2*np.arange(lmax)+3) * t * Q_mm[:-1]
+    for n in range(2, lmax+1):
+        Q[:, n, :n-1] = a_nm[n, :n-1]*t*Q[:, n-1, :n-1] - b_nm[n, :n-1]*Q[:, n-2, :n-1]
+
+    # multiply back by u**m, and unscale. log(u)=-inf at the poles gives 0
+    m = np.arange(lmax+1)
+    with np.errstate(divide="ignore"):
+        log_u = np.log(u)[:, None]
+    with np.errstate(invalid="ignore"):
+        fac = np.exp(m*log_u - np.log(ALF_scale))
+    fac[:, 0] = 1/ALF_scale
+    P_lm = Q * fac[:, None, :]
+    if not div_u:
+        return P_lm
+
+    with np.errstate(invalid="ignore"):
+        fac_u = np.exp((m-1)*log_u - np.log(ALF_scale))
+    fac_u[:, 1] = 1/ALF_scale
+    fac_u[:, 0] = 0
+    P_lm_u = Q * fac_u[:, None, :]
+    return P_lm, P_lm_u
+
+
+def ALF_norm_deriv (P_lm):
+    """
+    Returns the derivatives with respect to the latitude of the fully
+    normalized ALFs P_lm[N, l, m] returned by ALF_norm_vec
+    The relation only uses the neighbouring orders, it is valid at the poles
+    """
+    lmax = P_lm.shape[1] - 1
+    l = np.arange(lmax+1, dtype=float)[:, None]
+    m = np.arange(lmax+1, dtype=float)[None, :]
+
+    # dP_lm/dcolat = ( c_m*sqrt((l+m)(l-m+1)) P_l,m-1 - sqrt((l-m)(l+m+1)) P_l,m+1 )/2
+    k_dn = np.sqrt(np.clip((l+m)*(l-m+1), 0, None)) / 2
+    k_dn[:, 1] *= np.sqrt(2)
+    k_up = np.sqrt(np.clip((l-m)*(l+m+1), 0, None)) / 2
+    k_up[:, 0] *= 2 / np.sqrt(2)
+
+    dP_lm = np.zeros(P_lm.shape)
+    dP_lm[:, :, 1:] = k_dn[:, 1:] * P_lm[:, :, :-1]
+    dP_lm[:, :, :-1] -= k_up[:, :-1] * P_lm[:, :, 1:]
+    return -dP_lm # d/dlat = -d/dcolat
+
+
 def Pol_Legendre (l, m, x):
     """
     returns an array[m+1,n+1] of the values of the associated Legendre function
@@ -186,6 +287,7 @@ def Pol_Legendre (l, m, x):
     return Plm_z, Plm_dz # use Plm_z[m, l]
 
 
+@lru_cache(maxsize=None)
 def Normalize (l, m):
     """
     Returns the normalization coefficient of degree l and order m
@@ -200,6 +302,7 @@ def Normalize (l, m):
     return N
 
 
+@lru_cache(maxsize=None)
 def Normalize1 (l, m):
     """
     Returns the normalization coefficient of degree l and order m
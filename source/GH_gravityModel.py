@@ -0,0 +1,199 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The GravityModel class bundles a set of spherical harmonic coefficients
+    with its constants, and caches what is derived from them, so that maps,
+    point evaluations and accelerations can be asked for again and again
+    without loading, truncating or correcting anything twice
+    Generally used variables:
+        model  = name of the coefficients in GH_import.Coef_Files
+        lmax   = maximum degree used from the model
+        HC, HS = Geopotential stokes coefficients
+        Lat, Long = geographic coordinates in degrees
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import numpy as np
+from numpy import pi, sin, cos
+from functools import cached_property
+
+import GH_import       as imp
+import GH_convert      as conv
+#import GH_generate     as gen
+import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+#import GH_terminal     as term
+import GH_harmonics    as harm
+import GH_geoMath      as gmath
+#import GH_earthMap     as emap
+import GH_spectral     as spec
+
+
+
+# =============================================================================
+# CLASS
+# =============================================================================
+class GravityModel:
+    """
+    A gravity (or topography) model, with lazy coefficients and cached tables
+    Input:
+        model: name of the coefficients in GH_import.Coef_Files, loaded from
+               the registry the first time they are needed
+        lmax: maximum degree used, 0 for the whole model
+        HC, HS: coefficient arrays to use instead of a registry model
+    Use:
+        EGM = GravityModel("full", 300)
+        G_Grid, G_Long, G_Lat = EGM.Grid(mins=30)
+        Geo_H = EGM.Evaluate("geoid", Lat, Long)
+    """
+    Functions = {"geoid":         harm.Get_Geoid_Height,
+                 "potential":     harm.Get_Geo_Pot,
+                 "acceleration":  harm.Get_acceleration3,
+                 "topography":    harm.Get_Topo_Height}
+
+    def __init__ (self, model="subset", lmax=0, HC=None, HS=None):
+        c = gmath.Constants()
+        self.model = model
+        self.GM = c.GM_g # m^3/s^2
+        self.a = c.a_g   # m
+        self.Truncations = {}
+        self._lmax = lmax
+        if HC is not None:
+            self.__dict__["Coef"] = (HC, HS)
+
+    def __repr__ (self):
+        return f"GravityModel(\"{self.model}\", lmax={self._lmax or '?'})"
+
+    @cached_property
+    def Coef (self):
+        """ (HC, HS) truncated to lmax, loaded on first use """
+        return imp.Get_Coef(self.model, self._lmax)
+
+    @property
+    def HC (self):
+        return self.Coef[0]
+
+    @property
+    def HS (self):
+        return self.Coef[1]
+
+    @property
+    def lmax (self):
+        if self._lmax <= 0:
+            self._lmax = len(self.HC) - 1
+        return self._lmax
+
+    def Truncate (self, lmax):
+        """ Returns the same model up to degree lmax, sharing the arrays """
+        if lmax not in self.Truncations:
+            HC, HS = self.HC[:lmax+1, :lmax+1], self.HS[:lmax+1, :lmax+1]
+            self.Truncations[lmax] = GravityModel(self.model, lmax, HC, HS)
+        return self.Truncations[lmax]
+
+    @cached_property
+    def HC_corr (self):
+        """ copy of HC without the reference ellipsoid, see harm.Remove_Ellipsoid """
+        return harm.Remove_Ellipsoid(self.lmax, self.HC)
+
+    @cached_property
+    def Line_Coef (self):
+        """ the coefficients as a line array, see conv.Make_Line_Coef """
+        return conv.Make_Line_Coef(self.lmax, self.HC, self.HS)
+
+    @cached_property
+    def Degree_Variance (self):
+        """ degree variances of the model, see GH_spectral """
+        return spec.Degree_Variance(self.lmax, self.Line_Coef)
+
+    def Get_Args (self, Get_FUNCTION):
+        """
+        returns the in_args of a GH_harmonics Get_FUNCTION for this model, the
+        geoid with the cached HC_corr, so it is not corrected again
+        """
+        if Get_FUNCTION is harm.Get_Geo_Pot:
+            return [self.lmax, self.HC, self.HS, 0, None, None]
+        if Get_FUNCTION is harm.Get_Geoid_Height:
+            return [self.lmax, self.HC_corr, self.HS, True]
+        return [self.lmax, self.HC, self.HS]
+
+    def Get_Function (self, function):
+        """ returns the Get_FUNCTION of a name of Functions, or function itself """
+        return self.Functions.get(function, function)
+
+    def Grid (self, mins, function="geoid", limits=np.array([-180, 180, -90, 90]), mode="auto", n_jobs=1, cache=False):
+        """ Returns G_Grid, G_Long, G_Lat of the function, see harm.Gen_Grid """
+        Get_FUNCTION = self.Get_Function(function)
+        return harm.Gen_Grid(mins, Get_FUNCTION, self.Get_Args(Get_FUNCTION), limits, mode, n_jobs, cache)
+
+    def Evaluate (self, function, Lat, Long, chunk=0):
+        """
+        Returns the function at scattered points on the ellipsoid, in one
+        vectorized pass: the row synthesis of the function (see
+        harm.Row_Synthesis) gives the order-wise sums at each point, which are
+        then summed over the orders at the longitude of the point
+        Input:
+            function: a name of Functions, or a GH_harmonics Get_FUNCTION
+            Lat, Long: coordinates in degrees, arrays of the same shape
+        Output:
+            Values: array of the shape of Lat
+        """
+        Get_FUNCTION = self.Get_Function(function)
+        Lat, Long = np.broadcast_arrays(np.asarray(Lat, dtype=float), np.asarray(Long, dtype=float))
+        Phi = pi/2 - Lat.ravel()*pi/180
+        Long = Long.ravel()*pi/180
+        R_e = gmath.Get_Ellipsoid_Radius(Phi)
+
+        Terms = harm.Row_Synthesis[Get_FUNCTION](R_e, Phi, *self.Get_Args(Get_FUNCTION))
+        if chunk <= 0:
+            chunk = max(1, int(2e7 // (self.lmax+1)**2))
+
+        m = np.arange(self.lmax+1)
+        Values = np.zeros(len(Phi))
+        for j in range(0, len(Phi), chunk):
+            A_m, B_m = harm.Row_Sums(Phi[j:j+chunk], Terms, slice(j, j+chunk))
+            m_Long = np.outer(Long[j:j+chunk], m)
+            Values[j:j+chunk] = (A_m*cos(m_Long) + B_m*sin(m_Long)).sum(axis=1)
+        return Values.reshape(Lat.shape)
+
+    def Acceleration (self, Pos, chunk=0):
+        """
+        Returns the accelerations [a_r, a_theta, a_phi] at the Pos positions
+        (r in km, lat, long, see conv.cart2sphA), see solv.Synth_PotGrad
+        """
+        Acc_line = solv.Synth_PotGrad(self.lmax, Pos, self.HC, self.HS,
+                                      R=self.a/1e3, GM=self.GM/1e9, chunk=chunk)
+        return conv.Make_Array(Acc_line, 3)
+
+
+
+# =============================================================================
+# TEST FUNCTIONS
+# =============================================================================
+def TEST_GravityModel ():
+    """ compares the model evaluation with the point by point sum """
+    EGM = GravityModel("subset", 20)
+    Lat = np.array([-60., 0., 10., 45.])
+    Long = np.array([-170., 0., 20., 100.])
+    Geo_H = EGM.Evaluate("geoid", Lat, Long)
+    for i in range(len(Lat)):
+        phi = pi/2 - Lat[i]*pi/180
+        R_e = gmath.Get_Ellipsoid_Radius(phi)
+        Geo_H_ref = harm.Get_Geoid_Height(R_e, phi, Long[i]*pi/180 + pi, EGM.lmax, EGM.HC, EGM.HS)
+        print(f"Lat {Lat[i]}, Long {Long[i]}: {Geo_H[i]:.6f} m vs {Geo_H_ref:.6f} m")
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+if __name__ == '__main__':
+
+    TEST_GravityModel()
+
+    print("\nGH_gravityModel done")
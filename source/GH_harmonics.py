@@ -30,11 +30,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 from numpy import pi, sin, cos
 from time import sleep
+import os
+import sys
+import json
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import GH_import       as imp
 import GH_convert      as conv
 #import GH_generate     as gen
-#import GH_solve        as solv
+import GH_solve        as solv
 #import GH_displayGeoid as dgeo
 #import GH_displaySat   as dsat
 #import GH_export       as exp
@@ -43,6 +49,18 @@ import GH_terminal     as term
 #import GH_harmonics    as harm
 import GH_geoMath      as gmath
 import GH_earthMap     as emap
+import GH_instrument   as inst
+
+
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Grid_Cache_Path = "../Rendered/cache" # grids memoized by Gen_Grid, see Fill_Grid
+Grid_Cache_Size = 2e9 # bytes, the least recently used grids are removed above
+Grid_Cache_Version = 1 # part of every cache key: bump it when the synthesis kernels change
+
+Tiles_Path = "../Rendered/tiles" # mosaics of Gen_Grid_Tiled
 
 
 
@@ -75,7 +93,8 @@ def init_grid (mins=0, limits=np.array([-180, 180, -90, 90])):
     return G_Grid, G_theta, G_phi
 
 
-def Gen_Grid (mins, Get_FUNCTION, in_args, limits=np.array([-180, 180, -90, 90])):
+@inst.Staged("grid")
+def Gen_Grid (mins, Get_FUNCTION, in_args, limits=np.array([-180, 180, -90, 90]), mode="auto", n_jobs=1, cache=False):
     """
     This function generates a grid of the desired spherical harmonic model
     at Lat/Long coordinates
@@ -84,27 +103,584 @@ def Gen_Grid (mins, Get_FUNCTION, in_args, limits=np.array([-180, 180, -90, 90])
         Get_FUNCTION: the callable function that must be used
         *in_args: the arguments to the callable function besides R, phi, theta
         limits: the geographical limits to the Long/lat map
+        mode: "point" calls Get_FUNCTION at each point, "fft" sums each
+              latitude row with an inverse FFT (see Fill_Grid_FFT), "auto"
+              uses "fft" whenever Get_FUNCTION has a row synthesis
+        n_jobs: number of processes sharing the rows in "fft" mode,
+                0 for all the cores, see Fill_Grid_Parallel
+        cache: look for the same grid in the disk cache first, and store it
+               there otherwise, see Fill_Grid
     Output:
         G_Grid: grid of Get_FUNCTION(R,phi,theta,*in_args)
         G_Long: grid of longitudes, [mins] step, within bounraries [limits]
         G_Lat:  same for latitudes
     """
     G_Grid, G_theta, G_phi = init_grid(mins, limits)
+    return Fill_Grid(G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, mode, n_jobs, cache)
+
+
+def init_grid_GL (lmax):
+    """
+    Initiates the grid variables of a global Gauss-Legendre grid, exact for
+    the analysis of a field up to degree lmax, see Grid_Analysis
+    lmax+1 latitudes at the Gauss-Legendre nodes, 2*lmax+2 longitudes
+    """
+    x, _ = np.polynomial.legendre.leggauss(lmax+1)
+    Line_phi   = np.arcsin(x)
+    Line_theta = -pi + 2*pi * np.arange(2*lmax+2) / (2*lmax+2)
+
+    G_theta, G_phi = np.meshgrid(Line_theta, Line_phi)
+    G_Grid = np.zeros(G_theta.shape)
+
+    return G_Grid, G_theta, G_phi
+
+
+@inst.Staged("grid")
+def Gen_Grid_GL (lmax_grid, Get_FUNCTION, in_args, mode="auto", n_jobs=1, cache=False):
+    """
+    Same as Gen_Grid, on the Gauss-Legendre grid of init_grid_GL(lmax_grid)
+    """
+    G_Grid, G_theta, G_phi = init_grid_GL(lmax_grid)
+    return Fill_Grid(G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, mode, n_jobs, cache)
+
+
+def Fill_Grid (G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, mode="point", n_jobs=1, cache=False):
+    """
+    Fills G_Grid with Get_FUNCTION at the G_theta/G_phi meshgrid (radians),
+    see Gen_Grid for the modes
+    With cache, the grid is first looked for in the disk cache, under a key
+    made of the function, the content of in_args, the mode and the grid
+    coordinates, see Get_Grid_Key.
+    Cached grids are memory-mapped copy-on-write, so they load instantly
+    """
+    if cache:
+        key = Get_Grid_Key(G_theta, G_phi, Get_FUNCTION, in_args, mode)
+        G_cached = Load_Cached_Grid(key, G_Grid.shape)
+        if G_cached is not None:
+            print(f"Loading the \"{Get_FUNCTION.__name__}()\" grid from the cache ({key})")
+            return G_cached, G_theta*180/pi, G_phi*180/pi # in degrees, L
+        G_Grid, G_Long, G_Lat = Fill_Grid(G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, mode, n_jobs)
+        Store_Cached_Grid(key, G_Grid)
+        return G_Grid, G_Long, G_Lat
+
+    inst.Count("points", G_Grid.size)
+    if mode != "point":
+        n_fft = Get_FFT_Size(G_theta[0])
+        if (Get_FUNCTION in Row_Synthesis) and (n_fft > 0):
+            return Fill_Grid_FFT(G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, n_jobs=n_jobs)
+        if mode == "fft":
+            raise Exception(f"No FFT synthesis of \"{Get_FUNCTION.__name__}()\" on this grid")
+
     print(f"Making a grid with \"{Get_FUNCTION.__name__}()\", with {G_Grid.size} points\n",end="\r")
+    if Get_FUNCTION in Point_Setup:
+        in_args = Point_Setup[Get_FUNCTION](*in_args)
 
-    it=0
-    for j in range(0, G_phi.shape[0]):
-        phi = pi/2 - G_phi[j][0]
-        R_e = gmath.Get_Ellipsoid_Radius(phi)
+    with term.Progress(G_Grid.size, "grid", "points") as P:
+        for j in range(0, G_phi.shape[0]):
+            phi = pi/2 - G_phi[j][0]
+            R_e = gmath.Get_Ellipsoid_Radius(phi)
 
-        for i in range(0, G_theta.shape[1]):
-            term.printProgressBar(it+1, G_phi.size); it+=1 # print(f"\rLong =  {theta*pi/180-180} ;Lat {90-phi*pi/180}",end="\r")
-            theta = G_theta[0][i]+ pi
-            G_Grid[j,i] = Get_FUNCTION(R_e, phi, theta, *in_args)
+            for i in range(0, G_theta.shape[1]):
+                theta = G_theta[0][i]+ pi
+                G_Grid[j,i] = Get_FUNCTION(R_e, phi, theta, *in_args)
+            P.update(G_theta.shape[1])
 
     return G_Grid, G_theta*180/pi, G_phi*180/pi # in degrees, L
 
 
+@inst.Staged("fft synthesis")
+def Fill_Grid_FFT (G_Grid, G_theta, G_phi, Get_FUNCTION, in_args, chunk=0, n_jobs=1):
+    """
+    Fills G_Grid like Fill_Grid, one latitude row at a time: the sums over
+    the degrees give the order-wise cosine/sine coefficients of the row (see
+    Row_Sums), and a real inverse FFT gives all the longitudes at once
+    Rows symmetric about the equator are paired (see Get_Row_Pairs) and
+    share their ALFs and degree sums, which halves the cost of global grids
+    The grid must have a regular longitude step dividing 360 degrees
+    Input:
+        chunk: number of rows per ALF evaluation, 0 for automatic
+        n_jobs: number of processes, see Fill_Grid_Parallel
+    """
+    Line_long = G_theta[0]
+    n_fft = Get_FFT_Size(Line_long)
+    I_col = np.arange(len(Line_long)) % n_fft
+    Row_Terms = Row_Synthesis[Get_FUNCTION]
+
+    Phi = pi/2 - G_phi[:, 0]
+    R_e = gmath.Get_Ellipsoid_Radius(Phi)
+    Terms = Row_Terms(R_e, Phi, *in_args)
+    lmax = Terms[0]
+    if chunk <= 0:
+        chunk = max(1, int(2e7 // (lmax+1)**2))
+    J_n, J_s = Get_Row_Pairs(Phi, Terms[3])
+    print(f"Making a grid with \"{Get_FUNCTION.__name__}()\", with {G_Grid.size} points, {len(J_n)} FFT rows\n",end="\r")
+
+    if n_jobs != 1:
+        Fill_Grid_Parallel(G_Grid, Phi, Terms, J_n, J_s, Line_long[0], n_fft, I_col, chunk, n_jobs)
+        return G_Grid, G_theta*180/pi, G_phi*180/pi # in degrees, L
+
+    with term.Progress(len(Phi), "grid", "rows") as P:
+        for k in range(0, len(J_n), chunk):
+            P.update(Fill_Rows(G_Grid, Phi, Terms, J_n[k:k+chunk], J_s[k:k+chunk], Line_long[0], n_fft, I_col))
+
+    return G_Grid, G_theta*180/pi, G_phi*180/pi # in degrees, L
+
+
+def Fill_Rows (G_Grid, Phi, Terms, J_n, J_s, long_0, n_fft, I_col):
+    """
+    Fills the rows J_n of G_Grid and their mirror rows J_s (-1 for none),
+    see Fill_Grid_FFT. Returns the number of rows filled
+    """
+    A_n, B_n, A_s, B_s = Row_Sums(Phi[J_n], Terms, J_n, J_s)
+    G_Grid[J_n] = Row_FFT(A_n, B_n, long_0, n_fft)[:, I_col]
+    Paired = J_s >= 0
+    if Paired.any():
+        G_Grid[J_s[Paired]] = Row_FFT(A_s[Paired], B_s[Paired], long_0, n_fft)[:, I_col]
+    return len(J_n) + Paired.sum()
+
+
+def Get_Row_Pairs (Phi, W_l):
+    """
+    Pairs the rows of colatitudes Phi that are symmetric about the equator,
+    with the same degree weights W_l[row, l] (see FUNCTIONS FOR ROW SYNTHESIS)
+    Output:
+        J_n: the rows to compute, northern ones first
+        J_s: the mirror row of each row of J_n, -1 if it has none
+    """
+    x = cos(Phi)
+    J_all = np.arange(len(x))
+    if len(x) < 2:
+        return J_all, -np.ones(len(x), dtype=int)
+    Order = np.argsort(x)
+    x_sorted = x[Order]
+
+    K = np.clip(np.searchsorted(x_sorted, -x), 1, len(x)-1)
+    K = np.where(abs(x_sorted[K-1] + x) < abs(x_sorted[K] + x), K-1, K)
+    Mirror = Order[K]
+    Paired = (x > 1e-12) & np.isclose(x[Mirror], -x, rtol=0, atol=1e-12)
+    Paired[Paired] &= np.all(np.isclose(W_l[Paired], W_l[Mirror[Paired]], rtol=1e-12, atol=0), axis=1)
+
+    Taken = np.zeros(len(x), dtype=bool)
+    Taken[Mirror[Paired]] = True
+    J_n = np.concatenate([J_all[Paired], J_all[~Paired & ~Taken]])
+    J_s = np.concatenate([Mirror[Paired], -np.ones((~Paired & ~Taken).sum(), dtype=int)])
+    return J_n, J_s
+
+
+def Fill_Grid_Parallel (G_Grid, Phi, Terms, J_n, J_s, long_0, n_fft, I_col, chunk, n_jobs=0):
+    """
+    Fills G_Grid with the FFT rows of Fill_Grid_FFT, shared between n_jobs
+    processes (0 for all the cores) by bands of chunk rows (or row pairs)
+    The coefficients, the row weights and the output grid are put in shared
+    memory (see GH_import.Share_Array): the workers attach them instead of
+    receiving a pickled copy, and write their rows straight into the grid
+    """
+    if n_jobs <= 0:
+        n_jobs = os.cpu_count()
+    lmax, HC, HS, W_l, Scale, Offset = Terms
+    Arrays = {"HC": HC[:lmax+1, :lmax+1], "HS": HS[:lmax+1, :lmax+1],
+              "W_l": W_l, "Scale": Scale, "Offset": Offset, "Phi": Phi,
+              "Grid": np.zeros(G_Grid.shape)}
+
+    Shared = {}
+    try:
+        for key, A in Arrays.items():
+            Shared[key] = imp.Share_Array(A)
+        Specs = {key: spec for key, (_, spec) in Shared.items()}
+
+        Bands = [(k, min(k+chunk, len(J_n))) for k in range(0, len(J_n), chunk)]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=Init_Row_Worker,
+                                 initargs=(Specs, lmax, J_n, J_s, long_0, n_fft, I_col)) as Pool:
+            Jobs = [Pool.submit(Row_Band, j_0, j_1) for j_0, j_1 in Bands]
+            with term.Progress(len(Phi), "grid", "rows") as P:
+                for job in as_completed(Jobs):
+                    P.update(job.result())
+
+        shm_grid, _ = Shared["Grid"]
+        G_Grid[:] = np.ndarray(G_Grid.shape, buffer=shm_grid.buf)
+    finally:
+        for shm, _ in Shared.values():
+            shm.close()
+            shm.unlink()
+    return G_Grid
+
+
+Row_Worker = {} # state of the worker processes of Fill_Grid_Parallel
+
+def Init_Row_Worker (Specs, lmax, J_n, J_s, long_0, n_fft, I_col):
+    """ attaches the shared arrays in a worker of Fill_Grid_Parallel """
+    Row_Worker.clear()
+    Row_Worker["shm"] = []
+    for key, spec in Specs.items():
+        shm, A = imp.Attach_Array(spec)
+        Row_Worker["shm"].append(shm)
+        Row_Worker[key] = A
+    Row_Worker.update(lmax=lmax, J_n=J_n, J_s=J_s, long_0=long_0, n_fft=n_fft, I_col=I_col)
+
+
+def Row_Band (k_0, k_1):
+    """ computes the rows J_n[k_0:k_1] in a worker of Fill_Grid_Parallel """
+    W = Row_Worker
+    Terms = (W["lmax"], W["HC"], W["HS"], W["W_l"], W["Scale"], W["Offset"])
+    return Fill_Rows(W["Grid"], W["Phi"], Terms, W["J_n"][k_0:k_1], W["J_s"][k_0:k_1],
+                     W["long_0"], W["n_fft"], W["I_col"])
+
+
+def Get_FFT_Size (Line_long):
+    """
+    Returns the number of regular longitudes around the world that contains
+    Line_long (radians), or 0 if Line_long is not regular with a step
+    dividing 2*pi
+    """
+    if len(Line_long) < 2:
+        return 0
+    step = Line_long[1] - Line_long[0]
+    n_fft = int(round(2*pi / step))
+    if (n_fft < 1) or not np.isclose(n_fft*step, 2*pi):
+        return 0
+    if not np.allclose(np.diff(Line_long), step):
+        return 0
+    return n_fft
+
+
+def Row_FFT (A_m, B_m, long_0, n_fft):
+    """
+    Returns the values of the series of each row
+        sum_m A_m[j, m]*cos(m*Long) + B_m[j, m]*sin(m*Long)
+    at the n_fft regular longitudes Long = long_0 + 2*pi*k/n_fft
+    Orders above n_fft/2 are folded back onto the orders they alias to, and
+    the missing orders up to n_fft/2 are zero padded, so any lmax works with
+    any grid step
+    """
+    lmax = A_m.shape[1] - 1
+    m = np.arange(lmax+1)
+    Z_m = (A_m - 1j*B_m) * np.exp(1j*m*long_0)
+
+    m_fold = m % n_fft
+    Flip = m_fold > n_fft//2
+    Z_m[:, Flip] = np.conj(Z_m[:, Flip])
+    m_fold[Flip] = n_fft - m_fold[Flip]
+
+    X_m = np.zeros((A_m.shape[0], n_fft//2 + 1), dtype=complex)
+    np.add.at(X_m, (slice(None), m_fold), Z_m)
+    X_m[:, 1:] /= 2
+    if n_fft % 2 == 0:
+        X_m[:, -1] *= 2
+    return np.fft.irfft(X_m * n_fft, n_fft, axis=1)
+
+
+
+
+
+# =============================================================================
+# FUNCTIONS FOR TILED GRIDS
+# =============================================================================
+@inst.Staged("tiled grid")
+def Gen_Grid_Tiled (mins, Get_FUNCTION, in_args, limits, title, tile=10,
+                    mins_fine=0, threshold=np.inf, path=None, mode="auto", n_jobs=1):
+    """
+    Generates a regional grid like Gen_Grid, tile by tile, for resolutions
+    that do not fit in memory. The box is cut into bands of latitudes, each
+    band is computed at once (its rows are shared by its tiles in "fft"
+    mode), then cut into tiles that are written to disk as they come.
+    Tiles where the field varies faster than threshold (units per degree)
+    are computed again at the finer resolution mins_fine
+    Input:
+        mins, Get_FUNCTION, in_args, limits, mode, n_jobs: see Gen_Grid
+        title: name of the mosaic, its files go in {path}/{title}
+        path: folder of the mosaics, Tiles_Path if None
+        tile: size of the tiles in degrees
+        mins_fine: resolution of the refined tiles, 0 for no refinement
+        threshold: largest gradient of a tile that is not refined
+    Output:
+        Mosaic: the index of the tiles, also stored in {path}/{title}/mosaic.json
+        To import use:
+            Tiles = imp.Load_Mosaic(title, path)
+    """
+    if path is None:
+        path = Tiles_Path
+    _, G_theta, G_phi = init_grid(mins, limits)
+    n_lat, n_long = G_theta.shape
+    Line_long = G_theta[0]*180/pi
+    Line_lat = G_phi[:, 0]*180/pi
+    n_tile = max(4, int(round(tile*60/mins)))
+
+    folder = f"{path}/{title}"
+    os.makedirs(folder, exist_ok=True)
+    Mosaic = {"function": Get_FUNCTION.__name__, "mins": mins, "limits": [float(v) for v in limits],
+              "shape": [n_lat, n_long], "tile": tile, "mins_fine": mins_fine, "Tiles": []}
+
+    Edges_lat, Edges_long = Get_Tile_Edges(n_lat, n_tile), Get_Tile_Edges(n_long, n_tile)
+    with term.Progress((len(Edges_lat)-1)*(len(Edges_long)-1), "tiles", "tiles") as P:
+        for i_0, i_1 in zip(Edges_lat[:-1], Edges_lat[1:]):
+            # the tiles hold the first row and column of the next ones, to leave no gap
+            i_e = min(i_1+1, n_lat)
+            G_Band, _, _ = Fill_Grid(np.zeros((i_e-i_0, n_long)), G_theta[i_0:i_e], G_phi[i_0:i_e],
+                                     Get_FUNCTION, in_args, mode, n_jobs)
+            for j_0, j_1 in zip(Edges_long[:-1], Edges_long[1:]):
+                j_e = min(j_1+1, n_long)
+                Tile = {"file": f"tile_{i_0}_{j_0}.npy", "rows": [i_0, i_1], "cols": [j_0, j_1],
+                        "long": [Line_long[j_0], Line_long[j_e-1], j_e-j_0],
+                        "lat":  [Line_lat[i_0],  Line_lat[i_e-1],  i_e-i_0]}
+                G_Tile = G_Band[:, j_0:j_e]
+                np.save(f"{folder}/{Tile['file']}", G_Tile)
+
+                if mins_fine and (Get_Gradient_Max(G_Tile, mins) > threshold):
+                    limits_fine = np.array([Line_long[j_0], Line_long[j_e-1], Line_lat[i_0], Line_lat[i_e-1]])
+                    G_Fine, G_Long, G_Lat = Gen_Grid(mins_fine, Get_FUNCTION, in_args, limits_fine,
+                                                     mode, n_jobs, cache=False)
+                    Tile["fine"] = {"file": f"tile_{i_0}_{j_0}_fine.npy",
+                                    "long": [G_Long[0, 0], G_Long[0, -1], G_Long.shape[1]],
+                                    "lat":  [G_Lat[0, 0],  G_Lat[-1, 0],  G_Lat.shape[0]]}
+                    np.save(f"{folder}/{Tile['fine']['file']}", G_Fine)
+                Mosaic["Tiles"].append(Tile)
+                P.update()
+
+    with open(f"{folder}/mosaic.tmp", "w") as file:
+        json.dump(Mosaic, file, indent=1, default=float)
+    os.replace(f"{folder}/mosaic.tmp", f"{folder}/mosaic.json")
+    return Mosaic
+
+
+def Get_Tile_Edges (n, n_tile):
+    """ returns the first index of each tile of n points and n, a short last tile joins the previous one """
+    Edges = list(range(0, n, n_tile)) + [n]
+    if (len(Edges) > 2) and (Edges[-1] - Edges[-2] < n_tile//2):
+        del Edges[-2]
+    return Edges
+
+
+def Get_Gradient_Max (G_Grid, mins):
+    """ returns the largest gradient of a grid of step mins, in units per degree """
+    if min(G_Grid.shape) < 2:
+        return 0
+    G_dlat, G_dlong = np.gradient(G_Grid, mins/60)
+    return np.amax(np.hypot(G_dlat, G_dlong))
+
+
+
+# =============================================================================
+# FUNCTIONS FOR THE GRID CACHE
+# =============================================================================
+def Get_Grid_Key (G_theta, G_phi, Get_FUNCTION, in_args, mode):
+    """
+    Returns the cache key of a grid: a hash of Grid_Cache_Version, of the
+    function (name, code, constants, defaults and closure), of the source of
+    the modules its kernels come from (see Get_Source_Hash), of the mode, of
+    the grid coordinates, and of the content of its arguments
+    """
+    Closure = getattr(Get_FUNCTION, "__closure__", None) or ()
+    Parts = [Grid_Cache_Version, f"{Get_FUNCTION.__module__}.{Get_FUNCTION.__qualname__}",
+             Get_Code_Parts(getattr(Get_FUNCTION, "__code__", None)),
+             getattr(Get_FUNCTION, "__defaults__", None),
+             Get_Source_Hash(Get_FUNCTION), mode, G_theta[0], G_phi[:, 0]]
+    Parts += [cell.cell_contents for cell in Closure]
+    Parts += list(in_args)
+    return solv.Get_Hash(*Parts)[:32]
+
+
+def Get_Code_Parts (code):
+    """ returns the bytecode and constants of a code object, nested functions included, as bytes """
+    if code is None:
+        return b""
+    Consts = []
+    for c in code.co_consts:
+        if hasattr(c, "co_code"):
+            Consts.append(Get_Code_Parts(c))
+        elif isinstance(c, frozenset): # the order of sets changes from one session to the next
+            Consts.append(repr(sorted(repr(v) for v in c)).encode())
+        else:
+            Consts.append(repr(c).encode())
+    return code.co_code + b"|" + b"|".join(Consts)
+
+
+def Get_Source_Hash (Get_FUNCTION):
+    """
+    Returns a hash of the source files of the module of Get_FUNCTION, of this
+    script and of GH_geoMath, where the helpers of the kernels are: editing
+    any of them changes the key of the cached grids
+    """
+    Files = {sys.modules[name].__file__ for name in [Get_FUNCTION.__module__, __name__, gmath.__name__]
+             if getattr(sys.modules.get(name), "__file__", None)}
+    H = hashlib.sha256()
+    for file_name in sorted(Files):
+        with open(file_name, "rb") as file:
+            H.update(file.read())
+    return H.hexdigest()
+
+
+def Load_Cached_Grid (key, shape, path=None):
+    """
+    Returns the cached grid of key, memory-mapped copy-on-write, or None
+    A hit refreshes the date of the file, for the eviction of Trim_Grid_Cache
+    The cache functions use Grid_Cache_Path and Grid_Cache_Size if path and
+    max_size are None, as set when they are called
+    """
+    if path is None:
+        path = Grid_Cache_Path
+    file_name = f"{path}/{key}.npy"
+    if not os.path.exists(file_name):
+        return None
+    G_Grid = np.load(file_name, mmap_mode="c")
+    if G_Grid.shape != shape:
+        return None
+    os.utime(file_name)
+    return G_Grid
+
+
+def Store_Cached_Grid (key, G_Grid, path=None, max_size=None):
+    """
+    Stores a grid in the cache, written under a temporary name then renamed,
+    and removes the least recently used grids above max_size bytes
+    """
+    if path is None:
+        path = Grid_Cache_Path
+    os.makedirs(path, exist_ok=True)
+    temp_name = f"{path}/{key}.{os.getpid()}.tmp"
+    with open(temp_name, "wb") as file:
+        np.save(file, G_Grid)
+    os.replace(temp_name, f"{path}/{key}.npy")
+    Trim_Grid_Cache(path, max_size)
+
+
+def Trim_Grid_Cache (path=None, max_size=None):
+    """ removes the least recently used grids until the cache fits max_size bytes """
+    if path is None:
+        path = Grid_Cache_Path
+    if max_size is None:
+        max_size = Grid_Cache_Size
+    Files = []
+    for entry in os.scandir(path):
+        try: # another process may have removed it meanwhile
+            if entry.name.endswith(".npy"):
+                Files.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        except OSError:
+            pass
+    Files.sort(reverse=True)
+    size = 0
+    for _, file_size, file_name in Files:
+        size += file_size
+        if size > max_size:
+            try: # already removed, or still memory-mapped by a cache hit (Windows)
+                os.remove(file_name)
+            except OSError:
+                pass
+
+
+
+# =============================================================================
+# FUNCTIONS FOR GRID ANALYSIS
+# =============================================================================
+def Get_CC_Weights (N):
+    """
+    Returns the Clenshaw-Curtis quadrature weights of the N+1 nodes
+    x_j = cos(j*pi/N), for integrals over x in [-1, 1]
+    Exact for polynomials of degree up to N
+    """
+    if N < 1:
+        return np.array([2.])
+    Theta = pi * np.arange(N+1) / N
+    k = np.arange(1, N//2 + 1)
+    b_k = np.where(2*k == N, 1., 2.)
+    W = 1 - (b_k / (4*k**2 - 1) * cos(2*np.outer(Theta, k))).sum(axis=1)
+    W *= 2 / N
+    W[[0, -1]] /= 2
+    return W
+
+
+def Get_Quad_Weights (Line_lat, quad="auto"):
+    """
+    Returns the quadrature weights over sin(lat) of the latitudes Line_lat
+    Input:
+        Line_lat: latitudes of the grid rows, in degrees, in any order
+        quad: "cc" for regular latitudes from pole to pole (Gen_Grid),
+              "gl" for Gauss-Legendre latitudes (Gen_Grid_GL),
+              "auto" to pick from the latitudes
+    Output:
+        W: weights of the rows
+        quad: the quadrature used
+    """
+    Line_lat = np.asarray(Line_lat, dtype=float)
+    n_lat = len(Line_lat)
+    Order = np.argsort(Line_lat)
+    Lat = Line_lat[Order]
+
+    if quad == "auto":
+        quad = "cc" if np.isclose(Lat[-1], 90) else "gl"
+
+    if quad == "cc":
+        Step = np.diff(Lat)
+        if not (np.isclose(Lat[0], -90) and np.isclose(Lat[-1], 90)
+                and np.allclose(Step, 180/(n_lat-1))):
+            raise Exception("Clenshaw-Curtis quadrature needs regular latitudes from pole to pole")
+        W_sorted = Get_CC_Weights(n_lat-1)
+    elif quad == "gl":
+        x, W_sorted = np.polynomial.legendre.leggauss(n_lat)
+        if not np.allclose(np.sin(Lat*pi/180), x, atol=1e-10):
+            raise Exception("The latitudes are not the Gauss-Legendre nodes, see init_grid_GL")
+    else:
+        raise Exception(f"Unknown quadrature \"{quad}\"")
+
+    W = np.zeros(n_lat)
+    W[Order] = W_sorted
+    return W, quad
+
+
+@inst.Staged("grid analysis")
+def Grid_Analysis (G_Grid, G_Long, G_Lat, lmax=0, quad="auto", chunk=0):
+    """
+    Returns the spherical harmonic coefficients of a global grid, by FFT along
+    the longitudes and quadrature along the latitudes, in O(lmax**3)
+    The grid is taken as a surface function:
+        G_Grid = sum (HC[l,m]*cos(m*Long) + HS[l,m]*sin(m*Long)) * P_lm(sin(Lat))
+    with the fully normalized ALFs of GH_geoMath.ALF_norm_vec
+    Input:
+        G_Grid, G_Long, G_Lat: grid and meshgrids in degrees, as returned by
+            Gen_Grid, Gen_Grid_GL or GH_import.Load_gridget_xmin. The
+            longitudes must go around the world with a regular step, a last
+            column repeating the first one (-180 and 180) is dropped
+        lmax: maximum degree of the analysis. 0 for the largest degree the
+            grid resolves exactly: (n_lat-1)//2 for a regular grid, n_lat-1 on
+            a Gauss-Legendre grid
+        quad: quadrature along the latitudes, see Get_Quad_Weights
+        chunk: number of rows per ALF evaluation, 0 for automatic
+    Output:
+        HC, HS: coefficient arrays of size lmax+1
+    """
+    G_Grid = np.asarray(G_Grid, dtype=float)
+    Line_long = np.asarray(G_Long, dtype=float)[0]
+    Line_lat = np.asarray(G_Lat, dtype=float)[:, 0]
+
+    if np.isclose(Line_long[-1] - Line_long[0], 360):
+        G_Grid = G_Grid[:, :-1]
+        Line_long = Line_long[:-1]
+    n_lon = len(Line_long)
+    if not np.allclose(np.diff(Line_long), 360/n_lon):
+        raise Exception("The grid must go around the world with a regular longitude step")
+
+    W, quad = Get_Quad_Weights(Line_lat, quad)
+    if lmax <= 0:
+        lmax = (len(Line_lat)-1)//2 if quad == "cc" else len(Line_lat)-1
+    if lmax > (n_lon-1)//2:
+        raise Exception(f"{n_lon} longitudes cannot resolve the orders up to lmax = {lmax}")
+    if chunk <= 0:
+        chunk = max(1, int(2e7 // (lmax+1)**2))
+
+    # longitude sums of the orders m, shifted to the first longitude
+    m = np.arange(lmax+1)
+    F = np.fft.rfft(G_Grid, axis=1)[:, :lmax+1]
+    F *= np.exp(-1j * m * Line_long[0]*pi/180)
+    F *= W[:, None] / (2*n_lon)
+
+    HC = np.zeros((lmax+1, lmax+1))
+    HS = np.zeros((lmax+1, lmax+1))
+    for i in range(0, len(Line_lat), chunk):
+        P_lm = gmath.ALF_norm_vec(lmax, sin(Line_lat[i:i+chunk]*pi/180))
+        HC += np.einsum("ilm,im->lm", P_lm,  F[i:i+chunk].real, optimize=True)
+        HS += np.einsum("ilm,im->lm", P_lm, -F[i:i+chunk].imag, optimize=True)
+    HS[:, 0] = 0
+
+    return HC, HS
 
 
 
@@ -155,12 +731,13 @@ def Get_Geo_Pot (R_e, phi, theta,    lmax, HC, HS, lmax_topo, HC_topo, HS_topo):
     return geopot
 
 
-def Get_Geoid_Height (R_e, phi, theta,    lmax, HC, HS):
+def Get_Geoid_Height (R_e, phi, theta,    lmax, HC, HS, corrected=False):
     """
     This function returns the potential at given height/phi/theta coordinates
     The solution is calculated up to degree lmax in the HC HS model
     The cosine coefficients for even l and m=0 are corrected to remove the
-    reference ellipsoid from the results
+    reference ellipsoid from the results, unless HC is already corrected
+    (see Remove_Ellipsoid, and Point_Geoid_Height for the grids)
     Equations come from the geoid cook book
     """
     cst = gmath.Constants()
@@ -170,6 +747,7 @@ def Get_Geoid_Height (R_e, phi, theta,    lmax, HC, HS):
 #    R = cst.a_g
 #    g_0 = cst.g
     phi_gc = phi
+    HC_corr = HC if corrected else Remove_Ellipsoid(lmax, HC)
 
     Sum1 = 0
     P_lm, _ = gmath.Pol_Legendre(lmax, lmax, cos(phi_gc) )
@@ -177,7 +755,7 @@ def Get_Geoid_Height (R_e, phi, theta,    lmax, HC, HS):
     for l in range (2, lmax+1):
         Sum2 = 0
         for m in range (0, l+1):
-            HC_lm = CorrCos_lm(l, m, HC[l,m])
+            HC_lm = HC_corr[l,m]
             Sum2 += (HC_lm*cos(m*theta) + HS[l,m]*sin(m*theta)) * P_lm[m, l] * gmath.Normalize(l, m)
 #            Sum2 += (HC[l,m]*cos(m*theta) + HS[l,m]*sin(m*theta)) * P_lm[m, l] * gmath.Normalize(l, m)
 #            Sum2 += (HC_lm*cos(m*theta) + HS[l,m]*sin(m*theta)) * LPNM[l, m]
@@ -315,12 +893,49 @@ def Get_isopot (R_e, phi, theta,    W_0, lmax, HC, HS, lmax_topo, HC_topo, HS_to
 # =============================================================================
 # SUB FUNCTIONS BUT STILL HARMONICS
 # =============================================================================
-def CorrCos_lm (l, m, HC_lm):
-    """ corrects the HC_lm coef if the conditions are correct - GCB """
-    lmax_corr=20
-    if ( (m==0) and (l<=lmax_corr) and (l%2 == 0) ): # print(f"corr lm {l} {m}")
-        HC_lm -= Cosine_Correction2(l)
-    return HC_lm
+def Remove_Ellipsoid (lmax, HC):
+    """
+    Returns a copy of HC up to degree lmax, without the even zonal terms of
+    the reference ellipsoid, see Get_Zonal_Correction
+    """
+    HC_corr = np.array(HC[:lmax+1, :lmax+1], dtype=float)
+    HC_corr[:, 0] -= Get_Zonal_Correction(lmax)
+    return HC_corr
+
+
+def Point_Geoid_Height (lmax, HC, HS, corrected=False):
+    """ in_args of Get_Geoid_Height for a whole grid, HC corrected once """
+    return [lmax, HC if corrected else Remove_Ellipsoid(lmax, HC), HS, True]
+
+
+Point_Setup = {Get_Geoid_Height: Point_Geoid_Height} # in_args prepared once per grid, "point" mode
+
+
+@lru_cache(maxsize=8)
+def Get_Zonal_Correction (lmax):
+    """
+    Returns the array[lmax+1] of the fully normalized zonal coefficients C_l0
+    of the normal field of the reference ellipsoid (WGS84), zero for odd l
+    J_2n = (-1)**(n+1) * 3*e**2n / ((2n+1)(2n+3)) * (1 - n + 5n*J_2/e**2)
+    C_2n = -J_2n / sqrt(4n+1)
+    Same values as the hsynth table of Cosine_Correction2 up to degree 20,
+    computed to any degree. The result is cached and read-only
+    """
+    c = gmath.Constants()
+    a, b, E, GM, wo = c.a_e, c.b_e, c.E, c.GM_e, c.wo
+    e2 = (E/a)**2  # first eccentricity, squared
+    e_p = E/b      # second eccentricity
+    m = wo**2 * a**2 * b / GM
+    q_0 = 1/2*((1 + 3/e_p**2)*np.arctan(e_p) - 3/e_p)
+    J_2 = e2/3 * (1 - 2/15*m*e_p/q_0)
+
+    n = np.arange(1, lmax//2 + 1)
+    with np.errstate(under="ignore"):
+        J_2n = (-1.)**(n+1) * 3*e2**n / ((2*n+1)*(2*n+3)) * (1 - n + 5*n*J_2/e2)
+    Corr = np.zeros(lmax+1)
+    Corr[2*n] = -J_2n / np.sqrt(4*n + 1)
+    Corr.flags.writeable = False
+    return Corr
 def Cosine_Correction2 (N):
     """ raw data from the hsynth fortran code """
     C = np.zeros(21)
@@ -365,6 +980,123 @@ def Cosine_Correction (N):
 
 
 
+# =============================================================================
+# FUNCTIONS FOR ROW SYNTHESIS
+# =============================================================================
+"""
+A row synthesis describes a Get_FUNCTION of this script as the linear sum
+    Offset + Scale * sum_l W_l * sum_m (HC[l,m]*cos(m*Long) + HS[l,m]*sin(m*Long)) * P_lm
+along a latitude row, so that Fill_Grid_FFT can sum it with FFTs
+Each takes arrays R_e and phi (colatitude) of the rows, then the in_args of
+its Get_FUNCTION, and returns (lmax, HC, HS, W_l[row, l], Scale[row], Offset[row])
+"""
+def Row_Sums (Phi, Terms, rows=slice(None), rows_s=None):
+    """
+    Returns the order-wise coefficients A_m[row, m], B_m[row, m] of the rows
+    at colatitudes Phi, for the row synthesis Terms, see above
+    The degree sums are split between even and odd l+m. As
+    P_lm(-x) = (-1)**(l+m) * P_lm(x), the same split sums also give the mirror
+    rows_s of the rows about the equator (see Get_Row_Pairs), returned as
+    A_s, B_s when rows_s is given
+    """
+    lmax, HC, HS, W_l, Scale, Offset = Terms
+    P_lm = gmath.ALF_norm_vec(lmax, cos(Phi))
+    P_lm *= W_l[rows, :, None]
+
+    Odd_m = np.arange(lmax+1) % 2 == 1
+    Sums = []
+    for H in (HC, HS):
+        H = H[:lmax+1, :lmax+1]
+        S_even_l = np.einsum("jlm,lm->jm", P_lm[:, 0::2], H[0::2], optimize=True)
+        S_odd_l  = np.einsum("jlm,lm->jm", P_lm[:, 1::2], H[1::2], optimize=True)
+        Sums.append((np.where(Odd_m, S_odd_l, S_even_l),   # even l+m
+                     np.where(Odd_m, S_even_l, S_odd_l)))  # odd l+m
+    (C_even, C_odd), (S_even, S_odd) = Sums
+
+    A_m = (C_even + C_odd) * Scale[rows, None]
+    B_m = (S_even + S_odd) * Scale[rows, None]
+    A_m[:, 0] += Offset[rows]
+    if rows_s is None:
+        return A_m, B_m
+
+    A_s = (C_even - C_odd) * Scale[rows_s, None]
+    B_s = (S_even - S_odd) * Scale[rows_s, None]
+    A_s[:, 0] += Offset[rows_s]
+    return A_m, B_m, A_s, B_s
+
+
+def Row_Degree_Weights (R_e, lmax, lmin, W_l=None):
+    """ returns the (a_g/R_e)**l weights of the rows, zero below lmin """
+    c = gmath.Constants()
+    l = np.arange(lmax+1)
+    W_rl = (c.a_g/R_e[:, None])**l
+    if W_l is not None:
+        W_rl *= W_l
+    W_rl[:, :lmin] = 0
+    return W_rl
+
+
+def Row_Topo_Height (R_e, Phi,   lmax_topo, HC_topo, HS_topo):
+    """ row synthesis of Get_Topo_Height """
+    W_l = np.ones((len(Phi), lmax_topo+1))
+    return lmax_topo, HC_topo, HS_topo, W_l, np.ones(len(Phi)), np.zeros(len(Phi))
+
+
+def Row_Geo_Pot (R_e, Phi,   lmax, HC, HS, lmax_topo, HC_topo, HS_topo):
+    """ row synthesis of Get_Geo_Pot, which only sums the zonal terms """
+    c = gmath.Constants()
+    HC_0 = np.zeros((lmax+1, lmax+1))
+    HC_0[:, 0] = HC[:lmax+1, 0]
+    W_l = Row_Degree_Weights(R_e, lmax, 2)
+    return lmax, HC_0, np.zeros((lmax+1, lmax+1)), W_l, c.GM_g/R_e, c.GM_g/R_e
+
+
+def Row_Geoid_Height (R_e, Phi,   lmax, HC, HS, corrected=False):
+    """
+    row synthesis of Get_Geoid_Height, with the same ellipsoid correction
+    unless HC is already corrected
+    """
+    c = gmath.Constants()
+    g_0 = gmath.Get_Normal_Gravity(Phi)
+    HC_corr = HC if corrected else Remove_Ellipsoid(lmax, HC)
+    W_l = Row_Degree_Weights(R_e, lmax, 2)
+    return lmax, HC_corr, HS, W_l, c.GM_g/(R_e*g_0), np.zeros(len(Phi))
+
+
+def Row_acceleration (R_e, Phi,   lmax, HC, HS):
+    """ row synthesis of Get_acceleration, the same finite difference over d """
+    c = gmath.Constants()
+    d = 1 # m
+    R_1 = R_e - d/2
+    R_2 = R_e + d/2
+    W_l = ( Row_Degree_Weights(R_1, lmax, 2) * (c.GM_g/R_1)[:, None]
+          - Row_Degree_Weights(R_2, lmax, 2) * (c.GM_g/R_2)[:, None] ) / d
+    return lmax, HC, HS, W_l, np.ones(len(Phi)), (c.GM_g/R_1 - c.GM_g/R_2) / d
+
+
+def Row_acceleration2 (R_e, Phi,   lmax, HC, HS):
+    """ row synthesis of Get_acceleration2 """
+    c = gmath.Constants()
+    W_l = Row_Degree_Weights(R_e, lmax, 2, np.arange(lmax+1))
+    return lmax, HC, HS, W_l, c.GM_g/R_e**3, np.zeros(len(Phi))
+
+
+def Row_acceleration3 (R_e, Phi,   lmax, HC, HS):
+    """ row synthesis of Get_acceleration3 """
+    c = gmath.Constants()
+    W_l = Row_Degree_Weights(R_e, lmax, 2, np.arange(lmax+1) + 1)
+    return lmax, HC, HS, W_l, c.GM_g/R_e**2, np.zeros(len(Phi))
+
+
+Row_Synthesis = {Get_Topo_Height:   Row_Topo_Height,
+                 Get_Geo_Pot:       Row_Geo_Pot,
+                 Get_Geoid_Height:  Row_Geoid_Height,
+                 Get_acceleration:  Row_acceleration,
+                 Get_acceleration2: Row_acceleration2,
+                 Get_acceleration3: Row_acceleration3}
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
@@ -384,6 +1116,19 @@ def void(r, phi, theta):
     return 0
 
 
+def TEST_Grid_Analysis():
+    """ synthesizes the topography on both grids, and analyses it back """
+    HC_topo, HS_topo = imp.Fetch_Topo_Coef()
+    lmax_topo = 10
+    HC_topo = HC_topo[:lmax_topo+1, :lmax_topo+1]
+    HS_topo = HS_topo[:lmax_topo+1, :lmax_topo+1]
+
+    for G_Grid, G_Long, G_Lat in [Gen_Grid_GL(lmax_topo, Get_Topo_Height, [lmax_topo, HC_topo, HS_topo]),
+                                  Gen_Grid(300, Get_Topo_Height, [lmax_topo, HC_topo, HS_topo])]:
+        HC, HS = Grid_Analysis(G_Grid, G_Long, G_Lat, lmax_topo)
+        print(f"\nmax error: cos {np.amax(abs(HC-HC_topo)):.3e}, sin {np.amax(abs(HS-HS_topo)):.3e}")
+
+
 def Math_calc_geopot_basic(z):
     """ some function needed in TEST_plot_radius """
     G = 6.673E-11
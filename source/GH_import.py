@@ -11,7 +11,13 @@
 # LIBRARIES
 # =============================================================================
 import numpy as np
+import os
+import json
 from time import gmtime, strftime
+from itertools import islice
+import threading
+import queue
+from multiprocessing import shared_memory
 
 #import GH_import       as imp
 #import GH_convert      as conv
@@ -25,6 +31,7 @@ import GH_export       as exp
 #import GH_harmonics    as harm
 #import GH_geoMath      as gmath
 #import GH_earthMap     as emap
+import GH_instrument   as inst
 
 
 from GH_convert import cart2sphA
@@ -33,6 +40,15 @@ from GH_convert import cart2sphA
 # GLOBAL VARIABLES
 # =============================================================================
 data_path = "../data"
+Coef_Cache_Path = "../Rendered/coef" # binary copies of the coefficient files, see Load_Binary
+
+Coef_Files = {"full"       : ("GeoPot_Coef_cos_deg2190.txt", "GeoPot_Coef_sin_deg2190.txt"),
+              "subset"     : ("GeoPot_Coef_cos_deg30.txt",   "GeoPot_Coef_sin_deg30.txt"),
+              "topo full"  : ("Height_Coef_cos_deg2190.txt", "Height_Coef_sin_deg2190.txt"),
+              "topo subset": ("GeoPot_Coef_cos_deg30.txt",   "GeoPot_Coef_sin_deg30.txt")}
+
+Coef_Registry = {} # model name -> (HC, HS) read-only arrays, see Get_Coef
+Coef_Shared = {}   # model name -> shared memory blocks, see Register_Coef
 
 
 
@@ -46,9 +62,36 @@ def Get_Time (format_="%Y%m%d_%H%M%S"):
 
 
 
+def Share_Array (A):
+    """
+    Copies an array into a new block of shared memory, that other processes
+    can attach with Attach_Array instead of receiving a pickled copy
+    Output:
+        shm: the SharedMemory block, to close() and unlink() once done
+        spec: (name, shape, dtype) to pass to Attach_Array
+    """
+    A = np.ascontiguousarray(A)
+    shm = shared_memory.SharedMemory(create=True, size=max(A.nbytes, 1))
+    B = np.ndarray(A.shape, A.dtype, buffer=shm.buf)
+    B[...] = A
+    return shm, (shm.name, A.shape, A.dtype.str)
+
+
+def Attach_Array (spec):
+    """
+    Returns the SharedMemory block and the array view of a spec returned by
+    Share_Array. Keep shm referenced as long as the array is used
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+
 # =============================================================================
 # FUNCTIONS TO FETCH FILES
 # =============================================================================
+@inst.Staged("read ephemeris")
 def Fetch_Pos (file_name, days=0.7, data_path="../data", spherical = True ):
     """
     Imports coordinates from file_name text file (generated from GMAT)
@@ -82,6 +125,7 @@ def Fetch_Pos (file_name, days=0.7, data_path="../data", spherical = True ):
 
 
 
+@inst.Staged("read ephemeris")
 def Fetch_Pos_Vit (file_name, days=0.7, data_path="../data", spherical = True ):
     """
     Imports coordinates from file_name text file (generated from GMAT)
@@ -122,38 +166,69 @@ def Fetch_Pos_Vit (file_name, days=0.7, data_path="../data", spherical = True ):
     return Pos,Vit, Time
 
 
-def Fetch_Coef (data="subset"):
+def Stream_Pos_Vit (file_name, days=0.7, data_path="../data", chunk=10000):
+    """
+    Same as Fetch_Pos_Vit, without spherical conversion, but reads the file
+    chunk lines at a time, so arcs of any length fit in memory
+    Input:
+        chunk: number of positions per chunk, at least 2 (the time step is
+               read from the first chunk)
+    Output:
+        yields Time, Pos, Vit for each chunk, in carthesian coordinates,
+        nothing if days is shorter than one time step
+    """
+    if chunk < 2:
+        raise Exception(f"Stream_Pos_Vit needs chunks of at least 2 positions, not {chunk}")
+    L = 0
+    with open(f"{data_path}/{file_name}") as file:
+        while True:
+            Lines = list(islice(file, chunk))
+            if not Lines: # end of the file, before loadtxt warns that it is empty
+                return
+            Eph = np.loadtxt(Lines, ndmin=2)
+            if len(Eph) == 0: # only blank lines left
+                return
+            t = Eph[:,0] #time in seconds
+            if L == 0:
+                if len(t) < 2:
+                    raise Exception(f"{file_name} has a single position, the time step is unknown")
+                dt = int(t[1]*100)/100
+                L_max = int(days*(86400/dt))
+                if L_max <= 0:
+                    return
+            Eph = Eph[:L_max-L]
+            L += len(Eph)
+            yield Eph[:,0], Eph[:,1:4], Eph[:,4:7]
+            if L >= L_max:
+                return
+
+
+def Fetch_Coef (data="subset", lmax=0):
     """
     Returns the spherical harmonic coefficients for Earth's Geopotential
     Data originally extracted from : EGM2008_to2190_ZeroTide.txt
     These coef are already normalized
     A subset is returned unless full coefficient matrix is specified
+    The arrays are private copies, that can be modified. Use Get_Coef for
+    read-only views of the registry, without copying them
     """
-    data_path = "../data"
-    if (data == "full"):
-        HC = np.loadtxt(f"{data_path}/GeoPot_Coef_cos_deg2190.txt")
-        HS = np.loadtxt(f"{data_path}/GeoPot_Coef_sin_deg2190.txt")
-    else:
-        HC = np.loadtxt(f"{data_path}/GeoPot_Coef_cos_deg30.txt")
-        HS = np.loadtxt(f"{data_path}/GeoPot_Coef_sin_deg30.txt")
-    return HC, HS
+    model = "full" if (data == "full") else "subset"
+    HC, HS = Get_Coef(model, lmax)
+    return np.array(HC), np.array(HS)
 
 
-def Fetch_Topo_Coef (data="subset"):
+def Fetch_Topo_Coef (data="subset", lmax=0):
     """
     Returns the spherical harmonic coefficients for Earth's Topography
     Data originally extracted from : Coeff_Height_and_Depth_to2190_DTM2006.txt
     These coef are already normalized
     A subset is returned unless full coefficient matrix is specified
+    The arrays are private copies, see Fetch_Coef
     """
-    data_path = "../data"
-    if (data == "full"):
-        HC_topo = np.loadtxt(f"{data_path}/Height_Coef_cos_deg2190.txt")
-        HS_topo = np.loadtxt(f"{data_path}/Height_Coef_sin_deg2190.txt")
-    else:
-        HC_topo = np.loadtxt(f"{data_path}/GeoPot_Coef_cos_deg30.txt")
-        HS_topo = np.loadtxt(f"{data_path}/GeoPot_Coef_sin_deg30.txt")
-    return HC_topo, HS_topo
+    model = "topo full" if (data == "full") else "topo subset"
+    HC_topo, HS_topo = Get_Coef(model, lmax)
+    return np.array(HC_topo), np.array(HS_topo)
+
 
 
 def Load_GLl (detail="zeros"):
@@ -169,6 +244,81 @@ def Load_GLl (detail="zeros"):
     return G_Grid, G_Long, G_Lat
 
 
+def Load_Mosaic (title, path="../Rendered/tiles", fine=True):
+    """
+    Should be used with harm.Gen_Grid_Tiled()
+    Returns the tiles of a mosaic as a list of [G_Grid, G_Long, G_Lat], with
+    the refined version of the tiles that have one, unless fine is False
+    The grids are memory-mapped, they are only read when used
+    """
+    folder = f"{path}/{title}"
+    with open(f"{folder}/mosaic.json") as file:
+        Mosaic = json.load(file)
+
+    Tiles = []
+    for Tile in Mosaic["Tiles"]:
+        if fine and ("fine" in Tile):
+            Tile = Tile["fine"]
+        G_Grid = np.load(f"{folder}/{Tile['file']}", mmap_mode="r")
+        G_Long, G_Lat = np.meshgrid(np.linspace(*Tile["long"]), np.linspace(*Tile["lat"]))
+        Tiles.append([G_Grid, G_Long, G_Lat])
+    return Tiles
+
+
+def Stream_Mosaic (title, path="../Rendered/tiles", fine=True):
+    """
+    Same as Load_Mosaic, one tile at a time, read into memory
+    Output:
+        yields G_Grid, G_Long, G_Lat, Tile (the entry of the tile in mosaic.json)
+    """
+    folder = f"{path}/{title}"
+    with open(f"{folder}/mosaic.json") as file:
+        Mosaic = json.load(file)
+
+    for Tile in Mosaic["Tiles"]:
+        Read = Tile["fine"] if (fine and ("fine" in Tile)) else Tile
+        G_Grid = np.load(f"{folder}/{Read['file']}")
+        G_Long, G_Lat = np.meshgrid(np.linspace(*Read["long"]), np.linspace(*Read["lat"]))
+        yield G_Grid, G_Long, G_Lat, Tile
+
+
+def Load_Mosaic_Grid (title, path="../Rendered/tiles", prefetch=2):
+    """
+    Returns the coarse tiles of a mosaic put back together, as G_Grid,
+    G_Long, G_Lat, see Load_Mosaic
+    The next tiles are read in the background while one is copied, see Prefetch
+    """
+    with open(f"{path}/{title}/mosaic.json") as file:
+        shape = json.load(file)["shape"]
+
+    G_Grid = np.zeros(shape)
+    Line_long = np.zeros(shape[1])
+    Line_lat  = np.zeros(shape[0])
+    for G_Tile, G_Long, G_Lat, Tile in Prefetch(Stream_Mosaic(title, path, fine=False), prefetch):
+        (i_0, i_1), (j_0, j_1) = Tile["rows"], Tile["cols"]
+        G_Grid[i_0:i_1, j_0:j_1] = G_Tile[:i_1-i_0, :j_1-j_0]
+        Line_long[j_0:j_1] = G_Long[0, :j_1-j_0]
+        Line_lat[i_0:i_1]  = G_Lat[:i_1-i_0, 0]
+    G_Long, G_Lat = np.meshgrid(Line_long, Line_lat)
+    return G_Grid, G_Long, G_Lat
+
+
+def Load_Normal (title, path="../Rendered/coefficients"):
+    """
+    Should be used with exp.Store_Normal()
+    Loads a solver state, see GH_solve.Init_Normal
+    """
+    with np.load(f"{path}/{title}.npz") as data:
+        state = {"lmax": int(data["lmax"]),
+                 "N": data["N"],
+                 "b": data["b"],
+                 "yty": float(data["yty"]),
+                 "n_obs": int(data["n_obs"]),
+                 "arcs": json.loads(str(data["arcs"])),
+                 "meta": json.loads(str(data["meta"]))}
+    return state
+
+
 def Load_gridget_xmin(shape = (61,61), name="pyOUTPUT.txt"):
     """
     This function is to be used along with py_gridget_xmin.py
@@ -195,6 +345,169 @@ def Load_gridget_xmin(shape = (61,61), name="pyOUTPUT.txt"):
 
 
 
+# =============================================================================
+# FUNCTIONS FOR THE COEFFICIENT REGISTRY
+# =============================================================================
+@inst.Staged("coefficients")
+def Get_Coef (model="subset", lmax=0):
+    """
+    Returns read-only views of the coefficients HC, HS of a model, truncated
+    to degree lmax (0 for all of them), without copying them. Fetch_Coef
+    returns copies instead, for the callers that modify them
+    A model of Coef_Files is loaded once per process, memory-mapped from a
+    binary copy of its text files, kept in Coef_Cache_Path (see Load_Binary):
+    every process maps the same pages of the system cache, so loading it
+    again is near-instant
+    Models put in shared memory with Register_Coef/Attach_Coef are also found
+    """
+    if model not in Coef_Registry:
+        if model not in Coef_Files:
+            raise Exception(f"Unknown coefficient model \"{model}\", see GH_import.Coef_Files")
+        Coef_Registry[model] = tuple(Load_Binary(file_name) for file_name in Coef_Files[model])
+
+    HC, HS = Coef_Registry[model]
+    if lmax > 0:
+        if lmax >= len(HC):
+            raise Exception(f"The model \"{model}\" stops at degree {len(HC)-1}, not {lmax}")
+        return HC[:lmax+1, :lmax+1], HS[:lmax+1, :lmax+1]
+    return HC, HS
+
+
+def Load_Binary (file_name, path=None, cache_path=None):
+    """
+    Returns a read-only memory map of the array in the text file file_name,
+    in path (data_path if None)
+    The array is converted once into a .npy file in cache_path
+    (Coef_Cache_Path if None), not next to the data, and again whenever the
+    text file is newer. The cache folder can be deleted at any time. The file
+    is written under a temporary name then renamed, so that processes
+    starting together never read a partial copy
+    """
+    if path is None:
+        path = data_path
+    if cache_path is None:
+        cache_path = Coef_Cache_Path
+    path_txt = f"{path}/{file_name}"
+    path_npy = f"{cache_path}/{os.path.splitext(file_name)[0]}.npy"
+    if (not os.path.exists(path_npy)) or (os.path.getmtime(path_npy) < os.path.getmtime(path_txt)):
+        Array = np.loadtxt(path_txt) # before the temporary file, not left behind if it fails
+        os.makedirs(cache_path, exist_ok=True)
+        path_tmp = f"{path_npy}.{os.getpid()}.tmp"
+        with open(path_tmp, "wb") as file:
+            np.save(file, Array)
+        os.replace(path_tmp, path_npy)
+    return np.load(path_npy, mmap_mode="r")
+
+
+def Register_Coef (model, HC, HS):
+    """
+    Copies coefficients computed in this process (solved ones for example)
+    into shared memory, and registers them under the name model for Get_Coef
+    Output:
+        Specs: to pass to Attach_Coef in the worker processes
+    """
+    Release_Coef(model)
+    (shm_HC, spec_HC), (shm_HS, spec_HS) = Share_Array(HC), Share_Array(HS)
+    Coef_Shared[model] = ([shm_HC, shm_HS], True)
+    Coef_Registry[model] = Read_Only(shm_HC, spec_HC), Read_Only(shm_HS, spec_HS)
+    return {model: (spec_HC, spec_HS)}
+
+
+def Attach_Coef (Specs):
+    """
+    Registers the shared coefficients of Register_Coef in this process,
+    without copying them. Can be used as a process pool initializer
+    """
+    for model, (spec_HC, spec_HS) in Specs.items():
+        shm_HC, _ = Attach_Array(spec_HC)
+        shm_HS, _ = Attach_Array(spec_HS)
+        Coef_Shared[model] = ([shm_HC, shm_HS], False)
+        Coef_Registry[model] = Read_Only(shm_HC, spec_HC), Read_Only(shm_HS, spec_HS)
+
+
+def Read_Only (shm, spec):
+    """ returns a read-only array view of a shared memory block """
+    _, shape, dtype = spec
+    A = np.ndarray(shape, dtype, buffer=shm.buf)
+    A.flags.writeable = False
+    return A
+
+
+def Release_Coef (model):
+    """
+    Removes a model from the registry, and frees its shared memory once the
+    process that created it with Register_Coef releases it
+    """
+    Coef_Registry.pop(model, None)
+    Shared, owner = Coef_Shared.pop(model, ([], False))
+    for shm in Shared:
+        shm.close()
+        if owner:
+            shm.unlink()
+
+
+
+# =============================================================================
+# FUNCTIONS FOR PREFETCHING
+# =============================================================================
+def Prefetch (Stream, n=2):
+    """
+    Runs the Stream generator in a background thread, up to n chunks ahead
+    of the consumer, so that reading and decoding the next chunks overlaps
+    with the processing of the current one
+    Exceptions raised in Stream are raised again in the consumer; if the
+    consumer stops early, the thread stops and closes Stream
+    Input:
+        Stream: iterable of chunks, such as Stream_Pos_Vit or Stream_Mosaic
+        n: size of the queue of chunks read ahead, 0 to read in the foreground
+    Output:
+        yields the chunks of Stream, in order
+    """
+    if n <= 0:
+        yield from Stream
+        return
+    Chunks = queue.Queue(maxsize=n)
+    Stop = threading.Event()
+
+    def Put (item):
+        """ waits for a free place in the queue, unless the consumer is gone """
+        while not Stop.is_set():
+            try:
+                Chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Producer ():
+        Source = iter(Stream)
+        try:
+            for Chunk in Source:
+                if not Put(("chunk", Chunk)):
+                    return
+            Put(("end", None))
+        except Exception as error:
+            Put(("error", error))
+        finally:
+            if hasattr(Source, "close"):
+                Source.close()
+
+    Thread = threading.Thread(target=Producer, name="Prefetch", daemon=True)
+    Thread.start()
+    try:
+        while True:
+            kind, item = Chunks.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        Stop.set()
+        Thread.join()
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
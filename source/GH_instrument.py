@@ -0,0 +1,298 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The functions in this script are used to measure where the time and the
+    memory go in a run: the other scripts wrap their main steps in stages
+    and count what they process, and a summary is printed at the end
+    Instrumentation is off unless Enable() is called, or the environment
+    variable GH_INSTRUMENT is set. When it is off, a stage costs one flag
+    check, and nothing is recorded
+        with inst.Stage("normal equations"):
+            ...
+            inst.Count("points", len(Pos))
+        print(inst.Report())
+    Stages opened inside other stages are recorded under their path, such as
+    "solve/normal equations"
+    Memory is how much a stage raised the peak resident size of the process
+    (its peak minus the resident size when the stage started, 0 when the
+    stage stayed below an earlier peak), or with Enable(trace_memory=True)
+    the peak of the allocations made inside each stage (tracemalloc, slower)
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import os
+import sys
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+import contextlib
+import functools
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+try:
+    from line_profiler import LineProfiler # optional, only for Line_Profile
+except ImportError:
+    LineProfiler = None
+
+#import GH_import       as imp
+#import GH_convert      as conv
+#import GH_generate     as gen
+#import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+#import GH_terminal     as term
+#import GH_harmonics    as harm
+#import GH_geoMath      as gmath
+#import GH_earthMap     as emap
+
+
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Enabled = bool(os.environ.get("GH_INSTRUMENT"))
+Trace_Memory = False
+Stages = {}   # path: {"calls", "time", "memory"} of the stages closed so far
+Counters = {} # path: {name: count}
+Stack = []    # the open stages: [path, t_0, memory at the start, peak of the closed children
+              #                   (traced) or peak of the process at the start (RSS)]
+Null_Stage = contextlib.nullcontext()
+Profile_Path = "../Rendered/profiles"
+
+
+
+# =============================================================================
+# FUNCTIONS TO RECORD
+# =============================================================================
+def Enable (trace_memory=False):
+    """ Starts recording the stages, and tracing the allocations if trace_memory """
+    global Enabled, Trace_Memory
+    Enabled = True
+    Trace_Memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def Disable ():
+    """ Stops recording, what is recorded is kept until Reset """
+    global Enabled, Trace_Memory
+    Enabled = False
+    if Trace_Memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    Trace_Memory = False
+
+
+def Reset ():
+    """ Forgets everything that has been recorded """
+    Stages.clear()
+    Counters.clear()
+    Stack.clear()
+
+
+def Stage (name):
+    """
+    Returns a context manager that records the time and memory spent in the
+    code it wraps, under name. When instrumentation is off it does nothing
+    """
+    if not Enabled:
+        return Null_Stage
+    return Recorded_Stage(name)
+
+
+@contextlib.contextmanager
+def Recorded_Stage (name):
+    """ see Stage """
+    path = f"{Stack[-1][0]}/{name}" if Stack else name
+    if Trace_Memory:
+        memory_0 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        peak_0 = 0
+    else:
+        memory_0, peak_0 = Get_RSS(), Get_Peak_RSS()
+    Stack.append([path, time.perf_counter(), memory_0, peak_0])
+    try:
+        yield
+    finally:
+        path, t_0, memory_0, peak_0 = Stack.pop()
+        Record = Stages.setdefault(path, {"calls": 0, "time": 0., "memory": 0})
+        Record["calls"] += 1
+        Record["time"] += time.perf_counter() - t_0
+        if Trace_Memory:
+            peak = max(tracemalloc.get_traced_memory()[1], peak_0) # peak_0: of the children
+            Record["memory"] = max(Record["memory"], peak - memory_0)
+            if Stack: # the peak of the parent was reset by this stage
+                Stack[-1][3] = max(Stack[-1][3], peak)
+        else: # the peak of the process only tells about this stage if the stage raised it
+            peak = Get_Peak_RSS()
+            if peak > peak_0:
+                Record["memory"] = max(Record["memory"], peak - memory_0)
+
+
+def Staged (name):
+    """
+    Decorator recording each call of a function as the stage name, see Stage
+    For the main steps of the pipeline only, not for functions called per point
+    """
+    def Decorator (FUNCTION):
+        @functools.wraps(FUNCTION)
+        def Staged_FUNCTION (*args, **kwargs):
+            if not Enabled:
+                return FUNCTION(*args, **kwargs)
+            with Recorded_Stage(name):
+                return FUNCTION(*args, **kwargs)
+        return Staged_FUNCTION
+    return Decorator
+
+
+def Count (name, n=1):
+    """ Adds n to the counter name of the current stage """
+    if not Enabled:
+        return
+    path = Stack[-1][0] if Stack else ""
+    Counts = Counters.setdefault(path, {})
+    Counts[name] = Counts.get(name, 0) + n
+
+
+def Get_RSS ():
+    """ Returns the resident memory of the process now, in bytes, its peak so far if unknown """
+    try:
+        with open("/proc/self/statm") as file: # Linux only
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return Get_Peak_RSS()
+
+
+def Get_Peak_RSS ():
+    """ Returns the peak resident memory of the process so far, in bytes, 0 if unknown """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024 # B on mac, kB on Linux
+
+
+
+# =============================================================================
+# FUNCTIONS TO REPORT
+# =============================================================================
+def Report ():
+    """ Returns the recorded stages and counters as text, nested stages indented """
+    if not Stages and not Counters:
+        return "Nothing was recorded, see GH_instrument.Enable"
+    memory = "alloc. peak" if Trace_Memory else "RSS peak +"
+    lines = [f"{'stage':<40}{'calls':>8}{'time (s)':>12}{'mean (s)':>12}{memory:>14}"]
+    for path in sorted(Stages, key=lambda p: (Get_Root_Order(p), p)):
+        Record = Stages[path]
+        depth = path.count("/")
+        name = "  "*depth + path.rsplit("/", 1)[-1]
+        lines.append(f"{name:<40}{Record['calls']:>8d}{Record['time']:>12.3f}"
+                     f"{Record['time']/Record['calls']:>12.4f}{Format_Bytes(Record['memory']):>14}")
+        for counter, n in Counters.get(path, {}).items():
+            rate = n / Record["time"] if Record["time"] > 0 else 0
+            lines.append(f"{'  '*(depth+1)}{counter}: {n} ({rate:.0f}/s)")
+    for counter, n in Counters.get("", {}).items():
+        lines.append(f"{counter}: {n}")
+    return "\n".join(lines)
+
+
+def Get_Root_Order (path):
+    """ orders the report by the first start of the top stages """
+    return list(Stages).index(path.split("/")[0]) if path.split("/")[0] in Stages else len(Stages)
+
+
+def Format_Bytes (n):
+    """ Returns a size in bytes as text """
+    for unit in ["B", "kB", "MB", "GB"]:
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+
+# =============================================================================
+# FUNCTIONS TO PROFILE
+# =============================================================================
+def Start_Profile ():
+    """ Starts profiling with cProfile, returns the profiler to give to Stop_Profile """
+    Profiler = cProfile.Profile()
+    Profiler.enable()
+    return Profiler
+
+
+def Stop_Profile (Profiler, title="profile", path=Profile_Path, n_lines=25, sort="cumulative"):
+    """
+    Stops the profiler, stores the statistics in {path}/{title}.prof (for
+    snakeviz or pstats), and prints the n_lines most expensive functions
+    """
+    Profiler.disable()
+    os.makedirs(path, exist_ok=True)
+    Profiler.dump_stats(f"{path}/{title}.prof")
+    text = io.StringIO()
+    pstats.Stats(Profiler, stream=text).sort_stats(sort).print_stats(n_lines)
+    print(text.getvalue())
+
+
+@contextlib.contextmanager
+def Profile (title="profile", path=Profile_Path, n_lines=25, sort="cumulative"):
+    """ Profiles the code it wraps, see Start_Profile and Stop_Profile """
+    Profiler = Start_Profile()
+    try:
+        yield Profiler
+    finally:
+        Stop_Profile(Profiler, title, path, n_lines, sort)
+
+
+@contextlib.contextmanager
+def Line_Profile (*Functions):
+    """
+    Profiles the Functions line by line, with line_profiler (optional, not
+    installed with the rest), and prints the result
+    """
+    if LineProfiler is None:
+        raise Exception("Line_Profile needs line_profiler: pip install line_profiler")
+    Profiler = LineProfiler(*Functions)
+    Profiler.enable_by_count()
+    try:
+        yield Profiler
+    finally:
+        Profiler.disable_by_count()
+        Profiler.print_stats()
+
+
+
+# =============================================================================
+# TEST FUNCTIONS
+# =============================================================================
+def TEST_Stages ():
+    import numpy as np
+    Enable(trace_memory=True)
+    with Stage("outer"):
+        A = np.ones((1000, 1000))
+        for i in range(3):
+            with Stage("inner"):
+                B = np.ones((2000, 1000))
+                Count("points", B.size)
+                del B
+    del A
+    print(Report())
+    Disable()
+    Reset()
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+if __name__ == '__main__':
+    TEST_Stages()
+
+    print("\nGH_instrument done")
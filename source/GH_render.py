@@ -0,0 +1,195 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The functions in this script render maps of precomputed grids to image
+    files, without a screen and without pyplot: the figures are drawn by the
+    Agg canvas only, so they never pop up, and they are not kept by pyplot
+    once rendered
+    A map layout (projection, limits, figure size) is built once per process
+    with its coastlines, gridlines, credits and colorbar axes, and kept in
+    Bases. Each map then only draws its data layer (contours, colorbar,
+    titles), is saved, and the data layer is removed for the next map.
+    Cartopy keeps the coastlines it has projected for a layout, so they are
+    not projected again either
+        Maps = [{"title": "geoid l100", "grid": [G_Grid, G_Long, G_Lat],
+                 "label": "Geoid height in m"}, ...]
+        Files = rend.Render_Maps(Maps, n_jobs=4)
+    Generally used variables:
+        Map = dictionary describing one map:
+            title: title of the figure, and name of the file
+            grid: [G_Grid, G_Long, G_Lat], or the detail of a grid stored
+                  with GH_export.Store_temp_GLl
+            the other keys are optional, see Map_Defaults
+        limits = [Western_long, Eastern_long, Southern_lat, Northern_lat]
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import os
+import cartopy.crs as ccrs
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colorbar import make_axes
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import GH_import       as imp
+#import GH_convert      as conv
+#import GH_generate     as gen
+#import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+import GH_terminal     as term
+#import GH_harmonics    as harm
+#import GH_geoMath      as gmath
+import GH_earthMap     as emap
+
+
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Render_Path = "../Rendered/images"
+Map_Defaults = {"levels": 40,              # number of color levels, or the levels
+                "map_color": "jet",        # see emap.Plot_contourf
+                "label": "",               # label of the colorbar
+                "subtitle": None,          # None for the number of points and levels
+                "limits": None,            # None for the limits of the grid
+                "proj": ccrs.PlateCarree,  # cartopy projection of the map
+                "shape": (7,5)}            # size of the figure, in inches
+Bases = {} # (proj, limits, shape): [FIG, AX, CAX, CBAR], the layouts built in this process
+
+
+
+# =============================================================================
+# FUNCTIONS FOR LAYOUTS
+# =============================================================================
+def Get_Base (proj, limits, shape):
+    """
+    Returns the figure, map axes, colorbar axes and colorbar (None until the
+    first map) of a layout, built the first time with the coastlines,
+    gridlines and credits of emap.Make_Map
+    """
+    key = (proj, tuple(float(v) for v in limits), tuple(shape))
+    if key not in Bases:
+        FIG = Figure(figsize=shape)
+        FigureCanvasAgg(FIG)
+        AX = FIG.add_subplot(111, projection=proj(central_longitude=0))
+        AX.set_extent(limits, crs=ccrs.PlateCarree())
+        emap.Add_Gridlines(AX, proj)
+        emap.Add_Credits(AX)
+        AX.coastlines(linewidth = 0.6)
+        CAX, _ = make_axes(AX, orientation='horizontal', pad=0.10) # as emap.Plot_contourf
+        Bases[key] = [FIG, AX, CAX, None]
+    return Bases[key]
+
+
+def Close_Bases ():
+    """ Forgets the layouts of this process, freeing their figures """
+    for FIG, _, _, _ in Bases.values():
+        FIG.clear()
+    Bases.clear()
+
+
+
+# =============================================================================
+# FUNCTIONS TO RENDER
+# =============================================================================
+def Render_Map (Map, path=Render_Path, dpi=200, time=""):
+    """
+    Renders one map onto its layout and saves it as "{path}/{time} {title}.png",
+    like GH_export.Store_Figure. Returns the file name
+    """
+    if "grid" not in Map:
+        raise Exception(f"The map \"{Map.get('title', '')}\" has no grid")
+    Map = {**Map_Defaults, **Map}
+    G_Grid, G_Long, G_Lat = imp.Load_GLl(Map["grid"]) if isinstance(Map["grid"], str) else Map["grid"]
+    limits = emap.get_limits(G_Long, G_Lat) if Map["limits"] is None else Map["limits"]
+    Base = Get_Base(Map["proj"], limits, Map["shape"])
+    FIG, AX, CAX, CBAR = Base
+
+    data = emap.Plot_contourf(G_Grid, G_Long, G_Lat, AX, Map["levels"],
+                              map_color=Map["map_color"], colorbar=False)
+    try:
+        if CBAR is None:
+            CBAR = Base[3] = FIG.colorbar(data, cax=CAX, orientation='horizontal')
+        else: # the colorbar is kept, clearing its axes costs as much as the map
+            CBAR.boundaries, CBAR.values = data.levels, data.cvalues
+            CBAR.update_normal(data)
+        CBAR.set_label(Map["label"])
+        FIG.suptitle(Map["title"])
+        levels = Map["levels"] if np.isscalar(Map["levels"]) else len(Map["levels"])
+        subtitle = Map["subtitle"]
+        if subtitle is None:
+            subtitle = f"{G_Grid.size} points; {levels} color levels"
+        AX.set_title(subtitle, fontsize=10)
+
+        file_name = f"{path}/{time} {Map['title']}.png"
+        FIG.savefig(file_name, dpi=dpi)
+    finally:
+        data.remove()
+    return file_name
+
+
+def Render_Maps (Maps, path=Render_Path, dpi=200, time="", n_jobs=1):
+    """
+    Renders a batch of maps, see Render_Map
+    Input:
+        Maps: list of Map dictionaries, see the top of this script
+        n_jobs: number of processes, 0 for all the cores. The grids are sent
+                to the processes, give stored grids by name to avoid it
+    Output:
+        Files: file names of the maps, in the order of Maps
+    """
+    os.makedirs(path, exist_ok=True)
+    if n_jobs <= 0:
+        n_jobs = os.cpu_count()
+    Files = [""] * len(Maps)
+
+    with term.Progress(len(Maps), "maps", "maps") as P:
+        if (n_jobs == 1) or (len(Maps) == 1):
+            try:
+                for k, Map in enumerate(Maps):
+                    Files[k] = Render_Map(Map, path, dpi, time)
+                    P.update()
+            finally:
+                Close_Bases()
+        else:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(Maps))) as Pool:
+                Jobs = {Pool.submit(Render_Map, Map, path, dpi, time): k for k, Map in enumerate(Maps)}
+                for job in as_completed(Jobs):
+                    Files[Jobs[job]] = job.result()
+                    P.update()
+    return Files
+
+
+
+# =============================================================================
+# TEST FUNCTIONS
+# =============================================================================
+def TEST_Render_Maps ():
+    """ renders the geoid at a few degrees, twice the same layout """
+    import GH_harmonics as harm
+    HC, HS = imp.Fetch_Coef()
+    Maps = []
+    for lmax in [5, 10, 20]:
+        G_Grid, G_Long, G_Lat = harm.Gen_Grid(120, harm.Get_Geoid_Height, [lmax, HC, HS])
+        Maps.append({"title": f"TEST geoid l{lmax}", "grid": [G_Grid, G_Long, G_Lat],
+                     "label": "Geoid height in m"})
+    print(Render_Maps(Maps, n_jobs=2))
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+if __name__ == '__main__':
+
+    TEST_Render_Maps()
+
+    print("\nGH_render done")
@@ -13,7 +13,12 @@ todo: write acc_matrix generation AND geopot_matrix generation
 # =============================================================================
 import numpy as np
 import numpy.linalg as npl
+import os
+import time
+import hashlib
+import scipy.linalg as spl
 from numpy import sin, cos
+from concurrent.futures import ThreadPoolExecutor
 
 import GH_import       as imp
 import GH_convert      as conv
@@ -21,20 +26,28 @@ import GH_convert      as conv
 #import GH_solve        as solv
 #import GH_displayGeoid as dgeo
 #import GH_displaySat   as dsat
-#import GH_export       as exp
+import GH_export       as exp
 #import GH_displayTopo  as dtopo
 import GH_terminal     as term
 #import GH_harmonics    as harm
 import GH_geoMath      as gmath
 #import GH_earthMap     as emap
+import GH_instrument   as inst
 
 
+
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Chunk_Memory = 1e9 # bytes of the temporary arrays of one chunk of points, see Get_Chunk
+
 # =============================================================================
 # FUNCTIONS FOR Sph Harm SOLVE
 # =============================================================================
 
 
 
+@inst.Staged("design matrix")
 def Get_PotGradMatrix2 (lmax, Pos): #"R = 6378136.3 m):
     """
     Returns the matrix of the gravitational potential gradient.
@@ -65,39 +78,39 @@ def Get_PotGradMatrix2 (lmax, Pos): #"R = 6378136.3 m):
     M_PotGrad = np.ones((N_points * 3, N_coef)) # THE Potential Gradient Matrix
     print(f"Generating BAM of shape = {M_PotGrad.shape}") # BAM =  "Big Ass Matrix"
 
-    for i in range (0, N_points):
-        term.printProgressBar(i+1, N_points)
-
-        r, theta, phi = Pos[i] #spherical coordinates at the first point
-        Plm_z, Plm_dz = gmath.Pol_Legendre(lmax, lmax, sin(theta))
+    with term.Progress(N_points, "matrix", "points") as P:
+        for i in range (0, N_points):
+            r, theta, phi = Pos[i] #spherical coordinates at the first point
+            Plm_z, Plm_dz = gmath.Pol_Legendre(lmax, lmax, sin(theta))
 
-        j = 0
-        k = Cos_len
+            j = 0
+            k = Cos_len
 
-        for l in range (0, lmax +1):
-            for m in range (0, l +1):
-                # These equations were found in the GFZ document page 23
-                W_r = - GM/r**2 * (R/r)**l * (l+1) * Plm_z[m, l]
-                W_phi = -W_r * m * r / (l+1)
-                W_theta = GM/r * (R/r)**l * Plm_dz[m, l]
+            for l in range (0, lmax +1):
+                for m in range (0, l +1):
+                    # These equations were found in the GFZ document page 23
+                    W_r = - GM/r**2 * (R/r)**l * (l+1) * Plm_z[m, l]
+                    W_phi = -W_r * m * r / (l+1)
+                    W_theta = GM/r * (R/r)**l * Plm_dz[m, l]
 
-                Sub_mat = np.zeros ((3,1))
-                Sub_mat = [ cos(m*phi)*W_r,
-                            cos(m*phi)*W_theta,
-                            -sin(m*phi)*W_phi] # multiply by: COS_lm_coef
+                    Sub_mat = np.zeros ((3,1))
+                    Sub_mat = [ cos(m*phi)*W_r,
+                                cos(m*phi)*W_theta,
+                                -sin(m*phi)*W_phi] # multiply by: COS_lm_coef
 
-                M_PotGrad [3*i : 3*(i+1), j] = Sub_mat
-                j += 1
+                    M_PotGrad [3*i : 3*(i+1), j] = Sub_mat
+                    j += 1
 
-                # for m of non-null, we get a sine coefficient
-                if (m != 0):
-                    Sub_mat = np.zeros ((3,1))
-                    Sub_mat = [ sin(m*phi)*W_r,
-                                sin(m*phi)*W_theta,
-                                cos(m*phi)*W_phi] # multiply by: SIN_lm_coef
+                    # for m of non-null, we get a sine coefficient
+                    if (m != 0):
+                        Sub_mat = np.zeros ((3,1))
+                        Sub_mat = [ sin(m*phi)*W_r,
+                                    sin(m*phi)*W_theta,
+                                    cos(m*phi)*W_phi] # multiply by: SIN_lm_coef
 
-                    M_PotGrad [3*i : 3*(i+1), k] = Sub_mat
-                    k += 1
+                        M_PotGrad [3*i : 3*(i+1), k] = Sub_mat
+                        k += 1
+            P.update()
 
     return M_PotGrad
 
@@ -106,9 +119,180 @@ def proj_ort(M,y):
     return y - M@np.linalg.lstsq(M,y)[0]
 
 
+@inst.Staged("design matrix")
+def Get_PotGradMatrix (lmax, Pos, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns the matrix of the gravitational potential gradient, vectorized.
+    Watch out, it gets big fast.
+    Multiplying it with the line array of coefficients from
+    GH_convert.Make_Line_Coef will return the acceleration at the given
+    coordinates, as [a_r, a_theta, a_phi] for each point.
+        *There are no geoid coefficients for l=0, l=1*
+        *There are no sine coefficients for m=0*
+    Input:
+        lmax: max degree
+        Pos: array of N_points positions in spherical coordinates (r, theta, phi)
+            as returned by GH_convert.cart2sphA: theta is the latitude
+            (elevation), phi is the longitude
+        R: Reference radius in km
+        GM: standard gravitational parameter in km**3 s**-2
+        chunk: number of points processed at once, 0 to fit Chunk_Memory
+               (see Get_Chunk)
+    Output:
+        M_PotGrad: the matrix of the coefficients, shape (3*N_points, N_coef)
+    """
+    chunk = Get_Chunk(lmax, chunk, 8)
+    N_points = len(Pos)
+    N_coef = conv.Get_Len_Coef(lmax)
+
+    M_PotGrad = np.zeros((N_points * 3, N_coef)) # THE Potential Gradient Matrix
+    print(f"Generating BAM of shape = {M_PotGrad.shape}") # BAM =  "Big Ass Matrix"
+
+    with term.Progress(N_points, "matrix", "points") as P:
+        for i in range (0, N_points, chunk):
+            M_PotGrad[3*i : 3*(i+chunk)] = Get_PotGradBlock(lmax, Pos[i : i+chunk], R, GM)
+            P.update(len(Pos[i : i+chunk]))
+
+    return M_PotGrad
+
+
+def Get_PotGradBlock (lmax, Pos, R=6378.1363, GM=398600.4418):
+    """
+    Returns the rows of Get_PotGradMatrix for a few points at once
+    These equations come from the GFZ document, the acceleration being the
+    gradient of the potential in local spherical coordinates:
+        a_r     = dV/dr
+        a_theta = 1/r * dV/dtheta
+        a_phi   = 1/(r*cos(theta)) * dV/dphi
+    """
+    Pos = np.atleast_2d(Pos)
+    r, theta, phi = Pos[:,0:1], Pos[:,1:2], Pos[:,2:3]
+    n = len(Pos)
+
+    _, L_cos, M_cos, _, L_sin, M_sin = conv.Get_Index_Coef(lmax)
+    F_cos, F_sin = conv.Get_Flat_Index(lmax)
+
+    P_lm, P_lm_u = gmath.ALF_norm_vec(lmax, sin(theta[:,0]), div_u=True)
+    dP_lm = gmath.ALF_norm_deriv(P_lm)
+    P_lm = P_lm.reshape(n, -1)
+    dP_lm = dP_lm.reshape(n, -1)
+    P_lm_u = P_lm_u.reshape(n, -1)
+
+    ls = np.arange(lmax+1)
+    ms = np.arange(lmax+1)
+    W_l = GM/r**2 * (R/r)**ls # (n, lmax+1)
+    cos_m = cos(ms*phi)
+    sin_m = sin(ms*phi)
+
+    Block = np.empty((n, 3, L_cos.size + L_sin.size))
+    for cols, L, M, F, trig, dtrig in [
+            (slice(0, L_cos.size), L_cos, M_cos, F_cos, cos_m, -sin_m), # multiply by: COS_lm_coef
+            (slice(L_cos.size, None), L_sin, M_sin, F_sin, sin_m, cos_m)]: # multiply by: SIN_lm_coef
+        W = W_l[:, L]
+        Block[:, 0, cols] = -(L+1) * W * P_lm[:, F] * trig[:, M]
+        Block[:, 1, cols] = W * dP_lm[:, F] * trig[:, M]
+        Block[:, 2, cols] = M * W * P_lm_u[:, F] * dtrig[:, M]
+
+    return Block.reshape(3*n, -1)
+
+
+@inst.Staged("normal equations")
+def Get_Normal (lmax, Pos, Acc, W=None, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns the normal equations of the least squares problem, accumulated
+    chunk by chunk so the full Get_PotGradMatrix is never held in memory
+    Input:
+        lmax, Pos, R, GM, chunk: see Get_PotGradMatrix
+        Acc: array of N_points accelerations (a_r, a_theta, a_phi)
+        W: weights, one per point or one per acceleration component
+    Output:
+        N: the normal matrix, M.T @ W @ M
+        b: the right hand side, M.T @ W @ Acc
+        yty: weighted squared norm of the accelerations
+    """
+    chunk = Get_Chunk(lmax, chunk, 14)
+    Acc_line = np.asarray(Acc).ravel()
+    W_line = Make_Weights(W, len(Pos))
+    N_coef = conv.Get_Len_Coef(lmax)
+    inst.Count("points", len(Pos))
+
+    N = np.zeros((N_coef, N_coef))
+    b = np.zeros(N_coef)
+    yty = 0.
+    with term.Progress(len(Pos), "normal", "points") as P:
+        for i in range (0, len(Pos), chunk):
+            M = Get_PotGradBlock(lmax, Pos[i : i+chunk], R, GM)
+            y = Acc_line[3*i : 3*(i+chunk)]
+            w = W_line[3*i : 3*(i+chunk)]
+            Mw = M * w[:, None]
+            N += Mw.T @ M
+            b += Mw.T @ y
+            yty += y @ (w*y)
+            P.update(len(Pos[i : i+chunk]))
+
+    return N, b, yty
+
+
+def Make_Weights (W, N_points):
+    """
+    Returns the weights as one weight per acceleration component (3*N_points)
+    W can be None (all ones), one weight per point, or one per component
+    """
+    if W is None:
+        return np.ones(3*N_points)
+    W = np.asarray(W, dtype=float).ravel()
+    if W.size == N_points:
+        W = np.repeat(W, 3)
+    if W.size != 3*N_points:
+        raise Exception(f"{W.size} weights given for {N_points} points")
+    return W
+
+
+def Get_Regularization (lmax, reg="kaula"):
+    """
+    Returns the diagonal of the regularization matrix, in the order of
+    GH_convert.Make_Line_Coef
+        "tikhonov": identity
+        "kaula": inverse of Kaula's rule variance, sigma_l = 1e-5/l**2
+    """
+    _, L_cos, _, _, L_sin, _ = conv.Get_Index_Coef(lmax)
+    Ls = np.concatenate((L_cos, L_sin)).astype(float)
+    if reg == "tikhonov":
+        return np.ones(Ls.size)
+    elif reg == "kaula":
+        return Ls**4 / 1e-10
+    raise Exception(f"unknown regularization \"{reg}\"")
 
 
-def Solve_Coef (lmax, Pos, Acc):
+@inst.Staged("cholesky")
+def Solve_Normal (N, b, n_refine=0):
+    """
+    Solves the normal equations N x = b with a Cholesky factorization
+    n_refine steps of iterative refinement are made, with the residual
+    computed in extended precision
+    """
+    factor = spl.cho_factor(N)
+    x = spl.cho_solve(factor, b)
+    for _ in range(n_refine):
+        res = b.astype(np.longdouble) - N.astype(np.longdouble) @ x.astype(np.longdouble)
+        x = x + spl.cho_solve(factor, res.astype(float))
+    return x
+
+
+def Apply_PotGradMatrix (lmax, Pos, CS, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns Get_PotGradMatrix(lmax, Pos) @ CS, chunk by chunk
+    """
+    chunk = Get_Chunk(lmax, chunk, 8)
+    Acc_line = np.zeros(3*len(Pos))
+    for i in range (0, len(Pos), chunk):
+        M = Get_PotGradBlock(lmax, Pos[i : i+chunk], R, GM)
+        Acc_line[3*i : 3*(i+chunk)] = M @ CS
+    return Acc_line
+
+
+@inst.Staged("solve")
+def Solve_Coef (lmax, Pos, Acc, method="lstsq", W=None, reg=None, alpha=1., n_refine=0, checkpoint=""):
     """
     Returns the solved for coefficients to the spherical harmonic approximation
     of the Acc accelerations at Pos positions. Uses the least square methods
@@ -116,28 +300,703 @@ def Solve_Coef (lmax, Pos, Acc):
         lmax: maximum degree to be solved for
         Pos: list of N_points positions in spherical coordinates (r, theta, phi)
         Acc: list of N_points accelerations in spherical coordinates (a_r, a_theta, a_phi)
+        method: "lstsq" solves the full matrix with numpy's SVD based lstsq
+                "cholesky" solves the normal equations, much faster on tall
+                matrices, built chunk by chunk
+                "cg" matrix-free conjugate gradient, see Solve_Coef_CG
+                "block" block diagonal by order, see Solve_Coef_Block
+                "robust" with outlier rejection, see Solve_Coef_Robust
+        W: weights, one per point or one per acceleration component
+        reg: None, "kaula" or "tikhonov", see Get_Regularization
+        alpha: weight of the regularization, e.g. the variance of the
+               observation noise for "kaula"
+        n_refine: number of iterative refinement steps ("cholesky" only)
+        checkpoint: title of the checkpoint file of the normal equations
+                    ("cholesky" only), see Get_Normal_Checkpoint
     Output:
         Solved_Coef: line array of solved coefficients
+        Acc_solved: line array of the accelerations from the solved coefficients
+    """
+    print(f"Solving for coefficients, with lmax = {lmax}, method = {method}")
+
+    Acc_line = np.asarray(Acc).ravel()
+
+    if method == "lstsq":
+        M = Get_PotGradMatrix(lmax, Pos) # get M_PotGrad
+        w = np.sqrt(Make_Weights(W, len(Pos)))
+        M_w = M * w[:, None]
+        y_w = Acc_line * w
+        if reg is not None:
+            M_w = np.vstack((M_w, np.diag(np.sqrt(alpha*Get_Regularization(lmax, reg)))))
+            y_w = np.concatenate((y_w, np.zeros(M.shape[1])))
+        Solved_coef = npl.lstsq(M_w, y_w, rcond=None)[0]
+        Acc_solved = M.dot(Solved_coef)
+
+    elif method == "cholesky":
+        if checkpoint:
+            N, b, _ = Get_Normal_Checkpoint(lmax, Pos, Acc_line, W, checkpoint)
+        else:
+            N, b, _ = Get_Normal(lmax, Pos, Acc_line, W)
+        if reg is not None:
+            N[np.diag_indices_from(N)] += alpha*Get_Regularization(lmax, reg)
+        Solved_coef = Solve_Normal(N, b, n_refine)
+        Acc_solved = Apply_PotGradMatrix(lmax, Pos, Solved_coef)
+
+    elif method == "cg":
+        Solved_coef, Acc_solved = Solve_Coef_CG(lmax, Pos, Acc_line, W, reg, alpha)
+
+    elif method == "block":
+        Solved_coef, Acc_solved = Solve_Coef_Block(lmax, Pos, Acc_line, W, reg, alpha)
+
+    elif method == "robust":
+        Solved_coef, Acc_solved, _, _ = Solve_Coef_Robust(lmax, Pos, Acc_line, W, reg, alpha, n_refine=n_refine)
+
+    else:
+        raise Exception(f"unknown solving method \"{method}\"")
+
+    return Solved_coef, Acc_solved
+
+
+
+
 # =============================================================================
-# # ISSUES:
-        - Diverges beyond lmax = 8
+# FUNCTIONS FOR MATRIX-FREE SOLVE
 # =============================================================================
+def Get_PotGradTerms (lmax, Pos, R=6378.1363, GM=398600.4418):
     """
-    print(f"Solving for coefficients, with lmax = {lmax}")
+    Returns the terms that make up the rows of Get_PotGradBlock, without the
+    longitude part, for a few points at once. For each point n:
+        G_r[n, l, m]   = -(l+1) * GM/r**2 * (R/r)**l * P_lm
+        G_t[n, l, m]   =          GM/r**2 * (R/r)**l * dP_lm/dtheta
+        G_p[n, l, m]   =      m * GM/r**2 * (R/r)**l * P_lm / cos(theta)
+        cos_m, sin_m[n, m] = cos(m*phi), sin(m*phi)
+    """
+    Pos = np.atleast_2d(Pos)
+    r, theta, phi = Pos[:,0:1], Pos[:,1:2], Pos[:,2:3]
 
-    Acc_line = conv.Make_Line(Acc)
+    P_lm, P_lm_u = gmath.ALF_norm_vec(lmax, sin(theta[:,0]), div_u=True)
+    dP_lm = gmath.ALF_norm_deriv(P_lm)
 
-    M = Get_PotGradMatrix(lmax, Pos) # get M_PotGrad
+    ls = np.arange(lmax+1)
+    ms = np.arange(lmax+1)
+    W_l = (GM/r**2 * (R/r)**ls)[:, :, None] # (n, lmax+1, 1)
+    G_r = -(ls+1)[:, None] * W_l * P_lm
+    G_t = W_l * dP_lm
+    G_p = ms * W_l * P_lm_u
+    G_r[:, :2] = 0; G_t[:, :2] = 0; G_p[:, :2] = 0 # no coefficients for l=0, l=1
 
-   # Solved_coef = npl.solve(M.T.dot(M), M.T.dot(Acc_line.T)) #[1:]))
-    Solved_coef = npl.lstsq(M, Acc_line)
+    return G_r, G_t, G_p, cos(ms*phi), sin(ms*phi)
 
-    Acc_solved = M[:-1, :-1].dot(Solved_coef[:-1]) # change this "-1" to a "-3"?
 
+def Get_Chunk (lmax, chunk=0, n_arrays=6):
+    """
+    Returns chunk, or if chunk <= 0 the number of points per chunk whose
+    temporary arrays fit in Chunk_Memory. n_arrays is the peak memory of
+    the caller per point, in (lmax+1)**2 floats (measured): 6 for the sums of
+    Get_PotGradTerms, 8 for the rows of Get_PotGradBlock, 9 for
+    Get_Normal_Blocks and 14 for the products of Get_Normal
+    """
+    if chunk <= 0:
+        chunk = max(1, int(Chunk_Memory // (n_arrays * 8*(lmax+1)**2)))
+    return chunk
+
+
+@inst.Staged("synthesis")
+def Synth_PotGrad (lmax, Pos, HC, HS, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns the accelerations at Pos from the HC, HS coefficients, as a line
+    array [a_r, a_theta, a_phi, ...]. Same result as
+    Get_PotGradMatrix(lmax, Pos) @ Make_Line_Coef(lmax, HC, HS), but the
+    matrix is never formed: the sums are made over l first, then over m
+    """
+    chunk = Get_Chunk(lmax, chunk)
+    HC = HC[:lmax+1, :lmax+1]
+    HS = HS[:lmax+1, :lmax+1]
+    Acc = np.zeros((len(Pos), 3))
+    for i in range (0, len(Pos), chunk):
+        G_r, G_t, G_p, cos_m, sin_m = Get_PotGradTerms(lmax, Pos[i : i+chunk], R, GM)
+        for k, G, (t_c, t_s) in [(0, G_r, (cos_m, sin_m)),
+                                 (1, G_t, (cos_m, sin_m)),
+                                 (2, G_p, (-sin_m, cos_m))]:
+            Sum_c = np.einsum("nlm,lm->nm", G, HC)
+            Sum_s = np.einsum("nlm,lm->nm", G, HS)
+            Acc[i : i+chunk, k] = np.sum(Sum_c*t_c + Sum_s*t_s, axis=1)
+    return Acc.ravel()
+
+
+def Analyse_PotGrad (lmax, Pos, Acc_line, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns Get_PotGradMatrix(lmax, Pos).T @ Acc_line as HC, HS arrays,
+    without forming the matrix. This is the transpose of Synth_PotGrad
+    """
+    chunk = Get_Chunk(lmax, chunk)
+    Acc = np.asarray(Acc_line).reshape(-1, 3)
+    HC = np.zeros((lmax+1, lmax+1))
+    HS = np.zeros((lmax+1, lmax+1))
+    for i in range (0, len(Pos), chunk):
+        G_r, G_t, G_p, cos_m, sin_m = Get_PotGradTerms(lmax, Pos[i : i+chunk], R, GM)
+        y = Acc[i : i+chunk]
+        for k, G, (t_c, t_s) in [(0, G_r, (cos_m, sin_m)),
+                                 (1, G_t, (cos_m, sin_m)),
+                                 (2, G_p, (-sin_m, cos_m))]:
+            HC += np.einsum("nlm,nm->lm", G, y[:, k:k+1]*t_c)
+            HS += np.einsum("nlm,nm->lm", G, y[:, k:k+1]*t_s)
+    HS[:, 0] = 0
+    return HC, HS
+
+
+def Get_Order_Index (lmax):
+    """
+    Returns, for every order m, the positions in the line array of
+    Make_Line_Coef of the cosine and of the sine coefficients of order m
+    """
+    I_cos, _, M_cos, I_sin, _, M_sin = conv.Get_Index_Coef(lmax)
+    Blocks = []
+    for m in range (0, lmax+1):
+        Blocks.append((m, "cos", I_cos[M_cos == m]))
+        if m > 0:
+            Blocks.append((m, "sin", I_sin[M_sin == m]))
+    return Blocks
+
+
+def Get_Normal_Blocks (lmax, Pos, Acc=None, W=None, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Returns the diagonal blocks, by order m, of the normal matrix: one block
+    for the cosine and one for the sine coefficients of each order.
+    The full normal matrix is never formed.
+    Input:
+        see Get_Normal. Acc is optional
+    Output:
+        Blocks: list of (m, "cos" or "sin", index, N_m, b_m), where index
+            are the positions of the coefficients in the line array, and b_m
+            is None if Acc is None
+    """
+    chunk = Get_Chunk(lmax, chunk, 9)
+    W_line = Make_Weights(W, len(Pos)).reshape(-1, 3)
+    if Acc is not None:
+        Acc = np.asarray(Acc).reshape(-1, 3)
+    Index = Get_Order_Index(lmax)
+    N_m = [np.zeros((idx.size, idx.size)) for _, _, idx in Index]
+    b_m = [np.zeros(idx.size) for _, _, idx in Index]
+
+    with term.Progress(len(Pos), "normal", "points") as P:
+        for i in range (0, len(Pos), chunk):
+            G_r, G_t, G_p, cos_m, sin_m = Get_PotGradTerms(lmax, Pos[i : i+chunk], R, GM)
+            w = W_line[i : i+chunk]
+            for k, (m, cs, idx) in enumerate(Index):
+                l0 = lmax+1 - idx.size
+                if cs == "cos":
+                    t_rt, t_p = cos_m[:, m:m+1], -sin_m[:, m:m+1]
+                else:
+                    t_rt, t_p = sin_m[:, m:m+1], cos_m[:, m:m+1]
+                A_r = G_r[:, l0:, m] * t_rt
+                A_t = G_t[:, l0:, m] * t_rt
+                A_p = G_p[:, l0:, m] * t_p
+                N_m[k] += (A_r.T * w[:, 0]) @ A_r + (A_t.T * w[:, 1]) @ A_t + (A_p.T * w[:, 2]) @ A_p
+                if Acc is not None:
+                    y = Acc[i : i+chunk] * w
+                    b_m[k] += A_r.T @ y[:, 0] + A_t.T @ y[:, 1] + A_p.T @ y[:, 2]
+            P.update(len(Pos[i : i+chunk]))
+
+    return [(m, cs, idx, N_m[k], b_m[k] if Acc is not None else None)
+            for k, (m, cs, idx) in enumerate(Index)]
+
+
+def Make_Block_Precond (Blocks, D_reg=None):
+    """
+    Returns the block-diagonal-by-order preconditioner as a callable
+    P(res) ~ N^-1 @ res, from the factorized blocks of Get_Normal_Blocks
+    D_reg: diagonal added to the normal matrix (regularization), if any
+    """
+    Factors = []
+    for m, cs, idx, N_m, _ in Blocks:
+        N_m = N_m.copy()
+        if D_reg is not None:
+            N_m[np.diag_indices_from(N_m)] += D_reg[idx]
+        Factors.append((idx, spl.cho_factor(N_m)))
+
+    def Precond (res):
+        out = np.empty_like(res)
+        for idx, factor in Factors:
+            out[idx] = spl.cho_solve(factor, res[idx])
+        return out
+    return Precond
+
+
+def Solve_PCG (Apply_N, b, Precond=None, x0=None, tol=1e-10, maxiter=500, callback=None):
+    """
+    Solves N x = b with the preconditioned conjugate gradient method
+    Input:
+        Apply_N: callable returning N @ x
+        b: right hand side
+        Precond: callable returning an approximation of N^-1 @ res
+        x0: first guess, zeros by default
+        tol: stops when |res| / |b| < tol
+        maxiter: maximum number of iterations
+        callback: called as callback(iteration, x, relative residual) after
+                  each iteration. If it returns True, the iterations stop
+    Output:
+        x: the solution
+        n_it: the number of iterations made
+    """
+    if Precond is None: Precond = lambda res: res
+    x = np.zeros_like(b) if x0 is None else x0.copy()
+    res = b - Apply_N(x)
+    z = Precond(res)
+    p = z.copy()
+    rz = res @ z
+    b_norm = npl.norm(b)
+    if b_norm == 0: return x, 0
+
+    for it in range (1, maxiter+1):
+        Np = Apply_N(p)
+        step = rz / (p @ Np)
+        x += step * p
+        res -= step * Np
+        rel = npl.norm(res) / b_norm
+        if callback is not None and callback(it, x, rel):
+            break
+        if rel < tol:
+            break
+        z = Precond(res)
+        rz_new = res @ z
+        p = z + rz_new/rz * p
+        rz = rz_new
+    return x, it
+
+
+@inst.Staged("solve cg")
+def Solve_Coef_CG (lmax, Pos, Acc, W=None, reg=None, alpha=1., precond="block",
+                   tol=1e-10, maxiter=500, callback=None, chunk=0, x0=None, Blocks=None):
+    """
+    Returns the solved for coefficients, with a matrix-free preconditioned
+    conjugate gradient on the normal equations: neither the potential
+    gradient matrix nor the normal matrix are formed, M and M.T are applied
+    with Synth_PotGrad and Analyse_PotGrad
+    Input:
+        lmax, Pos, Acc, W, reg, alpha: see Solve_Coef
+        precond: None, "jacobi", or "block" (block diagonal by order)
+        tol, maxiter, callback, x0: see Solve_PCG
+        chunk: number of points processed at once, 0 to fit Chunk_Memory
+        Blocks: the output of Get_Normal_Blocks, if already computed
+    Output:
+        Solved_coef: line array of solved coefficients
+        Acc_solved: line array of the accelerations from the solved coefficients
+    """
+    Acc_line = np.asarray(Acc).ravel()
+    W_line = Make_Weights(W, len(Pos))
+    D_reg = None if reg is None else alpha*Get_Regularization(lmax, reg)
+    H_buffer = np.zeros((lmax+1, lmax+1)), np.zeros((lmax+1, lmax+1)) # reused at each iteration
+
+    def Apply_N (CS):
+        HC, HS = conv.Make_Array_Coef(lmax, CS, out=H_buffer)
+        y = Synth_PotGrad(lmax, Pos, HC, HS, chunk=chunk) * W_line
+        NC, NS = Analyse_PotGrad(lmax, Pos, y, chunk=chunk)
+        N_CS = conv.Make_Line_Coef(lmax, NC, NS)
+        if D_reg is not None:
+            N_CS += D_reg * CS
+        return N_CS
+
+    BC, BS = Analyse_PotGrad(lmax, Pos, Acc_line * W_line, chunk=chunk)
+    b = conv.Make_Line_Coef(lmax, BC, BS)
+
+    if (precond in ["block", "jacobi"]) and (Blocks is None):
+        Blocks = Get_Normal_Blocks(lmax, Pos, None, W_line, chunk=chunk)
+    if precond == "block":
+        Precond = Make_Block_Precond(Blocks, D_reg)
+    elif precond == "jacobi":
+        D = np.concatenate([np.diag(N_m) for _, _, _, N_m, _ in Blocks])
+        Index = np.concatenate([idx for _, _, idx in Get_Order_Index(lmax)])
+        Diag = np.zeros(b.size); Diag[Index] = D
+        if D_reg is not None: Diag += D_reg
+        Precond = lambda res: res / Diag
+    else:
+        Precond = None
+
+    Solved_coef, n_it = Solve_PCG(Apply_N, b, Precond, x0, tol, maxiter, callback)
+    print(f"Conjugate gradient: {n_it} iterations")
+
+    HC, HS = conv.Make_Array_Coef(lmax, Solved_coef)
+    Acc_solved = Synth_PotGrad(lmax, Pos, HC, HS, chunk=chunk)
     return Solved_coef, Acc_solved
 
 
 
+# =============================================================================
+# FUNCTIONS FOR BLOCK DIAGONAL SOLVE
+# =============================================================================
+def Check_Block_Diagonal (lmax, Pos, W=None, lmax_check=20, n_sample=2000):
+    """
+    Returns how far the normal matrix is from being block diagonal by order:
+    the Frobenius norm of the off-block part of the (diagonally scaled)
+    normal matrix, relative to the norm of the whole matrix.
+    ~0 for near-polar repeat orbits with regular sampling, ~1 for random points
+    The check is made on a subsample of the points, and up to lmax_check
+    """
+    lmax = min(lmax, lmax_check)
+    step = max(1, len(Pos) // n_sample)
+    W_line = Make_Weights(W, len(Pos)).reshape(-1, 3)[::step]
+    N, _, _ = Get_Normal(lmax, Pos[::step], np.zeros(3*len(W_line)), W_line)
+
+    D = np.sqrt(np.diag(N))
+    D[D == 0] = 1
+    N = N / D[:, None] / D[None, :]
+    In_block = np.zeros(N.shape, dtype=bool)
+    for _, _, idx in Get_Order_Index(lmax):
+        In_block[np.ix_(idx, idx)] = True
+    return npl.norm(N[~In_block]) / npl.norm(N)
+
+
+@inst.Staged("solve block")
+def Solve_Coef_Block (lmax, Pos, Acc, W=None, reg=None, alpha=1., full=None,
+                      threshold=0.05, n_jobs=None, chunk=0, **CG_args):
+    """
+    Returns the solved for coefficients, assuming the normal matrix is block
+    diagonal by order m (near-polar repeat orbits): only the blocks of the
+    cosine and sine coefficients of each order are formed, and they are
+    solved independently, in parallel threads
+    Input:
+        lmax, Pos, Acc, W, reg, alpha: see Solve_Coef
+        full: True:  the block solution is the first guess and the blocks are
+                     the preconditioner of Solve_Coef_CG on the full problem
+              False: the block solution is returned as is
+              None:  decided by Check_Block_Diagonal against threshold
+        n_jobs: number of threads solving the blocks
+        CG_args: passed on to Solve_Coef_CG if full
+    Output:
+        Solved_coef: line array of solved coefficients
+        Acc_solved: line array of the accelerations from the solved coefficients
+    """
+    if full is None:
+        ratio = Check_Block_Diagonal(lmax, Pos, W)
+        full = ratio > threshold
+        print(f"Off-block ratio of the normal matrix = {ratio:.3f}; full solve: {full}")
+
+    Blocks = Get_Normal_Blocks(lmax, Pos, Acc, W, chunk=chunk)
+    D_reg = None if reg is None else alpha*Get_Regularization(lmax, reg)
+
+    def Solve_Block (Block):
+        _, _, idx, N_m, b_m = Block
+        if D_reg is not None:
+            N_m = N_m.copy()
+            N_m[np.diag_indices_from(N_m)] += D_reg[idx]
+        return idx, spl.cho_solve(spl.cho_factor(N_m), b_m)
+
+    Solved_coef = np.zeros(conv.Get_Len_Coef(lmax))
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for idx, x_m in pool.map(Solve_Block, Blocks):
+            Solved_coef[idx] = x_m
+
+    if full:
+        return Solve_Coef_CG(lmax, Pos, Acc, W, reg, alpha, "block", chunk=chunk,
+                             x0=Solved_coef, Blocks=Blocks, **CG_args)
+
+    HC, HS = conv.Make_Array_Coef(lmax, Solved_coef)
+    Acc_solved = Synth_PotGrad(lmax, Pos, HC, HS, chunk=chunk)
+    return Solved_coef, Acc_solved
+
+
+
+# =============================================================================
+# FUNCTIONS FOR INCREMENTAL SOLVE
+# =============================================================================
+def Init_Normal (lmax, meta=None):
+    """
+    Returns an empty solver state: the normal equations accumulated so far
+    Store it with GH_export.Store_Normal, load it with GH_import.Load_Normal
+        lmax: maximum degree of the coefficients
+        N, b, yty: normal matrix, right hand side, weighted |Acc|**2
+        n_obs: number of accelerations components accumulated
+        arcs: names of the arcs accumulated, in order
+        meta: dictionary of user information (file names, constants...)
+    """
+    N_coef = conv.Get_Len_Coef(lmax)
+    state = {"lmax": lmax,
+             "N": np.zeros((N_coef, N_coef)),
+             "b": np.zeros(N_coef),
+             "yty": 0.,
+             "n_obs": 0,
+             "arcs": [],
+             "meta": dict(meta) if meta else {}}
+    return state
+
+
+def Update_Normal (state, Pos, Acc, W=None, arc_name=""):
+    """
+    Adds the contribution of a new arc of Pos, Acc to the solver state
+    An arc that has already been accumulated under the same name is skipped
+    """
+    if arc_name and (arc_name in state["arcs"]):
+        print(f"Arc \"{arc_name}\" is already in the normal equations, skipped")
+        return state
+    N, b, yty = Get_Normal(state["lmax"], Pos, Acc, W)
+    state["N"] += N
+    state["b"] += b
+    state["yty"] += yty
+    state["n_obs"] += 3*len(Pos)
+    state["arcs"].append(arc_name)
+    return state
+
+
+def Stream_Update_Normal (state, Stream, W=None, arc_name=""):
+    """
+    Adds the chunks of a stream of Time, Pos, Acc (see
+    GH_generate.Stream_Normal) to the solver state, as one arc
+    Yields the chunks once they are accumulated, so it can be counted like
+    the other stages of the stream
+    W: None or one weight per acceleration component (3 values)
+    """
+    if arc_name and (arc_name in state["arcs"]):
+        print(f"Arc \"{arc_name}\" is already in the normal equations, skipped")
+        return
+    for Time, Pos, Acc in Stream:
+        w = None if W is None else np.tile(W, len(Pos))
+        N, b, yty = Get_Normal(state["lmax"], Pos, Acc, w)
+        state["N"] += N
+        state["b"] += b
+        state["yty"] += yty
+        state["n_obs"] += 3*len(Pos)
+        yield Time, Pos, Acc
+    state["arcs"].append(arc_name)
+
+
+def Solve_State (state, reg=None, alpha=1., n_refine=0):
+    """
+    Returns the coefficients solved from the accumulated normal equations,
+    and the a posteriori variance of unit weight
+    reg, alpha, n_refine: see Solve_Coef
+    """
+    N = state["N"]
+    if reg is not None:
+        N = N.copy()
+        N[np.diag_indices_from(N)] += alpha*Get_Regularization(state["lmax"], reg)
+    Solved_coef = Solve_Normal(N, state["b"], n_refine)
+
+    dof = max(state["n_obs"] - Solved_coef.size, 1)
+    sigma0_2 = (state["yty"] - 2*Solved_coef @ state["b"]
+                + Solved_coef @ state["N"] @ Solved_coef) / dof
+    return Solved_coef, sigma0_2
+
+
+def Get_Index_Extend (lmax_old, lmax_new):
+    """
+    Returns the positions, in the line array of degree lmax_new, of the
+    coefficients of the line array of degree lmax_old, and of the new ones
+    """
+    I_cos, L_cos, M_cos, I_sin, L_sin, M_sin = conv.Get_Index_Coef(lmax_new)
+    old = np.zeros(conv.Get_Len_Coef(lmax_new), dtype=bool)
+    old[I_cos[L_cos <= lmax_old]] = True
+    old[I_sin[L_sin <= lmax_old]] = True
+    return np.flatnonzero(old), np.flatnonzero(~old)
+
+
+def Extend_Normal (state, lmax_new, arcs, chunk=0):
+    """
+    Extends the solver state to lmax_new. The normal matrix of the old
+    coefficients is kept as is, only the blocks involving the new
+    coefficients are computed. The arcs must be the same as the ones already
+    accumulated (see state["arcs"]), in a list of (Pos, Acc, W)
+    """
+    lmax_old = state["lmax"]
+    if lmax_new <= lmax_old:
+        return state
+    if len(arcs) != len(state["arcs"]):
+        raise Exception(f"{len(arcs)} arcs given, {len(state['arcs'])} were accumulated")
+    chunk = Get_Chunk(lmax_new, chunk, 14)
+    I_old, I_new = Get_Index_Extend(lmax_old, lmax_new)
+    print(f"Extending the normal equations from lmax = {lmax_old} to {lmax_new}")
+
+    N_on = np.zeros((I_old.size, I_new.size))
+    N_nn = np.zeros((I_new.size, I_new.size))
+    b_n = np.zeros(I_new.size)
+    for Pos, Acc, W in arcs:
+        Acc_line = np.asarray(Acc).ravel()
+        W_line = Make_Weights(W, len(Pos))
+        with term.Progress(len(Pos), "normal", "points") as P:
+            for i in range (0, len(Pos), chunk):
+                M = Get_PotGradBlock(lmax_new, Pos[i : i+chunk])
+                M_o = M[:, I_old]
+                M_n = M[:, I_new] * W_line[3*i : 3*(i+chunk), None]
+                N_on += M_o.T @ M_n
+                N_nn += M_n.T @ M[:, I_new]
+                b_n += M_n.T @ Acc_line[3*i : 3*(i+chunk)]
+                P.update(len(Pos[i : i+chunk]))
+
+    N_coef = I_old.size + I_new.size
+    N = np.zeros((N_coef, N_coef))
+    N[np.ix_(I_old, I_old)] = state["N"]
+    N[np.ix_(I_old, I_new)] = N_on
+    N[np.ix_(I_new, I_old)] = N_on.T
+    N[np.ix_(I_new, I_new)] = N_nn
+    b = np.zeros(N_coef)
+    b[I_old] = state["b"]
+    b[I_new] = b_n
+
+    state["lmax"] = lmax_new
+    state["N"] = N
+    state["b"] = b
+    return state
+
+
+
+# =============================================================================
+# FUNCTIONS FOR CHECKPOINTED SOLVE
+# =============================================================================
+def Get_Hash (*args):
+    """
+    Returns a content hash (sha256, hex) of the arguments: arrays are hashed
+    on their shape, type and bytes, other arguments on their repr
+    """
+    H = hashlib.sha256()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            arg = np.ascontiguousarray(arg)
+            H.update(f"{arg.shape}{arg.dtype}".encode())
+            H.update(arg.data)
+        else:
+            H.update(repr(arg).encode())
+    return H.hexdigest()
+
+
+def Get_Normal_Checkpoint (lmax, Pos, Acc, W=None, title="normal", path="../Rendered/temp",
+                           every=50, R=6378.1363, GM=398600.4418, chunk=0):
+    """
+    Same as Get_Normal, but the partial sums are stored to disk every
+    "every" chunks. If the build is interrupted, calling this function again
+    with the same inputs resumes from the last checkpoint.
+    The checkpoint file is "{path}/{title}_{hash}.npz", where hash is the
+    content hash of the inputs, so that a checkpoint is never resumed with
+    other positions, accelerations, weights, lmax or constants.
+    It is written with GH_export.Store_Normal (atomic write), and kept once
+    complete, so a rerun returns immediately. Delete it to free disk space.
+    """
+    Acc_line = np.asarray(Acc, dtype=float).ravel()
+    W_line = Make_Weights(W, len(Pos))
+    Pos = np.asarray(Pos, dtype=float)
+    chunk = Get_Chunk(lmax, chunk, 14)
+    key = Get_Hash(lmax, Pos, Acc_line, W_line, R, GM, chunk)[:16]
+    title = f"{title}_{key}"
+
+    if os.path.exists(f"{path}/{title}.npz"):
+        state = imp.Load_Normal(title, path)
+        print(f"Resuming \"{title}\" at point {state['meta']['i_next']} of {len(Pos)}")
+    else:
+        state = Init_Normal(lmax, {"hash": key, "i_next": 0})
+
+    step = every*chunk
+    for i in range (state["meta"]["i_next"], len(Pos), step):
+        N, b, yty = Get_Normal(lmax, Pos[i : i+step], Acc_line[3*i : 3*(i+step)],
+                               W_line[3*i : 3*(i+step)], R, GM, chunk)
+        state["N"] += N
+        state["b"] += b
+        state["yty"] += yty
+        state["n_obs"] += 3*len(Pos[i : i+step])
+        state["meta"]["i_next"] = min(i+step, len(Pos))
+        exp.Store_Normal(state, title, path)
+
+    return state["N"], state["b"], state["yty"]
+
+
+
+# =============================================================================
+# FUNCTIONS FOR RESIDUAL ANALYSIS
+# =============================================================================
+def Get_Residuals (lmax, Pos, Acc, CS, chunk=0):
+    """
+    Returns the residuals Acc - M @ CS as a line array, computed chunk by
+    chunk with Synth_PotGrad, without forming M
+    """
+    HC, HS = conv.Make_Array_Coef(lmax, CS)
+    return np.asarray(Acc).ravel() - Synth_PotGrad(lmax, Pos, HC, HS, chunk=chunk)
+
+
+def Find_Outliers (Res, W_line, k_sigma=3.):
+    """
+    Returns the mask of the residuals further than k_sigma robust standard
+    deviations from their median, among the ones of non-zero weight.
+    The standard deviation is estimated with the median absolute deviation
+    of the weighted residuals, separately for each of the 3 components
+    """
+    Res = (Res * np.sqrt(W_line)).reshape(-1, 3)
+    Used = W_line.reshape(-1, 3) > 0
+    Out = np.zeros(Res.shape, dtype=bool)
+    for k in range(3):
+        res_k = Res[Used[:, k], k]
+        if res_k.size == 0: continue
+        med = np.median(res_k)
+        sigma = 1.4826 * np.median(np.abs(res_k - med))
+        if sigma == 0: continue
+        Out[:, k] = Used[:, k] & (np.abs(Res[:, k] - med) > k_sigma*sigma)
+    return Out.ravel()
+
+
+@inst.Staged("solve robust")
+def Solve_Coef_Robust (lmax, Pos, Acc, W=None, reg=None, alpha=1., k_sigma=3.,
+                       max_iter=10, n_refine=0, chunk=0):
+    """
+    Returns the solved for coefficients, with an outlier rejection loop:
+    solve, compute the residuals, flag the outliers (see Find_Outliers),
+    remove them from the normal equations, and solve again, until no new
+    outlier is found.
+    Removing outliers downdates the normal equations with the rows of the
+    outliers only, the normal matrix is never rebuilt
+    Input:
+        lmax, Pos, Acc, W, reg, alpha, n_refine: see Solve_Coef
+        k_sigma: rejection threshold in robust standard deviations
+        max_iter: maximum number of rejection iterations
+    Output:
+        Solved_coef: line array of solved coefficients
+        Acc_solved: line array of the accelerations from the solved coefficients
+        W_line: the final weights, one per component, 0 for the outliers
+        Report: list of dictionaries, one per iteration, with the number of
+                outliers, the weighted rms of the residuals and the timings
+    """
+    chunk = Get_Chunk(lmax, chunk, 14)
+    Acc_line = np.asarray(Acc, dtype=float).ravel()
+    W_line = Make_Weights(W, len(Pos)).copy()
+    N, b, _ = Get_Normal(lmax, Pos, Acc_line, W_line, chunk=chunk)
+    D_reg = None if reg is None else alpha*Get_Regularization(lmax, reg)
+    Report = []
+
+    for it in range (0, max_iter+1):
+        t0 = time.perf_counter()
+        N_r = N
+        if D_reg is not None:
+            N_r = N.copy()
+            N_r[np.diag_indices_from(N_r)] += D_reg
+        Solved_coef = Solve_Normal(N_r, b, n_refine)
+        t1 = time.perf_counter()
+        Res = Get_Residuals(lmax, Pos, Acc_line, Solved_coef, chunk)
+        t2 = time.perf_counter()
+        Out = Find_Outliers(Res, W_line, k_sigma)
+
+        used = W_line > 0
+        rms = np.sqrt(np.sum(W_line*Res**2) / max(np.sum(W_line[used]), 1e-300))
+        Report.append({"iteration": it, "outliers": int(Out.sum()),
+                       "rejected": int((~used).sum()), "rms": rms,
+                       "t_solve": t1-t0, "t_residuals": t2-t1})
+        print(f"iteration {it}: rms = {rms:.3e}; {Out.sum()} new outliers; "
+              f"solve {t1-t0:.2f} s; residuals {t2-t1:.2f} s")
+        if (not Out.any()) or (it == max_iter):
+            break
+
+        # downdate the normal equations with the rows of the outliers
+        Pts = np.unique(np.flatnonzero(Out) // 3)
+        for i in range (0, Pts.size, chunk):
+            pts = Pts[i : i+chunk]
+            rows = (3*pts[:, None] + np.arange(3)).ravel()
+            M = Get_PotGradBlock(lmax, Pos[pts])
+            w = W_line[rows] * Out[rows]
+            Mw = M * w[:, None]
+            N -= Mw.T @ M
+            b -= Mw.T @ Acc_line[rows]
+        W_line[Out] = 0
+        Report[-1]["t_downdate"] = time.perf_counter() - t2
+
+    Acc_solved = Acc_line - Res
+    return Solved_coef, Acc_solved, W_line, Report
+
+
 
 # =============================================================================
 # TEST FUNCTIONS
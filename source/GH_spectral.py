@@ -0,0 +1,195 @@
+"""
+@authors:
+# =============================================================================
+ Information:
+    The functions in this script are used to compare gravity fields degree
+    by degree: degree variances, difference degree variances, cumulative geoid
+    error, and signal to noise ratio per degree.
+    They work directly on the line arrays of coefficients of
+    GH_convert.Make_Line_Coef, with no loop over the degrees and orders.
+    Generally used variables:
+        lmax   = maximum degree
+        CS     = line array of coefficients, see GH_convert.Get_Index_Coef
+        HC, HS = Geopotential stokes coefficients
+    Can be run from the terminal, on coefficient files written with
+    GH_export.Store_Array:
+        python GH_spectral.py "HC_sim.txt" "HS_sim.txt" --lmax 30
+# =============================================================================
+"""
+# =============================================================================
+# LIBRARIES
+# =============================================================================
+import numpy as np
+import argparse
+
+import GH_import       as imp
+import GH_convert      as conv
+#import GH_generate     as gen
+#import GH_solve        as solv
+#import GH_displayGeoid as dgeo
+#import GH_displaySat   as dsat
+#import GH_export       as exp
+#import GH_displayTopo  as dtopo
+#import GH_terminal     as term
+#import GH_harmonics    as harm
+import GH_geoMath      as gmath
+#import GH_earthMap     as emap
+
+
+
+# =============================================================================
+# FUNCTIONS FOR DEGREE VARIANCES
+# =============================================================================
+def Degree_Variance (lmax, CS, order="GH"):
+    """
+    Returns the degree variances of the line array of coefficients CS:
+        sigma2[l] = sum over m of (C_lm**2 + S_lm**2)
+    Input:
+        lmax: maximum degree of CS
+        CS: line array of coefficients
+        order: ordering of CS, see GH_convert.Get_Index_Coef
+    Output:
+        sigma2: array of lmax+1 degree variances
+    """
+    I_cos, L_cos, _, I_sin, L_sin, _ = conv.Get_Index_Coef(lmax, order)
+    CS = np.asarray(CS).ravel()
+    sigma2  = np.bincount(L_cos, weights=CS[I_cos]**2, minlength=lmax+1)
+    sigma2 += np.bincount(L_sin, weights=CS[I_sin]**2, minlength=lmax+1)
+    return sigma2
+
+
+def Degree_Variance_Array (lmax, HC, HS):
+    """ Returns the degree variances of the HC, HS arrays, see Degree_Variance """
+    return Degree_Variance(lmax, conv.Make_Line_Coef(lmax, HC, HS))
+
+
+def Diff_Degree_Variance (lmax, CS_1, CS_2, order="GH"):
+    """
+    Returns the difference degree variances between two line arrays of
+    coefficients, the "error" spectrum of CS_1 with respect to CS_2
+    """
+    return Degree_Variance(lmax, np.asarray(CS_1) - np.asarray(CS_2), order)
+
+
+def Degree_RMS (sigma2):
+    """ Returns the rms per coefficient of each degree (Kaula's rule scale) """
+    l = np.arange(sigma2.size)
+    return np.sqrt(sigma2 / (2*l + 1))
+
+
+def Geoid_Degree_Amplitude (sigma2, R=gmath.Constants.a_g):
+    """ Returns the geoid height amplitude of each degree, in m """
+    return R * np.sqrt(sigma2)
+
+
+def Cumul_Geoid_Error (sigma2_diff, R=gmath.Constants.a_g):
+    """ Returns the cumulative geoid error up to each degree, in m """
+    return R * np.sqrt(np.cumsum(sigma2_diff))
+
+
+def SNR_Degree (sigma2_signal, sigma2_diff):
+    """
+    Returns the signal to noise ratio of each degree, inf where there is no
+    difference, nan where there is neither signal nor difference
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(sigma2_signal / sigma2_diff)
+
+
+
+# =============================================================================
+# FUNCTIONS FOR TABLES
+# =============================================================================
+def Spectral_Table (lmax, CS_solved, CS_ref, R=gmath.Constants.a_g):
+    """
+    Returns the table of the spectral diagnostics of CS_solved against CS_ref
+    Output:
+        Table: structured array with, for each degree l >= 2, the fields
+            l, rms_ref, rms_solved, rms_diff, geoid_ref (m),
+            cumul_geoid_err (m), snr
+    """
+    sigma2_ref = Degree_Variance(lmax, CS_ref)
+    sigma2_slv = Degree_Variance(lmax, CS_solved)
+    sigma2_dif = Diff_Degree_Variance(lmax, CS_solved, CS_ref)
+
+    Table = np.zeros(lmax+1, dtype=[("l", int), ("rms_ref", float),
+                                    ("rms_solved", float), ("rms_diff", float),
+                                    ("geoid_ref", float), ("cumul_geoid_err", float),
+                                    ("snr", float)])
+    Table["l"] = np.arange(lmax+1)
+    Table["rms_ref"] = Degree_RMS(sigma2_ref)
+    Table["rms_solved"] = Degree_RMS(sigma2_slv)
+    Table["rms_diff"] = Degree_RMS(sigma2_dif)
+    Table["geoid_ref"] = Geoid_Degree_Amplitude(sigma2_ref, R)
+    Table["cumul_geoid_err"] = Cumul_Geoid_Error(sigma2_dif, R)
+    Table["snr"] = SNR_Degree(sigma2_ref, sigma2_dif)
+    return Table[2:]
+
+
+def Spectral_Table_Array (lmax, HC, HS, HC_ref, HS_ref, R=gmath.Constants.a_g):
+    """ Same as Spectral_Table, from coefficient arrays """
+    CS_solved = conv.Make_Line_Coef(lmax, HC, HS)
+    CS_ref = conv.Make_Line_Coef(lmax, HC_ref, HS_ref)
+    return Spectral_Table(lmax, CS_solved, CS_ref, R)
+
+
+def Format_Table (Table):
+    """ Returns the spectral table as text, one line per degree """
+    names = Table.dtype.names
+    lines = ["\t".join(f"{name:>15}" for name in names)]
+    for row in Table:
+        lines.append(f"{row[0]:>15d}\t" + "\t".join(f"{val:>15.6e}" for val in list(row)[1:]))
+    return "\n".join(lines)
+
+
+
+# =============================================================================
+# TEST FUNCTIONS
+# =============================================================================
+def TEST_Spectral ():
+    """ Compares the reference coefficients with a noisy copy of themselves """
+    HC, HS = imp.Fetch_Coef()
+    lmax = len(HC) - 1
+    HC_n = HC + np.tril(np.random.randn(*HC.shape)) * 1e-9
+    HS_n = HS + np.tril(np.random.randn(*HS.shape)) * 1e-9
+    Table = Spectral_Table_Array(lmax, HC_n, HS_n, HC, HS)
+    print(Format_Table(Table))
+    return Table
+
+
+def Main (argv=None):
+    """ terminal interface, see the description at the top of this script """
+    parser = argparse.ArgumentParser(description="Spectral diagnostics of solved coefficients")
+    parser.add_argument("HC", help="cosine coefficients file (see GH_export.Store_Array)")
+    parser.add_argument("HS", help="sine coefficients file")
+    parser.add_argument("--lmax", type=int, default=0, help="maximum degree (default: all)")
+    parser.add_argument("--ref", nargs="+", default=["subset"],
+                        help="reference: \"subset\", \"full\" (see GH_import.Fetch_Coef), or the HC HS files")
+    parser.add_argument("--path", default="../Rendered/coefficients", help="path of the coefficient files")
+    parser.add_argument("--out", default="", help="file to write the table into")
+    args = parser.parse_args(argv)
+
+    HC = np.loadtxt(f"{args.path}/{args.HC}", ndmin=2)
+    HS = np.loadtxt(f"{args.path}/{args.HS}", ndmin=2)
+    if len(args.ref) == 2:
+        HC_ref = np.loadtxt(f"{args.path}/{args.ref[0]}", ndmin=2)
+        HS_ref = np.loadtxt(f"{args.path}/{args.ref[1]}", ndmin=2)
+    else:
+        HC_ref, HS_ref = imp.Fetch_Coef(args.ref[0])
+
+    lmax = min(len(HC), len(HC_ref)) - 1
+    if args.lmax > 0: lmax = min(lmax, args.lmax)
+
+    text = Format_Table(Spectral_Table_Array(lmax, HC, HS, HC_ref, HS_ref))
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(text + "\n")
+    print(text)
+
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+if __name__ == '__main__':
+    Main()
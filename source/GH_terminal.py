@@ -4,13 +4,25 @@
  Information:
     The functions in this script are used to write text to the terminal
     with a nice printout
+    Progress reports the advance of long loops without slowing them down:
+    the loop only adds to a counter, and a background thread prints the line
+    a few times per second, with the nested stages, the rate and an ETA
+        with term.Progress(len(Rows), "grid", "rows") as P:
+            for row in Rows:
+                ...
+                P.update()
+    Nothing is printed when the output is not a terminal (batch runs, logs),
+    unless Show is set to True
 # =============================================================================
 """
 
 # =============================================================================
 # LIBRARIES
 # =============================================================================
+import os
+import sys
 import time
+import threading
 
 #import GH_import       as imp
 #import GH_convert      as conv
@@ -26,6 +38,17 @@ import time
 #import GH_earthMap     as emap
 
 
+# =============================================================================
+# GLOBAL VARIABLES
+# =============================================================================
+Show = None # None: show the progress in terminals and consoles only, True/False to force it
+Interval = 0.5 # s between two progress lines
+Progress_Stack = [] # the Progress stages open, outermost first
+Reporter = None # [thread, stop event] printing the progress of Progress_Stack
+Last_Length = 0 # length of the last progress line, to write over it
+
+
+
 # =============================================================================
 # FUNCTIONS TO PRINT TEXT
 # =============================================================================
@@ -54,6 +77,131 @@ def printProgressBar (iteration, total, length=20, decimals=1):
         print("\n")
 
 
+# =============================================================================
+# PROGRESS
+# =============================================================================
+class Progress:
+    """
+    A stage of progress, used as a context manager around a loop
+    Stages opened inside another one are shown after it on the same line
+    Input:
+        total: number of items of the stage, 0 if unknown
+        title: name of the stage
+        unit: name of the items, for the rate
+        thread: print from a background thread every Interval seconds. If
+                False, the line is printed by update, at most every Interval
+                seconds: for loops with few, long iterations
+    Use:
+        update(n): adds n items done, it does nothing else when threaded
+    """
+    def __init__ (self, total=0, title="Progress", unit="it", thread=True):
+        self.total = total
+        self.title = title
+        self.unit = unit
+        self.thread = thread
+        self.done = 0
+        self.t_0 = time.perf_counter()
+        self.t_print = 0
+
+    def __enter__ (self):
+        self.t_0 = time.perf_counter()
+        Progress_Stack.append(self)
+        if (len(Progress_Stack) == 1) and self.thread and Is_Interactive():
+            Start_Reporter()
+        return self
+
+    def update (self, n=1):
+        self.done += n
+        if (not self.thread) and (Reporter is None):
+            t = time.perf_counter()
+            if (t - self.t_print >= Interval) and Is_Interactive():
+                self.t_print = t
+                Print_Progress()
+
+    def __exit__ (self, *exc):
+        if (len(Progress_Stack) == 1) and Is_Interactive():
+            Stop_Reporter()
+            Print_Progress(final=True)
+        Progress_Stack.remove(self)
+        return False
+
+
+def Is_Interactive ():
+    """ True if the progress should be printed, see Show """
+    if Show is not None:
+        return Show
+    if os.environ.get("GH_PROGRESS") == "0":
+        return False
+    return sys.stdout.isatty() or ("ipykernel" in sys.modules) or ("spyder_kernels" in sys.modules)
+
+
+def Start_Reporter ():
+    """ Starts the thread printing the progress every Interval seconds """
+    global Reporter
+    Stop = threading.Event()
+    def Report ():
+        while not Stop.wait(Interval):
+            Print_Progress()
+    Thread = threading.Thread(target=Report, name="Progress", daemon=True)
+    Reporter = [Thread, Stop]
+    Thread.start()
+
+
+def Stop_Reporter ():
+    """ Stops the thread started by Start_Reporter """
+    global Reporter
+    if Reporter is not None:
+        Thread, Stop = Reporter
+        Stop.set()
+        Thread.join()
+        Reporter = None
+
+
+def Format_Progress (final=False):
+    """
+    Returns the line of the open stages: the advance of each stage, then the
+    rate and the time left of the innermost one, and of the outermost one
+    once it has advanced. When final, the total time of the outermost one
+    """
+    Stack = list(Progress_Stack) # the loop may open or close stages meanwhile
+    if not Stack:
+        return ""
+    Parts = []
+    for Stage in Stack:
+        part = f"{Stage.title}: {Stage.done}"
+        if Stage.total:
+            part += f"/{Stage.total} ({100*Stage.done/Stage.total:.0f}%)"
+        Parts.append(part)
+    Outer, Stage = Stack[0], Stack[-1]
+    if final:
+        return f"{Parts[0]} in {Format_Duration(time.perf_counter() - Outer.t_0)}"
+
+    elapsed = time.perf_counter() - Stage.t_0
+    rate = Stage.done / elapsed if elapsed > 0 else 0
+    line = " > ".join(Parts) + f" | {rate:.3g} {Stage.unit}/s"
+    if Stage.total and (rate > 0):
+        line += f" | ETA {Format_Duration((Stage.total - Stage.done) / rate)}"
+    if (Outer is not Stage) and Outer.total and Outer.done:
+        t = time.perf_counter() - Outer.t_0
+        line += f" (all {Format_Duration(t * (Outer.total - Outer.done) / Outer.done)})"
+    return line
+
+
+def Print_Progress (final=False):
+    """ Prints the line of Format_Progress over the previous one """
+    global Last_Length
+    line = Format_Progress(final)
+    print(f"\r{line:<{Last_Length}}", end="\n" if final else "", flush=True)
+    Last_Length = 0 if final else len(line)
+
+
+def Format_Duration (t):
+    """ Returns a duration in seconds as h:mm:ss """
+    t = int(round(t))
+    return f"{t//3600}:{t%3600//60:02d}:{t%60:02d}"
+
+
+
 # =============================================================================
 # TEST FUNCTIONS
 # =============================================================================
@@ -70,10 +218,20 @@ def TEST_ProgressBar():
         printProgressBar(i + 1, l)
 
 
+def TEST_Progress():
+    with Progress(5, "tiles") as P_tiles:
+        for tile in range(5):
+            with Progress(200, "rows", "rows") as P_rows:
+                for row in range(200):
+                    time.sleep(0.005)
+                    P_rows.update()
+            P_tiles.update()
+
+
 # =============================================================================
 # MAIN
 # =============================================================================
 if __name__ == '__main__':
-    TEST_ProgressBar()
+    TEST_Progress()
 
     print("\nGH_export done")
\ No newline at end of file
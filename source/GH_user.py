@@ -30,6 +30,7 @@ future stuff:
 # =============================================================================
 import numpy as np
 import matplotlib.pyplot as plt
+import os
 from time import gmtime, strftime
 
 import GH_import       as imp
@@ -44,6 +45,7 @@ import GH_export       as exp
 #import GH_harmonics    as harm
 #import GH_geoMath      as gmath
 #import GH_earthMap     as emap
+import GH_instrument   as inst
 
 
 from GH_import import data_path #= "../data"
@@ -69,6 +71,9 @@ if __name__ == '__main__':
     """ data solving """
     lmax_gen   = 5 # when generating the data
     lmax_solve = 5  # when solving for coefficients
+    solve_method = "cholesky" # "lstsq", "cholesky", "cg", "block", "robust", see solv.Solve_Coef
+    solve_reg = None # None, "kaula", "tikhonov"
+    normal_title = "" # if set, the normal equations are kept in save_co_path and updated with each new arc
 
     """ plotting maps of geoids """
     lmax_topo = 5
@@ -80,10 +85,16 @@ if __name__ == '__main__':
     save_im_path = "../Rendered/images"
     save_co_path = "../Rendered/coefficients"
 
+    """ measuring the run, see GH_instrument """
+    instrument = False # prints the time and memory of each step at the end
+    profile = False # profiles the whole run with cProfile
+
 # =============================================================================
 # =============================================================================
 #%%
     time_str = imp.Get_Time()
+    if instrument: inst.Enable()
+    if profile: Profiler = inst.Start_Profile()
 
 
     #HC, HS = imp.Fetch_Coef()
@@ -95,10 +106,21 @@ if __name__ == '__main__':
 
 
 #%% # Do math...
-    Solved_coef_sim, Acc_solved_sim = solv.Solve_Coef(lmax_solve, Pos_sim, Acc_sim.T)
+    if normal_title:
+        if os.path.exists(f"{save_co_path}/{normal_title}.npz"):
+            state = imp.Load_Normal(normal_title, save_co_path)
+        else:
+            state = solv.Init_Normal(lmax_solve, {"lmax_gen": lmax_gen})
+        state = solv.Update_Normal(state, Pos_sim[1:-1], Acc_sim, arc_name=f"{file_name} {days}") # Gen_Acc drops the first and last points
+        exp.Store_Normal(state, normal_title, save_co_path)
+        lmax_solve = state["lmax"]
+        Solved_coef_sim, _ = solv.Solve_State(state, solve_reg)
+        Acc_solved_sim = solv.Apply_PotGradMatrix(lmax_solve, Pos_sim[1:-1], Solved_coef_sim)
+    else:
+        Solved_coef_sim, Acc_solved_sim = solv.Solve_Coef(lmax_solve, Pos_sim[1:-1], Acc_sim, solve_method, reg=solve_reg) # Gen_Acc drops the first and last points
     HC_sim, HS_sim = conv.Make_Array_Coef(lmax_solve, Solved_coef_sim)
 
-    Acc_solved_sim = conv.Make_Array(Acc_solved_sim[:-2]) # this "-2" must be replaced with a modulo function to get the highest number thats a multiple of 3, AND smaller than the length of the array
+    Acc_solved_sim = conv.Make_Array(Acc_solved_sim)
 
 
 #%% # plotting path simulation
@@ -130,6 +152,13 @@ if __name__ == '__main__':
         exp.Store_Figure(MAP_SIM.number,  title3, time_str, save_im_path, 500)
 
 
+#%% run summary
+    if profile:
+        inst.Stop_Profile(Profiler, f"GH_user {time_str}")
+    if inst.Enabled:
+        print("\n" + inst.Report())
+
+
 print("\nUser instructions done")
 
 #%%